@@ -10,6 +10,7 @@ import math
 from collections import defaultdict
 import itertools
 import heapq
+import numpy as np
 
 from codedep import codeDeps
 
@@ -19,6 +20,7 @@ from armspeech.util.util import MapElem
 from armspeech.util.mathhelp import ThreshMax
 from armspeech.util.mathhelp import assert_allclose
 from armspeech.util.timing import timed
+import armspeech.numpy_settings
 
 @codeDeps()
 def partitionLabels(labels, fullQuestion):
@@ -172,6 +174,137 @@ class DepthBasedFirstLevelAccSummer(object):
 
         return leafToQgToValueToAcc
 
+@codeDeps(d.AccArena, d.getAccArena)
+class BitsetAccSummer(object):
+    """An acc summer that computes the accs for all questions at once.
+
+    This combines the roles of a node-based first-level acc summer and a
+    second-level acc summer, and is useful when there are many labels and
+    questions.
+    All the distinct labels are encoded once as an integer matrix with one
+    column for each question group, giving the index of the value of each
+    label among the distinct values for that question group. Each question is
+    then evaluated once for each distinct value, and the resulting answers
+    are stored as a bitset (a boolean vector over labels) for each answer.
+    The statistics of the acc for each label are stacked into a matrix (see
+    d.getAccArena), so that the accs for every answer of every question at a
+    node are computed by restricting the bitsets to the labels at the node
+    (equivalent to a bitwise AND with the bitset for the node) and taking a
+    single matrix product with the stacked statistics.
+
+    The answers are processed in blocks of at most rowsPerBlock, so the
+    temporary (answers x labels at node) matrix used for the product has
+    bounded size however many questions there are.
+
+    N.B. all the label accs should support the arena representation and have
+    the same layout, and the accs returned by createAcc should have this same
+    layout.
+    """
+    def __init__(self, labels, accForLabel, createAcc, questionGroups,
+                 rowsPerBlock = 256):
+        self.createAcc = createAcc
+        self.rowsPerBlock = rowsPerBlock
+
+        assert self.rowsPerBlock >= 1
+
+        self.labelToIndex = dict([ (label, labelIndex)
+                                   for labelIndex, label in enumerate(labels) ])
+        if len(self.labelToIndex) != len(labels):
+            raise RuntimeError('labels should be distinct')
+
+        self.layout = None
+        statsList = []
+        for label in labels:
+            arena = d.getAccArena(accForLabel(label))
+            if arena is None:
+                raise RuntimeError('label accs must support the arena'
+                                   ' representation to use bitsets')
+            if self.layout is None:
+                self.layout = arena.layout
+            elif arena.layout != self.layout:
+                raise RuntimeError('label accs must all have the same layout'
+                                   ' to use bitsets')
+            statsList.append(arena.buffer)
+        self.stats = np.array(statsList)
+
+        self.valueIndices = np.empty((len(labels), len(questionGroups)),
+                                     dtype = np.int64)
+        bitsets = []
+        self.fullQuestionToRow = dict()
+        for qgIndex, (labelValuer, questions) in enumerate(questionGroups):
+            valueToIndex = dict()
+            for labelIndex, label in enumerate(labels):
+                value = labelValuer(label)
+                if value not in valueToIndex:
+                    valueToIndex[value] = len(valueToIndex)
+                self.valueIndices[labelIndex, qgIndex] = valueToIndex[value]
+            values = [None] * len(valueToIndex)
+            for value, valueIndex in valueToIndex.iteritems():
+                values[valueIndex] = value
+
+            for question in questions:
+                answerForValue = np.array([ question(value)
+                                            for value in values ],
+                                          dtype = np.int64)
+                answers = answerForValue[self.valueIndices[:, qgIndex]]
+                self.fullQuestionToRow[(labelValuer, question)] = len(bitsets)
+                for answer in question.codomain():
+                    bitsets.append(answers == answer)
+        self.bitsets = np.array(bitsets, dtype = np.bool_).reshape(
+            (len(bitsets), len(labels))
+        )
+
+    def getLabelIndices(self, labels):
+        return np.array([ self.labelToIndex[label] for label in labels ],
+                        dtype = np.int64)
+
+    def accFromStats(self, stats):
+        acc = self.createAcc()
+        d.AccArena(self.layout, stats).addToAcc(acc)
+        return acc
+
+    def all(self, labels):
+        labelIndices = self.getLabelIndices(labels)
+        return self.accFromStats(np.sum(self.stats[labelIndices], axis = 0))
+
+    def forQuestionGroups(self, labels, questionGroups, minCount = 0.0):
+        """Computes the acc for each labelValuer, question and answer.
+
+        The returned value has the same form as for
+        SecondLevelAccSummer.forQuestionGroups.
+        Each question in questionGroups should have been present when this
+        acc summer was created.
+        """
+        labelIndices = self.getLabelIndices(labels)
+        rows = [ self.fullQuestionToRow[(labelValuer, question)] + answer
+                 for labelValuer, questions in questionGroups
+                 for question in questions
+                 for answer in question.codomain() ]
+        statsForNode = self.stats[labelIndices]
+        statsForRow = np.empty((len(rows), self.stats.shape[1]))
+        for blockStart in range(0, len(rows), self.rowsPerBlock):
+            blockRows = rows[blockStart:(blockStart + self.rowsPerBlock)]
+            bitsetsForBlock = self.bitsets[np.ix_(blockRows, labelIndices)]
+            statsForRow[blockStart:(blockStart + len(blockRows))] = np.dot(
+                bitsetsForBlock.astype(np.float64), statsForNode
+            )
+
+        accsForQuestionGroups = []
+        pos = 0
+        for labelValuer, questions in questionGroups:
+            accsForQuestions = []
+            for question in questions:
+                accForAnswer = [ self.accFromStats(statsForRow[pos + answer])
+                                 for answer in question.codomain() ]
+                pos += len(accForAnswer)
+                if all([ acc.count() >= minCount for acc in accForAnswer ]):
+                    accsForQuestions.append((question, accForAnswer))
+            if accsForQuestions:
+                accsForQuestionGroups.append((labelValuer, accsForQuestions))
+        assert pos == len(rows)
+
+        return accsForQuestionGroups
+
 @codeDeps()
 class ProtoLeaf(object):
     def __init__(self, dist, aux, auxRat, count):
@@ -333,7 +466,8 @@ def constructTree(splitInfoDict):
     leafDists = [ leafProto.dist for leafProto in leafProtos ]
     auxValuedRat = d.sumValuedRats([ (leafProto.aux, leafProto.auxRat)
                                      for leafProto in leafProtos ])
-    decTree = xf.DecisionTree(tree, numLeaves = len(leafProtos))
+    decTree = xf.DecisionTree(tree, numLeaves = len(leafProtos),
+                              compiled = True)
     dist = d.MappedInputDist(MapElem(0, 2, decTree),
         d.DiscreteDist(range(decTree.numLeaves),
             dict(enumerate(leafDists))
@@ -349,6 +483,8 @@ class NodeBasedClusterer(object):
 
     More specifically this class contains methods that use a certain form of
     state which is useful for node-based clustering.
+    If accSummer2 is None then accSummer1 should compute the accs for each
+    question directly (see BitsetAccSummer).
     """
     def __init__(self, accSummer1, accSummer2, minCount, leafEstimator,
                  splitValuer, goodThresh, verbosity):
@@ -360,15 +496,24 @@ class NodeBasedClusterer(object):
         self.goodThresh = goodThresh
         self.verbosity = verbosity
 
+    def getAccsForQuestionGroups(self, labels, questionGroups):
+        if self.accSummer2 is None:
+            return self.accSummer1.forQuestionGroups(
+                labels, questionGroups, minCount = self.minCount
+            )
+        else:
+            qgToValueToAcc = self.accSummer1.getQgToValueToAcc(
+                labels, questionGroups
+            )
+            return self.accSummer2.forQuestionGroups(
+                qgToValueToAcc, questionGroups, minCount = self.minCount
+            )
+
     def computeBestSplitAndStateAdj(self, state):
         labels, questionGroups, answerSeq, protoNoSplit = state
 
-        qgToValueToAcc = self.accSummer1.getQgToValueToAcc(
-            labels, questionGroups
-        )
-        accsForQuestionGroups = self.accSummer2.forQuestionGroups(
-            qgToValueToAcc, questionGroups, minCount = self.minCount
-        )
+        accsForQuestionGroups = self.getAccsForQuestionGroups(labels,
+                                                              questionGroups)
 
         questionGroupsOut = getPrunedQuestionGroups(accsForQuestionGroups)
 
@@ -616,6 +761,7 @@ class ClusteringSpec(object):
                  estimateTotAux = d.getDefaultEstimateTotAuxNoRevert(),
                  catchEstimationErrors = False,
                  goodThresh = 0.1,
+                 useBitsets = False,
                  verbosity = 2):
         self.utilitySpec = utilitySpec
         self.questionGroups = questionGroups
@@ -623,15 +769,40 @@ class ClusteringSpec(object):
         self.estimateTotAux = estimateTotAux
         self.catchEstimationErrors = catchEstimationErrors
         self.goodThresh = goodThresh
+        # (if True then node-based clustering uses BitsetAccSummer)
+        self.useBitsets = useBitsets
         self.verbosity = verbosity
 
-@codeDeps(LeafEstimator, NodeBasedClusterer, NodeBasedFirstLevelAccSummer,
-    SecondLevelAccSummer, constructTree, d.Rat, removeTrivialQuestions, timed
+@codeDeps(BitsetAccSummer, NodeBasedFirstLevelAccSummer, SecondLevelAccSummer,
+    removeTrivialQuestions
+)
+def getNodeBasedAccSummers(clusteringSpec, labels, accForLabel, createAcc):
+    """Returns question groups and acc summers for node-based clustering.
+
+    Trivial questions are removed from the question groups.
+    """
+    questionGroups = removeTrivialQuestions(labels,
+                                            clusteringSpec.questionGroups)
+    if clusteringSpec.useBitsets:
+        accSummer1 = BitsetAccSummer(labels, accForLabel, createAcc,
+                                     questionGroups)
+        accSummer2 = None
+    else:
+        accSummer1 = NodeBasedFirstLevelAccSummer(accForLabel, createAcc)
+        accSummer2 = SecondLevelAccSummer(createAcc)
+    return questionGroups, accSummer1, accSummer2
+
+@codeDeps(LeafEstimator, NodeBasedClusterer, constructTree, d.Rat,
+    getNodeBasedAccSummers, timed
 )
 def decisionTreeCluster(clusteringSpec, labels, accForLabel, createAcc):
     verbosity = clusteringSpec.verbosity
-    accSummer1 = NodeBasedFirstLevelAccSummer(accForLabel, createAcc)
-    accSummer2 = SecondLevelAccSummer(createAcc)
+    getAccSummers = getNodeBasedAccSummers
+    if verbosity >= 3:
+        getAccSummers = timed(getAccSummers)
+    questionGroups, accSummer1, accSummer2 = getAccSummers(
+        clusteringSpec, labels, accForLabel, createAcc
+    )
     minCount = clusteringSpec.minCount
     leafEstimator = LeafEstimator(
         clusteringSpec.estimateTotAux,
@@ -653,8 +824,6 @@ def decisionTreeCluster(clusteringSpec, labels, accForLabel, createAcc):
                ' minCount = %s' %
                (splitValuer.perLeafPenalty, minCount))
 
-    questionGroups = removeTrivialQuestions(labels,
-                                            clusteringSpec.questionGroups)
     splitInfoDict = dict(
         clusterer.subTreeSplitInfoIter((labels, questionGroups, (), protoRoot))
     )
@@ -743,16 +912,17 @@ def getDeltaIter(labelsRoot, accForLabel, distRoot, splitIter,
 
         yield delta
 
-@codeDeps(LeafEstimator, NodeBasedClusterer, NodeBasedFirstLevelAccSummer,
-    SecondLevelAccSummer, getDeltaIter, removeTrivialQuestions
+@codeDeps(LeafEstimator, NodeBasedClusterer, getDeltaIter,
+    getNodeBasedAccSummers
 )
 def decisionTreeClusterInGreedyOrderWithTest(clusteringSpec,
                                              labels, labelsTest,
                                              accForLabel, accForLabelTest,
                                              createAcc):
     verbosity = clusteringSpec.verbosity
-    accSummer1 = NodeBasedFirstLevelAccSummer(accForLabel, createAcc)
-    accSummer2 = SecondLevelAccSummer(createAcc)
+    questionGroups, accSummer1, accSummer2 = getNodeBasedAccSummers(
+        clusteringSpec, labels, accForLabel, createAcc
+    )
     minCount = clusteringSpec.minCount
     leafEstimator = LeafEstimator(
         clusteringSpec.estimateTotAux,
@@ -770,9 +940,6 @@ def decisionTreeClusterInGreedyOrderWithTest(clusteringSpec,
                ' minCount = %s' %
                (splitValuer.perLeafPenalty, minCount))
 
-    questionGroups = removeTrivialQuestions(labels,
-                                            clusteringSpec.questionGroups)
-
     # (have to be a bit careful about iterators getting used up; not ideal)
     splitInfoIter = clusterer.subTreeSplitInfoIterInGreedyOrder(
         (labels, questionGroups, (), protoRoot)
@@ -6,10 +6,11 @@
 # See `License` for details of license and warranty.
 
 from codedep import codeDeps
+from bisque import persist
 
 import armspeech.modelling.dist as d
 
-@codeDeps(d.SynthMethod)
+@codeDeps(d.SynthMethod, persist.secHashObject)
 class Corpus(object):
     def accumulate(self, acc, uttIds = None):
         if uttIds is None:
@@ -40,3 +41,28 @@ class Corpus(object):
     def synth(self, dist, uttId, method = d.SynthMethod.Sample):
         input, actualOutput = self.data(uttId)
         return dist.synth(input, method, actualOutput)
+
+    def synthIterator(self, dist, uttId, method = d.SynthMethod.Sample):
+        """Returns an iterator over synthesized frames for a sequence dist."""
+        input, actualOutput = self.data(uttId)
+        return dist.synthIterator(input, method, actualOutput)
+
+    def synthBatch(self, dist, uttIds, method = d.SynthMethod.Sample, synthCache = None, distHash = None):
+        """Synthesizes the given utterances using a single synthBatch call.
+
+        If synthCache is not None then only utterances whose outputs are not
+        already cached are synthesized (see features.SynthCache). distHash
+        should then be the secHash of dist, and is computed if not given.
+        """
+        inputs = []
+        actualOutputs = []
+        for uttId in uttIds:
+            input, actualOutput = self.data(uttId)
+            inputs.append(input)
+            actualOutputs.append(actualOutput)
+        if synthCache is None:
+            return dist.synthBatch(inputs, method, actualOutputs)
+        else:
+            if distHash is None:
+                distHash = persist.secHashObject(dist)
+            return synthCache.synthBatch(dist, distHash, inputs, method, actualOutputs)
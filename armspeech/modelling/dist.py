@@ -5,26 +5,33 @@
 # This file is part of armspeech.
 # See `License` for details of license and warranty.
 
+import os
 import logging
 import math
 import numpy as np
 import numpy.linalg as la
 from scipy import special
 import random
+import tempfile
 from itertools import izip
-from collections import deque
+from collections import deque, defaultdict
 
+import codedep
 from codedep import codeDeps, ForwardRef
+from bisque import persist
 
 from armspeech.util.mathhelp import logSum, sigmoid, sampleDiscrete, reprArray
-from armspeech.util.memoize import memoize
+from armspeech.util.mathhelp import logSumArray, sigmoidArray
+from armspeech.util.mathhelp import packSymmetric, unpackSymmetric, outerPacked
 from armspeech.util.mathhelp import assert_allclose
 from armspeech.util.util import orderedDictRepr
 import armspeech.util.mylinalg as mla
-from armspeech.util.iterhelp import contextualizeIter
+from armspeech.util.iterhelp import contextualizeIter, contextualizeArray
+from armspeech.util.iterhelp import PackedFrames
 from armspeech.modelling import nodetree
 from armspeech.modelling import semiring
 from armspeech.modelling import wnet
+from armspeech.modelling.lattice import Lattice, writeLattice, readLattice
 import armspeech.numpy_settings
 
 # (FIXME : add more checks to validate Dists and Accs on creation (including
@@ -44,6 +51,7 @@ def eval_local(reprString):
     )
     from armspeech.modelling.wnet import ConcreteNet
     from armspeech.util.mathhelp import AsArray
+    from armspeech.util.memoize import LruCache
     from armspeech.util.util import MapElem
 
     return eval(reprString)
@@ -167,6 +175,64 @@ def getVerboseNetCreateAcc():
     return nodetree.getDagMap([verboseNetCreateAccPartial,
                                defaultCreateAccPartial])
 
+@codeDeps(ForwardRef(lambda: AutoregressiveNetDist), defaultCreateAccPartial,
+    nodetree.getDagMap
+)
+def getLatticeNetCreateAcc(latticeDir, replayLattices = False):
+    """Returns a createAcc function which writes or replays net lattices.
+
+    Any AutoregressiveNetDist accs created write their edge posteriors to
+    latticeDir, or if replayLattices is True accumulate using the lattices
+    previously written there (see AutoregressiveNetAcc).
+    """
+    def latticeNetCreateAccPartial(dist, createAccChild):
+        if isinstance(dist, AutoregressiveNetDist):
+            return dist.createAcc(createAccChild, latticeDir = latticeDir,
+                                  replayLattices = replayLattices)
+    return nodetree.getDagMap([latticeNetCreateAccPartial,
+                               defaultCreateAccPartial])
+
+@codeDeps(ForwardRef(lambda: AutoregressiveNetDist), defaultCreateAccPartial,
+    nodetree.getDagMap
+)
+def getNetCacheCreateAcc(netCache):
+    """Returns a createAcc function which caches concretized nets.
+
+    Any AutoregressiveNetDist accs created look up the concretized net for
+    each input in netCache (see AutoregressiveNetDist.getConcreteNet).
+    """
+    def netCacheCreateAccPartial(dist, createAccChild):
+        if isinstance(dist, AutoregressiveNetDist):
+            return dist.createAcc(createAccChild, netCache = netCache)
+    return nodetree.getDagMap([netCacheCreateAccPartial,
+                               defaultCreateAccPartial])
+
+@codeDeps(ForwardRef(lambda: BinaryLogisticClassifier),
+    ForwardRef(lambda: BinaryLogisticClassifierAcc),
+    ForwardRef(lambda: LinearGaussian), ForwardRef(lambda: LinearGaussianAcc),
+    ForwardRef(lambda: LinearGaussianVec),
+    ForwardRef(lambda: LinearGaussianVecAcc)
+)
+def packedCreateAccPartial(dist, createAccChild):
+    if isinstance(dist, LinearGaussian):
+        return LinearGaussianAcc(distPrev = dist, packed = True,
+                                 tag = dist.tag)
+    elif isinstance(dist, LinearGaussianVec):
+        return LinearGaussianVecAcc(distPrev = dist, packed = True,
+                                    tag = dist.tag)
+    elif isinstance(dist, BinaryLogisticClassifier):
+        return BinaryLogisticClassifierAcc(dist, packed = True, tag = dist.tag)
+
+@codeDeps(defaultCreateAccPartial, nodetree.getDagMap, packedCreateAccPartial)
+def getPackedCreateAcc():
+    """Returns a createAcc function which stores sumOuter statistics packed.
+
+    This roughly halves the memory used by LinearGaussianAcc,
+    LinearGaussianVecAcc and BinaryLogisticClassifierAcc accumulators.
+    """
+    return nodetree.getDagMap([packedCreateAccPartial,
+                               defaultCreateAccPartial])
+
 @codeDeps(nodetree.getDagMap)
 def getParams(partialMaps):
     return nodetree.getDagMap(
@@ -310,6 +376,109 @@ def addAcc(accTo, accFrom):
             nodeTo.addAccSingle(nodeFrom)
             agenda.extend(reversed(nodeTo.addAccChildPairs(nodeFrom)))
 
+@codeDeps(ForwardRef(lambda: getAccLayout), nodetree.nodeList)
+class AccArena(object):
+    """The numeric statistics of an accumulator DAG in one flat buffer.
+
+    layout describes each node of the DAG in nodeList order as a tuple
+    (className, statNames, statShapes), and buffer is a contiguous float64
+    array containing the values of all these statistics in the same order.
+    Two arenas with equal layouts can be added with a single vector addition.
+    An arena is only a snapshot of the statistics; use addToAcc to add it back
+    into an accumulator DAG.
+    """
+    def __init__(self, layout, buffer):
+        self.layout = layout
+        self.buffer = buffer
+
+    def addArena(self, arena):
+        if arena.layout != self.layout:
+            raise RuntimeError('can only add arenas with identical layouts')
+        self.buffer += arena.buffer
+
+    def addToAcc(self, acc):
+        """Adds these statistics to the statistics of accumulator DAG acc.
+
+        N.B. acc should have the same structure as the DAG this arena was
+        created from.
+        Only the layouts are compared, so that for example the structural
+        checks present in some addAccSingle methods are not performed.
+        """
+        nodes = nodetree.nodeList(acc)
+        if getAccLayout(nodes) != self.layout:
+            raise RuntimeError('acc does not match arena layout')
+        pos = 0
+        for node, (_, statNames, statShapes) in izip(nodes, self.layout):
+            for statName, statShape in izip(statNames, statShapes):
+                size = int(np.prod(statShape))
+                value = np.reshape(self.buffer[pos:(pos + size)], statShape)
+                if statShape == ():
+                    setattr(node, statName,
+                            getattr(node, statName) + float(value))
+                else:
+                    getattr(node, statName)[...] += value
+                pos += size
+        assert pos == len(self.buffer)
+
+@codeDeps(ForwardRef(lambda: AccCommon))
+def getAccLayout(nodes):
+    """Returns the arena layout for the given list of DAG nodes.
+
+    Returns None if some node does not support the arena layout, for example
+    because its shape is data-dependent as for AutoGrowingDiscreteAcc.
+    """
+    layout = []
+    for node in nodes:
+        statNames = (node.statNames() if isinstance(node, AccCommon)
+                     else None)
+        if statNames is None:
+            return None
+        statShapes = tuple([ np.shape(getattr(node, statName))
+                             for statName in statNames ])
+        layout.append((node.__class__.__name__, tuple(statNames), statShapes))
+    return tuple(layout)
+
+@codeDeps(AccArena, getAccLayout, nodetree.nodeList)
+def getAccArena(acc):
+    """Returns the statistics of accumulator DAG acc as an AccArena.
+
+    Returns None if some node of the DAG does not support the arena layout.
+    """
+    nodes = nodetree.nodeList(acc)
+    layout = getAccLayout(nodes)
+    if layout is None:
+        return None
+    buffer = np.empty((sum([ int(np.prod(statShape))
+                             for _, _, statShapes in layout
+                             for statShape in statShapes ]),))
+    pos = 0
+    for node, (_, statNames, statShapes) in izip(nodes, layout):
+        for statName, statShape in izip(statNames, statShapes):
+            size = int(np.prod(statShape))
+            buffer[pos:(pos + size)] = np.ravel(getattr(node, statName))
+            pos += size
+    return AccArena(layout, buffer)
+
+@codeDeps(AccArena, addAcc)
+def addAccs(accTo, accsFrom):
+    """Adds several accumulator sub-DAGs to accumulator sub-DAG accTo.
+
+    Each element of accsFrom may be an accumulator or an AccArena.
+    The arenas are summed with one vector addition each and added to accTo in
+    a single pass, while accumulators are added using addAcc.
+    """
+    arenaTot = None
+    for accFrom in accsFrom:
+        if isinstance(accFrom, AccArena):
+            if arenaTot is None:
+                arenaTot = AccArena(accFrom.layout, np.copy(accFrom.buffer))
+            else:
+                arenaTot.addArena(accFrom)
+        else:
+            addAcc(accTo, accFrom)
+    if arenaTot is not None:
+        arenaTot.addToAcc(accTo)
+
 @codeDeps()
 def parseConcat(dists, params, parseChild):
     distNews = []
@@ -324,49 +493,259 @@ class PruneSpec(object):
     pass
 @codeDeps(PruneSpec)
 class SimplePruneSpec(PruneSpec):
-    def __init__(self, betaThresh, logOccThresh):
+    def __init__(self, betaThresh, logOccThresh, beamSize = None):
         self.betaThresh = betaThresh
         self.logOccThresh = logOccThresh
+        # (maximum number of nodes kept at each time during forward-backward)
+        self.beamSize = beamSize
     def __repr__(self):
-        return 'SimplePruneSpec(%r, %r)' % (self.betaThresh, self.logOccThresh)
+        return 'SimplePruneSpec(%r, %r, beamSize=%r)' % (self.betaThresh,
+                                                          self.logOccThresh,
+                                                          self.beamSize)
+
+@codeDeps()
+class MemoStore(object):
+    """A growable store of frames used by Memo.
+
+    Frames which convert to numeric arrays of a fixed shape are stored in a
+    single preallocated array, optionally backed by a memory-mapped file
+    created in spillDir.
+    If columnar is True then tuple frames which are not numeric (e.g.
+    structured inputs such as ((questionAnswers, subLabel), acInput)) are
+    stored column-wise, with one (non-columnar) MemoStore per tuple element,
+    so that any numeric elements are still stored in arrays.
+    Anything else falls back to a list.
+    """
+    def __init__(self, capacity = None, spillDir = None, columnar = True):
+        self.capacity = capacity
+        self.spillDir = spillDir
+        self.columnar = columnar
+
+        self.size = 0
+        self.array = None
+        self.columns = None
+        self.items = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if self.array is not None:
+            state['array'] = np.array(self.array[:self.size])
+        return state
+
+    def allocate(self, length, shape, dtype):
+        length = max(length, 1)
+        if self.spillDir is None:
+            return np.empty((length,) + shape, dtype = dtype)
+        else:
+            fd, path = tempfile.mkstemp(suffix = '.memo', dir = self.spillDir)
+            os.close(fd)
+            try:
+                return np.memmap(path, dtype = dtype, mode = 'w+',
+                                 shape = (length,) + shape)
+            finally:
+                # (the mapping remains valid after the file is unlinked)
+                os.unlink(path)
+
+    def asFrame(self, x):
+        """Returns x as an array storable in self.array, or None."""
+        try:
+            a = np.asarray(x)
+        except ValueError:
+            return None
+        if a.dtype.kind not in 'biuf':
+            return None
+        if self.array is not None and (
+            a.shape != self.array.shape[1:] or
+            not np.can_cast(a.dtype, self.array.dtype)
+        ):
+            return None
+        return a
+
+    def isColumnFrame(self, x):
+        """Returns True if x can be stored in self.columns."""
+        return (isinstance(x, tuple) and
+                len(x) == len(self.columns))
+
+    def fallBack(self):
+        self.items = list(self.values())
+        self.array = None
+        self.columns = None
+
+    def values(self):
+        if self.items is not None:
+            return self.items
+        elif self.array is not None:
+            return self.array[:self.size]
+        elif self.columns is not None:
+            return zip(*[ column.values() for column in self.columns ])
+        else:
+            return []
+
+    def append(self, x):
+        if self.items is None and self.columns is None:
+            a = self.asFrame(x)
+            if a is None:
+                if (self.size == 0 and self.columnar and
+                        isinstance(x, tuple) and x):
+                    self.columns = [
+                        MemoStore(self.capacity, self.spillDir,
+                                  columnar = False)
+                        for elem in x
+                    ]
+                else:
+                    self.fallBack()
+            else:
+                if self.array is None:
+                    length = 16 if self.capacity is None else self.capacity
+                    self.array = self.allocate(length, a.shape, a.dtype)
+                elif self.size == len(self.array):
+                    arrayNew = self.allocate(2 * self.size,
+                                             self.array.shape[1:],
+                                             self.array.dtype)
+                    arrayNew[:self.size] = self.array[:self.size]
+                    self.array = arrayNew
+                self.array[self.size] = a
+        if self.columns is not None:
+            if self.isColumnFrame(x):
+                for column, elem in zip(self.columns, x):
+                    column.append(elem)
+            else:
+                self.fallBack()
+        if self.items is not None:
+            self.items.append(x)
+        self.size += 1
+
+    def __setitem__(self, index, x):
+        assert 0 <= index < self.size
+        if self.items is None and self.columns is None:
+            a = self.asFrame(x)
+            if a is None:
+                self.fallBack()
+            else:
+                self.array[index] = a
+        if self.columns is not None:
+            if self.isColumnFrame(x):
+                for column, elem in zip(self.columns, x):
+                    column[index] = elem
+            else:
+                self.fallBack()
+        if self.items is not None:
+            self.items[index] = x
+
+    def extend(self, store, indices):
+        """Appends the frames of store at the given indices."""
+        if (self.items is None and store.items is None and
+                store.array is not None and
+                (self.array is None and self.columns is None or
+                 self.array is not None and
+                 self.asFrame(store.array[:1][0]) is not None)):
+            if self.array is None:
+                self.append(store.array[indices[0]])
+                indices = indices[1:]
+            sizeNew = self.size + len(indices)
+            if sizeNew > len(self.array):
+                arrayNew = self.allocate(max(sizeNew, 2 * self.size),
+                                         self.array.shape[1:],
+                                         self.array.dtype)
+                arrayNew[:self.size] = self.array[:self.size]
+                self.array = arrayNew
+            self.array[self.size:sizeNew] = store.array[np.asarray(indices,
+                                                                   dtype = int)]
+            self.size = sizeNew
+        elif (self.items is None and store.columns is not None and
+                (self.size == 0 and self.array is None and self.columnar or
+                 self.columns is not None and
+                 len(self.columns) == len(store.columns))):
+            if self.columns is None:
+                self.columns = [
+                    MemoStore(self.capacity, self.spillDir, columnar = False)
+                    for column in store.columns
+                ]
+            for column, storeColumn in zip(self.columns, store.columns):
+                column.extend(storeColumn, indices)
+            self.size += len(indices)
+        else:
+            storeValues = store.values()
+            for index in indices:
+                self.append(storeValues[index])
 
-@codeDeps(assert_allclose)
+@codeDeps(MemoStore, assert_allclose)
 class Memo(object):
-    def __init__(self, maxOcc):
+    """Remembers a uniformly random subset of at most maxOcc frames.
+
+    Frames are kept in array-backed MemoStores, so memory use is linear in the
+    raw frame data when frames are numeric.
+    If spillDir is specified the arrays are memory-mapped from files created
+    there rather than kept in RAM.
+    """
+    def __init__(self, maxOcc, spillDir = None):
         self.maxOcc = maxOcc
+        self.spillDir = spillDir
 
         self.occ = 0.0
         self.fakeOcc = 0.0
-        self.inputs = []
-        self.outputs = []
+        self.inputStore = MemoStore(maxOcc, spillDir)
+        self.outputStore = MemoStore(maxOcc, spillDir)
+
+    @property
+    def inputs(self):
+        return self.inputStore.values()
+
+    @property
+    def outputs(self):
+        return self.outputStore.values()
 
     def add(self, input, output, occ = 1.0):
         if occ != 1.0:
             raise RuntimeError('Memo occupancies must be 1.0')
         self.occ += occ
-        if self.maxOcc is None or len(self.inputs) < self.maxOcc:
+        if self.maxOcc is None or self.outputStore.size < self.maxOcc:
             self.fakeOcc += occ
-            self.inputs.append(input)
-            self.outputs.append(output)
+            self.inputStore.append(input)
+            self.outputStore.append(output)
         elif random.random() * self.occ < self.fakeOcc:
             # (FIXME : behind the scenes, only do subset selection every
             #   certain number of inputs (for efficiency)?)
-            assert len(self.inputs) == self.maxOcc
+            assert self.outputStore.size == self.maxOcc
             delIndex = random.randrange(self.maxOcc)
-            self.inputs[delIndex] = input
-            self.outputs[delIndex] = output
-        assert_allclose(self.fakeOcc, len(self.inputs))
+            self.inputStore[delIndex] = input
+            self.outputStore[delIndex] = output
+        assert_allclose(self.fakeOcc, self.outputStore.size)
 
-    # FIXME : do random subset selection for addAcc too
     def addAccSingle(self, acc):
+        """Merges the subset remembered by acc into this memo.
+
+        The merged subset is a uniformly random subset of the union of the
+        frames seen by the two memos, as if all the frames had been added to
+        a single memo.
+        """
+        occSelf = int(round(self.occ))
+        occOther = int(round(acc.occ))
+        sizeSelf = self.outputStore.size
+        sizeOther = acc.outputStore.size
+        if self.maxOcc is None:
+            indicesSelf = range(sizeSelf)
+            indicesOther = range(sizeOther)
+        else:
+            # number drawn from each side is hypergeometrically distributed
+            sizeNew = min(self.maxOcc, occSelf + occOther)
+            numSelf = sum([
+                1 for pos in random.sample(xrange(occSelf + occOther), sizeNew)
+                if pos < occSelf
+            ])
+            indicesSelf = sorted(random.sample(xrange(sizeSelf), numSelf))
+            indicesOther = sorted(random.sample(xrange(sizeOther),
+                                                sizeNew - numSelf))
+
+        for storeName in ['inputStore', 'outputStore']:
+            storeNew = MemoStore(self.maxOcc, self.spillDir)
+            if indicesSelf:
+                storeNew.extend(getattr(self, storeName), indicesSelf)
+            if indicesOther:
+                storeNew.extend(getattr(acc, storeName), indicesOther)
+            setattr(self, storeName, storeNew)
         self.occ += acc.occ
-        self.fakeOcc += acc.fakeOcc
-        self.inputs += acc.inputs
-        self.outputs += acc.outputs
-        if self.maxOcc is not None and self.fakeOcc > self.maxOcc:
-            self.fakeOcc = self.maxOcc
-            self.inputs = self.inputs[:self.maxOcc]
-            self.outputs = self.outputs[:self.maxOcc]
+        self.fakeOcc = float(self.outputStore.size)
 
 @codeDeps()
 class EstimationError(Exception):
@@ -398,6 +777,25 @@ class AccCommon(object):
     #    abstract
     def add(self, input, output, occ = 1.0):
         abstract
+    def addBatch(self, inputs, outputs, occs = None):
+        """Adds a block of frames.
+
+        Equivalent to calling add for each (input, output, occ) triple in turn.
+        If occs is None then every occupancy is taken to be 1.0.
+        Subclasses may override this to process the whole block at once.
+        """
+        if occs is None:
+            occs = [1.0] * len(outputs)
+        for input, output, occ in izip(inputs, outputs, occs):
+            self.add(input, output, occ)
+    def statNames(self):
+        """Returns the names of the numeric statistics of this node.
+
+        These should be exactly the float or float array attributes which
+        addAccSingle sums, so that the node can be stored in an AccArena.
+        Returns None if addAccSingle does anything more complicated.
+        """
+        return None
     # (FIXME : for all of the Accs defined below, add more checks that acc is
     #   of the right type during addAccSingle?)
     def addAccSingle(self, acc):
@@ -495,6 +893,9 @@ class DerivTermAccG(AccG):
         self.derivParams += self.distPrev.logProbDerivParams(input,
                                                              output) * occ
 
+    def statNames(self):
+        return ['occ', 'logLikePrev', 'derivParams']
+
     # N.B. assumes distPrev is the same for self and acc (not checked).
     def addAccSingle(self, acc):
         self.occ += acc.occ
@@ -521,6 +922,9 @@ class FixedValueAcc(TermAcc):
                                ' FixedValueAcc' % (output, self.value))
         self.occ += occ
 
+    def statNames(self):
+        return ['occ']
+
     def addAccSingle(self, acc):
         assert self.value == acc.value
         self.occ += acc.occ
@@ -544,6 +948,9 @@ class OracleAcc(TermAcc):
     def add(self, input, output, occ = 1.0):
         self.occ += occ
 
+    def statNames(self):
+        return ['occ']
+
     def addAccSingle(self, acc):
         self.occ += acc.occ
 
@@ -557,11 +964,17 @@ class OracleAcc(TermAcc):
         return OracleDist(tag = self.tag), (0.0, Rat.Exact)
 
 @codeDeps(EstimationError, ForwardRef(lambda: LinearGaussian), Rat, TermAcc,
-    mla.solve
+    mla.solve, outerPacked, packSymmetric, unpackSymmetric
 )
 class LinearGaussianAcc(TermAcc):
+    """Accumulator for LinearGaussian.
+
+    If packed is True then only the upper triangle of the symmetric sumOuter
+    statistic is stored and accumulated, and the full matrix is only
+    constructed when needed for estimation.
+    """
     def __init__(self, distPrev = None, inputLength = None,
-                 varianceFloor = None, tag = None):
+                 varianceFloor = None, packed = False, tag = None):
         self.distPrev = distPrev
         if distPrev is not None:
             inputLength = len(distPrev.coeff)
@@ -573,6 +986,7 @@ class LinearGaussianAcc(TermAcc):
                 self.varianceFloor = distPrev.varianceFloor
             else:
                 self.varianceFloor = 0.0
+        self.packed = packed
         self.tag = tag
 
         self.occ = 0.0
@@ -583,11 +997,58 @@ class LinearGaussianAcc(TermAcc):
         assert self.varianceFloor is not None
         assert self.varianceFloor >= 0.0
 
+    @property
+    def sumOuter(self):
+        if self.packed:
+            return unpackSymmetric(self.sumOuterStored)
+        else:
+            return self.sumOuterStored
+
+    @sumOuter.setter
+    def sumOuter(self, sumOuter):
+        if self.packed:
+            self.sumOuterStored = packSymmetric(sumOuter)
+        else:
+            self.sumOuterStored = sumOuter
+
     def add(self, input, output, occ = 1.0):
         self.occ += occ
         self.sumSqr += (output ** 2) * occ
         self.sumTarget += input * output * occ
-        self.sumOuter += np.outer(input, input) * occ
+        if self.packed:
+            self.sumOuterStored += outerPacked(np.asarray(input)) * occ
+        else:
+            self.sumOuterStored += np.outer(input, input) * occ
+
+    def addBatch(self, inputs, outputs, occs = None):
+        """Adds a block of frames using a single weighted matrix product.
+
+        inputs should be a sequence of T input vectors (or a (T, inputLength)
+        array) and outputs and occs sequences of length T.
+        The resulting statistics agree with those computed by calling add for
+        each frame in turn up to floating point rounding.
+        """
+        numFrames = len(outputs)
+        inputLength = len(self.sumTarget)
+        inputs = np.reshape(np.asarray(inputs, dtype = np.float64),
+                            (numFrames, inputLength))
+        outputs = np.asarray(outputs, dtype = np.float64)
+        if occs is None:
+            occs = np.ones((numFrames,))
+        else:
+            occs = np.asarray(occs, dtype = np.float64)
+        weightedInputs = inputs * occs[:, np.newaxis]
+        self.occ += float(np.sum(occs))
+        self.sumSqr += np.dot(outputs ** 2, occs)
+        self.sumTarget += np.dot(outputs, weightedInputs)
+        sumOuterBatch = np.dot(weightedInputs.T, inputs)
+        if self.packed:
+            self.sumOuterStored += packSymmetric(sumOuterBatch)
+        else:
+            self.sumOuterStored += sumOuterBatch
+
+    def statNames(self):
+        return ['occ', 'sumSqr', 'sumTarget', 'sumOuterStored']
 
     # N.B. assumes distPrev (if present) is the same for self and acc (not
     #   checked).
@@ -595,7 +1056,10 @@ class LinearGaussianAcc(TermAcc):
         self.occ += acc.occ
         self.sumSqr += acc.sumSqr
         self.sumTarget += acc.sumTarget
-        self.sumOuter += acc.sumOuter
+        if self.packed and acc.packed:
+            self.sumOuterStored += acc.sumOuterStored
+        else:
+            self.sumOuter = self.sumOuter + acc.sumOuter
 
     def auxFn(self, coeff, variance):
         term = (self.sumSqr - 2.0 * np.dot(self.sumTarget, coeff) +
@@ -608,9 +1072,10 @@ class LinearGaussianAcc(TermAcc):
         return self.auxFn(self.distPrev.coeff, self.distPrev.variance)[0]
 
     def auxDerivParams(self, coeff, variance):
+        sumOuterCoeff = np.dot(self.sumOuter, coeff)
         term = (self.sumSqr - 2.0 * np.dot(self.sumTarget, coeff) +
-                np.dot(np.dot(self.sumOuter, coeff), coeff))
-        derivCoeff = (self.sumTarget - np.dot(self.sumOuter, coeff)) / variance
+                np.dot(sumOuterCoeff, coeff))
+        derivCoeff = (self.sumTarget - sumOuterCoeff) / variance
         derivLogPrecision = 0.5 * self.occ - 0.5 * term / variance
         return np.append(derivCoeff, derivLogPrecision), Rat.Exact
 
@@ -621,11 +1086,12 @@ class LinearGaussianAcc(TermAcc):
     def estimateSingleAux(self):
         if self.occ == 0.0:
             raise EstimationError('require occ > 0')
+        sumOuter = self.sumOuter
         try:
-            coeff = mla.solve(self.sumOuter, self.sumTarget)
+            coeff = mla.solve(sumOuter, self.sumTarget)
         except la.LinAlgError:
             try:
-                coeff = la.lstsq(self.sumOuter, self.sumTarget)[0]
+                coeff = la.lstsq(sumOuter, self.sumTarget)[0]
             except la.LinAlgError, detail:
                 raise EstimationError('could not solve: %s' % detail)
         variance = (self.sumSqr - np.dot(coeff, self.sumTarget)) / self.occ
@@ -646,11 +1112,17 @@ class LinearGaussianAcc(TermAcc):
         return distNew, self.auxFn(coeff, variance)
 
 @codeDeps(EstimationError, ForwardRef(lambda: LinearGaussianVec), Rat, TermAcc,
-    mla.solve
+    mla.solve, outerPacked, packSymmetric, unpackSymmetric
 )
 class LinearGaussianVecAcc(TermAcc):
-    def __init__(self, distPrev, tag = None):
+    """Accumulator for LinearGaussianVec.
+
+    If packed is True then only the upper triangle of each symmetric
+    sumOuter matrix is stored, as for LinearGaussianAcc.
+    """
+    def __init__(self, distPrev, packed = False, tag = None):
         self.distPrev = distPrev
+        self.packed = packed
         self.tag = tag
 
         self.varianceFloorVec = self.distPrev.varianceFloorVec
@@ -662,132 +1134,176 @@ class LinearGaussianVecAcc(TermAcc):
         assert self.varianceFloorVec is not None
         assert np.all(self.varianceFloorVec >= 0.0)
 
+    @property
+    def sumOuter(self):
+        if self.packed:
+            return unpackSymmetric(self.sumOuterStored)
+        else:
+            return self.sumOuterStored
+
+    @sumOuter.setter
+    def sumOuter(self, sumOuter):
+        if self.packed:
+            self.sumOuterStored = packSymmetric(sumOuter)
+        else:
+            self.sumOuterStored = sumOuter
+
     def add(self, input, output, occ = 1.0):
         self.occ += occ
         inputOutput = np.concatenate((input, np.reshape(output, (1, -1))),
                                      axis = 0)
-        self.sumOuter += np.einsum(
-            inputOutput, [1, 0],
-            inputOutput, [2, 0],
-            [0, 1, 2]
-        ) * occ
+        if self.packed:
+            self.sumOuterStored += outerPacked(inputOutput).T * occ
+        else:
+            self.sumOuterStored += np.einsum(
+                inputOutput, [1, 0],
+                inputOutput, [2, 0],
+                [0, 1, 2]
+            ) * occ
+
+    def addBatch(self, inputs, outputs, occs = None):
+        """Adds a block of frames using one stacked matrix product.
+
+        inputs should be a sequence of T (inputLength, order) inputs and
+        outputs a sequence of T (order,) outputs.
+        """
+        order, inputLength = np.shape(self.distPrev.coeffVec)
+        numFrames = len(outputs)
+        inputs = np.reshape(np.asarray(inputs, dtype = np.float64),
+                            (numFrames, inputLength, order))
+        outputs = np.reshape(np.asarray(outputs, dtype = np.float64),
+                             (numFrames, 1, order))
+        if occs is None:
+            occs = np.ones((numFrames,))
+        else:
+            occs = np.asarray(occs, dtype = np.float64)
+        # (order, numFrames, inputLength + 1)
+        inputOutputs = np.transpose(
+            np.concatenate((inputs, outputs), axis = 1), (2, 0, 1)
+        )
+        weighted = inputOutputs * occs[np.newaxis, :, np.newaxis]
+        self.occ += float(np.sum(occs))
+        sumOuterBatch = np.einsum(weighted, [0, 3, 1],
+                                  inputOutputs, [0, 3, 2],
+                                  [0, 1, 2])
+        if self.packed:
+            self.sumOuterStored += packSymmetric(sumOuterBatch)
+        else:
+            self.sumOuterStored += sumOuterBatch
+
+    def statNames(self):
+        return ['occ', 'sumOuterStored']
 
     # N.B. assumes distPrev (if present) is the same for self and acc (not
     #   checked).
     def addAccSingle(self, acc):
         self.occ += acc.occ
-        self.sumOuter += acc.sumOuter
+        if self.packed and acc.packed:
+            self.sumOuterStored += acc.sumOuterStored
+        else:
+            self.sumOuter = self.sumOuter + acc.sumOuter
 
-    def auxFn(self, coeffVec, varianceVec):
-        # (FIXME : could make this a bit nicer?)
+    def getStats(self):
+        """Returns the sufficient statistics stored in sumOuter.
 
+        Returns (sumSqrVec, sumTargetVec, sumOuterInputVec) with shapes
+        (order,), (order, inputLength) and (order, inputLength, inputLength).
+        """
         order, inputLength = np.shape(self.distPrev.coeffVec)
         sumSqrVec = self.sumOuter[:, inputLength, inputLength]
         sumTargetVec = self.sumOuter[:, inputLength, :inputLength]
         sumOuterInputVec = self.sumOuter[:, :inputLength, :inputLength]
+        return sumSqrVec, sumTargetVec, sumOuterInputVec
 
-        auxes = []
-        for vecIndex in range(order):
-            sumSqr = sumSqrVec[vecIndex]
-            sumTarget = sumTargetVec[vecIndex]
-            sumOuterInput = sumOuterInputVec[vecIndex]
-            coeff = coeffVec[vecIndex]
-            variance = varianceVec[vecIndex]
-
-            term = (sumSqr - 2.0 * np.dot(sumTarget, coeff) +
-                    np.dot(np.dot(sumOuterInput, coeff), coeff))
-            aux = (-0.5 * math.log(2.0 * math.pi) * self.occ +
-                   -0.5 * math.log(variance) * self.occ +
-                   -0.5 * term / variance)
-            auxes.append(aux)
+    def termVec(self, coeffVec):
+        sumSqrVec, sumTargetVec, sumOuterInputVec = self.getStats()
+        sumOuterCoeffVec = np.einsum(sumOuterInputVec, [0, 1, 2],
+                                     coeffVec, [0, 2],
+                                     [0, 1])
+        termVec = (sumSqrVec - 2.0 * np.sum(sumTargetVec * coeffVec, axis = 1) +
+                   np.sum(sumOuterCoeffVec * coeffVec, axis = 1))
+        return termVec, sumOuterCoeffVec
 
+    def auxFn(self, coeffVec, varianceVec):
+        termVec, _ = self.termVec(coeffVec)
+        auxes = (-0.5 * math.log(2.0 * math.pi) * self.occ +
+                 -0.5 * np.log(varianceVec) * self.occ +
+                 -0.5 * termVec / varianceVec)
         return np.sum(auxes), Rat.Exact
 
     def logLikeSingle(self):
         return self.auxFn(self.distPrev.coeffVec, self.distPrev.varianceVec)[0]
 
     def auxDerivParams(self, coeffVec, varianceVec):
-        # (FIXME : could make this a bit nicer?)
-
-        order, inputLength = np.shape(self.distPrev.coeffVec)
-        sumSqrVec = self.sumOuter[:, inputLength, inputLength]
-        sumTargetVec = self.sumOuter[:, inputLength, :inputLength]
-        sumOuterInputVec = self.sumOuter[:, :inputLength, :inputLength]
-
-        derivCoeffVec = []
-        derivLogPrecisionVec = []
-        for vecIndex in range(order):
-            sumSqr = sumSqrVec[vecIndex]
-            sumTarget = sumTargetVec[vecIndex]
-            sumOuterInput = sumOuterInputVec[vecIndex]
-            coeff = coeffVec[vecIndex]
-            variance = varianceVec[vecIndex]
-
-            term = (sumSqr - 2.0 * np.dot(sumTarget, coeff) +
-                    np.dot(np.dot(sumOuterInput, coeff), coeff))
-            derivCoeff = (sumTarget - np.dot(sumOuterInput, coeff)) / variance
-            derivLogPrecision = 0.5 * self.occ - 0.5 * term / variance
-            derivCoeffVec.append(derivCoeff)
-            derivLogPrecisionVec.append(derivLogPrecision)
-
+        _, sumTargetVec, _ = self.getStats()
+        termVec, sumOuterCoeffVec = self.termVec(coeffVec)
+        derivCoeffVec = ((sumTargetVec - sumOuterCoeffVec) /
+                         np.reshape(varianceVec, (-1, 1)))
+        derivLogPrecisionVec = 0.5 * self.occ - 0.5 * termVec / varianceVec
         return np.append(derivCoeffVec, derivLogPrecisionVec), Rat.Exact
 
     def derivParamsSingle(self):
         return self.auxDerivParams(self.distPrev.coeffVec,
                                    self.distPrev.varianceVec)[0]
 
-    def estimateSingleAux(self):
-        if self.occ == 0.0:
-            raise EstimationError('require occ > 0')
-
-        # (FIXME : this is not quite equivalent to an array of LinearGaussian
-        #   objects in the case that EstimationError errors are thrown and
-        #   caught. Not sure this is a problem, though.)
-
-        # (FIXME : could make this a bit nicer?)
+    def solveCoeffVec(self):
+        """Solves for the coefficients of all dimensions at once.
 
+        If the stacked solve fails (for example because the statistics for
+        some dimension are singular) then falls back to solving each dimension
+        separately, using least squares where necessary.
+        (N.B. solving a stack of systems with a single call to la.solve
+        requires numpy >= 1.8.)
+        """
         order, inputLength = np.shape(self.distPrev.coeffVec)
-        sumSqrVec = self.sumOuter[:, inputLength, inputLength]
-        sumTargetVec = self.sumOuter[:, inputLength, :inputLength]
-        sumOuterInputVec = self.sumOuter[:, :inputLength, :inputLength]
+        _, sumTargetVec, sumOuterInputVec = self.getStats()
+        if order == 0 or inputLength == 0:
+            return np.zeros((order, inputLength))
+        try:
+            return la.solve(sumOuterInputVec, sumTargetVec)
+        except la.LinAlgError:
+            pass
 
-        coeffVec = []
-        varianceVec = []
+        coeffVec = np.empty((order, inputLength))
         for vecIndex in range(order):
-            sumSqr = sumSqrVec[vecIndex]
             sumTarget = sumTargetVec[vecIndex]
             sumOuterInput = sumOuterInputVec[vecIndex]
-            varianceFloor = self.varianceFloorVec[vecIndex]
-
             try:
-                coeff = mla.solve(sumOuterInput, sumTarget)
+                coeffVec[vecIndex] = mla.solve(sumOuterInput, sumTarget)
             except la.LinAlgError:
                 try:
-                    coeff = la.lstsq(sumOuterInput, sumTarget)[0]
+                    coeffVec[vecIndex] = la.lstsq(sumOuterInput, sumTarget)[0]
                 except la.LinAlgError, detail:
                     raise EstimationError('could not solve: %s' % detail)
-            variance = (sumSqr - np.dot(coeff, sumTarget)) / self.occ
+        return coeffVec
+
+    def estimateSingleAux(self):
+        if self.occ == 0.0:
+            raise EstimationError('require occ > 0')
+
+        # (FIXME : this is not quite equivalent to an array of LinearGaussian
+        #   objects in the case that EstimationError errors are thrown and
+        #   caught. Not sure this is a problem, though.)
 
-            if variance < varianceFloor:
-                variance = varianceFloor
+        sumSqrVec, sumTargetVec, _ = self.getStats()
+        coeffVec = self.solveCoeffVec()
+        varianceVec = (
+            (sumSqrVec - np.sum(coeffVec * sumTargetVec, axis = 1)) / self.occ
+        )
+        varianceVec = np.maximum(varianceVec, self.varianceFloorVec)
 
+        # (report the first offending dimension, as for a LinearGaussian)
+        badIndices = np.nonzero(varianceVec < 1e-10)[0]
+        if len(badIndices) > 0:
+            variance = varianceVec[badIndices[0]]
             if variance <= 0.0:
-                raise EstimationError('computed variance is zero or negative: %r' %
-                                      variance)
-            elif variance < 1e-10:
-                raise EstimationError('computed variance too miniscule (variances'
-                                      ' this small can lead to substantial loss of'
-                                      ' precision during accumulation): %r' %
-                                      variance)
-
-            coeffVec.append(coeff)
-            varianceVec.append(variance)
-        coeffVec = np.asarray(coeffVec)
-        varianceVec = np.asarray(varianceVec)
-        if coeffVec.size == 0:
-            coeffVec = np.zeros((order, inputLength))
-        if varianceVec.size == 0:
-            varianceVec = np.zeros((order,))
+                raise EstimationError('computed variance is zero or negative:'
+                                      ' %r' % variance)
+            else:
+                raise EstimationError('computed variance too miniscule'
+                                      ' (variances this small can lead to'
+                                      ' substantial loss of precision during'
+                                      ' accumulation): %r' % variance)
 
         distNew = LinearGaussianVec(coeffVec, varianceVec,
                                     self.varianceFloorVec, tag = self.tag)
@@ -814,6 +1330,9 @@ class GaussianVecAcc(TermAcc):
         self.sumVec += output * occ
         self.sumSqrVec += output * output * occ
 
+    def statNames(self):
+        return ['occ', 'sumVec', 'sumSqrVec']
+
     # N.B. assumes distPrev (if present) is the same for self and acc (not
     #   checked).
     def addAccSingle(self, acc):
@@ -899,6 +1418,9 @@ class ConstantClassifierAcc(TermAcc):
         self.occ += occ
         self.occs[classIndex] += occ
 
+    def statNames(self):
+        return ['occ', 'occs']
+
     # N.B. assumes class 0 in self corresponds to class 0 in acc, etc.
     #   Also assumes distPrev (if present) is the same for self and acc (not
     #   checked).
@@ -951,11 +1473,17 @@ class ConstantClassifierAcc(TermAcc):
         return distNew, self.auxFn(probs)
 
 @codeDeps(ForwardRef(lambda: BinaryLogisticClassifier), EstimationError, Rat,
-    TermAcc, mla.solve
+    TermAcc, mla.solve, outerPacked, packSymmetric, unpackSymmetric
 )
 class BinaryLogisticClassifierAcc(TermAcc):
-    def __init__(self, distPrev, tag = None):
+    """Accumulator for BinaryLogisticClassifier.
+
+    If packed is True then only the upper triangle of the symmetric sumOuter
+    statistic is stored, as for LinearGaussianAcc.
+    """
+    def __init__(self, distPrev, packed = False, tag = None):
         self.distPrev = distPrev
+        self.packed = packed
         self.tag = tag
 
         dim = len(self.distPrev.coeff)
@@ -964,15 +1492,37 @@ class BinaryLogisticClassifierAcc(TermAcc):
         self.sumOuter = np.zeros([dim, dim])
         self.logLikePrev = 0.0
 
+    @property
+    def sumOuter(self):
+        if self.packed:
+            return unpackSymmetric(self.sumOuterStored)
+        else:
+            return self.sumOuterStored
+
+    @sumOuter.setter
+    def sumOuter(self, sumOuter):
+        if self.packed:
+            self.sumOuterStored = packSymmetric(sumOuter)
+        else:
+            self.sumOuterStored = sumOuter
+
     def add(self, input, classIndex, occ = 1.0):
         if occ > 0.0:
             probPrev1 = self.distPrev.prob(input, 1)
             probPrevProduct = probPrev1 * (1.0 - probPrev1)
             self.occ += occ
             self.sumTarget += input * (probPrev1 - classIndex) * occ
-            self.sumOuter += np.outer(input, input) * probPrevProduct * occ
+            if self.packed:
+                self.sumOuterStored += (outerPacked(np.asarray(input)) *
+                                        probPrevProduct * occ)
+            else:
+                self.sumOuterStored += (np.outer(input, input) *
+                                        probPrevProduct * occ)
             self.logLikePrev += self.distPrev.logProb(input, classIndex) * occ
 
+    def statNames(self):
+        return ['occ', 'sumTarget', 'sumOuterStored', 'logLikePrev']
+
     # N.B. assumes class 0 in self corresponds to class 0 in acc, etc.
     # (FIXME : accumulated values encode a local quadratic approx of likelihood
     #   function at current params. However should the origin in parameter
@@ -983,7 +1533,10 @@ class BinaryLogisticClassifierAcc(TermAcc):
         assert np.all(self.distPrev.coeff == acc.distPrev.coeff)
         self.occ += acc.occ
         self.sumTarget += acc.sumTarget
-        self.sumOuter += acc.sumOuter
+        if self.packed and acc.packed:
+            self.sumOuterStored += acc.sumOuterStored
+        else:
+            self.sumOuter = self.sumOuter + acc.sumOuter
         self.logLikePrev += acc.logLikePrev
 
     def auxFn(self, coeff):
@@ -1015,11 +1568,12 @@ class BinaryLogisticClassifierAcc(TermAcc):
     def estimateSingleAux(self):
         if self.occ == 0.0:
             raise EstimationError('require occ > 0')
+        sumOuter = self.sumOuter
         try:
-            coeffDelta = -mla.solve(self.sumOuter, self.sumTarget)
+            coeffDelta = -mla.solve(sumOuter, self.sumTarget)
         except la.LinAlgError:
             try:
-                coeffDelta = -la.lstsq(self.sumOuter, self.sumTarget)[0]
+                coeffDelta = -la.lstsq(sumOuter, self.sumTarget)[0]
             except la.LinAlgError, detail:
                 raise EstimationError('could not solve: %s' % detail)
 
@@ -1035,7 +1589,9 @@ class BinaryLogisticClassifierAcc(TermAcc):
                                            tag = self.tag)
         return distNew, self.auxFn(coeff)
 
-@codeDeps(Acc, ForwardRef(lambda: MixtureDist), Rat, assert_allclose, logSum)
+@codeDeps(Acc, ForwardRef(lambda: MixtureDist), Rat, assert_allclose, logSum,
+    logSumArray
+)
 class MixtureAcc(Acc):
     def __init__(self, distPrev, classAcc, regAccs, tag = None):
         self.numComps = distPrev.numComps
@@ -1064,6 +1620,37 @@ class MixtureAcc(Acc):
                 self.regAccs[comp].add(input, output, occ * relOcc)
                 self.entropy -= occ * relOcc * math.log(relOcc)
 
+    def addBatch(self, inputs, outputs, occs = None):
+        numFrames = len(outputs)
+        if occs is None:
+            occs = np.ones((numFrames,))
+        else:
+            occs = np.asarray(occs, dtype = np.float64)
+        self.occ += float(np.sum(occs))
+        # (numFrames, numComps) matrix of responsibilities
+        logProbs = self.distPrev.logProbCompBatch(inputs, outputs)
+        logTots = logSumArray(logProbs, axis = 1)
+        relOccs = np.exp(logProbs - np.reshape(logTots, (-1, 1)))
+        assert_allclose(np.sum(relOccs, axis = 1), np.ones((numFrames,)))
+        compOccs = np.reshape(occs, (-1, 1)) * relOccs
+        for comp in range(self.numComps):
+            frameIndices = np.nonzero(relOccs[:, comp] > 0.0)[0]
+            if len(frameIndices) > 0:
+                compInputs = [ inputs[frameIndex]
+                               for frameIndex in frameIndices ]
+                compOutputs = [ outputs[frameIndex]
+                                for frameIndex in frameIndices ]
+                self.classAcc.addBatch(compInputs, [comp] * len(frameIndices),
+                                       compOccs[frameIndices, comp])
+                self.regAccs[comp].addBatch(compInputs, compOutputs,
+                                            compOccs[frameIndices, comp])
+        isPositive = relOccs > 0.0
+        self.entropy -= np.sum(compOccs[isPositive] *
+                               np.log(relOccs[isPositive]))
+
+    def statNames(self):
+        return ['occ', 'entropy']
+
     # N.B. assumes component 0 in self corresponds to component 0 in acc, etc.
     #   Also assumes distPrev is the same for self and acc (not checked).
     def addAccSingle(self, acc):
@@ -1103,6 +1690,9 @@ class IdentifiableMixtureAcc(Acc):
         self.classAcc.add(input, comp, occ)
         self.regAccs[comp].add(input, acOutput, occ)
 
+    def statNames(self):
+        return ['occ']
+
     def addAccSingle(self, acc):
         assert len(self.regAccs) == len(acc.regAccs)
         self.occ += acc.occ
@@ -1149,6 +1739,21 @@ class VectorAcc(Acc):
             summary = self.vectorSummarizer(input, output[:outIndex], outIndex)
             self.accComps[outIndex].add(summary, output[outIndex], occ)
 
+    def addBatch(self, inputs, outputs, occs = None):
+        if occs is None:
+            occs = [1.0] * len(outputs)
+        self.occ += sum(occs)
+        for outIndex in self.accComps:
+            summaries = [
+                self.vectorSummarizer(input, output[:outIndex], outIndex)
+                for input, output in izip(inputs, outputs)
+            ]
+            outputComps = [ output[outIndex] for output in outputs ]
+            self.accComps[outIndex].addBatch(summaries, outputComps, occs)
+
+    def statNames(self):
+        return ['occ']
+
     def addAccSingle(self, acc):
         assert self.order == acc.order
         assert self.keys == acc.keys
@@ -1195,6 +1800,24 @@ class DiscreteAcc(Acc):
         self.occ += occ
         self.accDict[label].add(acInput, output, occ)
 
+    def addBatch(self, inputs, outputs, occs = None):
+        if occs is None:
+            occs = [1.0] * len(outputs)
+        self.occ += sum(occs)
+        blocks = dict()
+        for (label, acInput), output, occ in izip(inputs, outputs, occs):
+            if label not in blocks:
+                blocks[label] = ([], [], [])
+            acInputs, labelOutputs, labelOccs = blocks[label]
+            acInputs.append(acInput)
+            labelOutputs.append(output)
+            labelOccs.append(occ)
+        for label, (acInputs, labelOutputs, labelOccs) in blocks.iteritems():
+            self.accDict[label].addBatch(acInputs, labelOutputs, labelOccs)
+
+    def statNames(self):
+        return ['occ']
+
     def addAccSingle(self, acc):
         assert self.keys == acc.keys
         self.occ += acc.occ
@@ -1270,6 +1893,17 @@ class MappedInputAcc(Acc):
         self.occ += occ
         self.acc.add(self.inputTransform(input), output, occ)
 
+    def addBatch(self, inputs, outputs, occs = None):
+        if occs is None:
+            occs = [1.0] * len(outputs)
+        self.occ += sum(occs)
+        inputTransform = self.inputTransform
+        self.acc.addBatch([ inputTransform(input) for input in inputs ],
+                          outputs, occs)
+
+    def statNames(self):
+        return ['occ']
+
     def addAccSingle(self, acc):
         self.occ += acc.occ
 
@@ -1304,6 +1938,9 @@ class MappedOutputAcc(Acc):
         self.acc.add(input, self.outputTransform(input, output), occ)
         self.logJac += self.outputTransform.logJac(input, output) * occ
 
+    def statNames(self):
+        return ['occ', 'logJac']
+
     def addAccSingle(self, acc):
         self.occ += acc.occ
         self.logJac += acc.logJac
@@ -1337,6 +1974,9 @@ class TransformedInputLearnDistAccEM(AccEM):
         self.occ += occ
         self.acc.add(self.inputTransform(input), output, occ)
 
+    def statNames(self):
+        return ['occ']
+
     def addAccSingle(self, acc):
         self.occ += acc.occ
 
@@ -1366,6 +2006,9 @@ class TransformedInputLearnTransformAccEM(AccEM):
         self.occ += occ
         self.inputTransformAcc.add((self.dist, input), output, occ)
 
+    def statNames(self):
+        return ['occ']
+
     def addAccSingle(self, acc):
         self.occ += acc.occ
 
@@ -1403,6 +2046,9 @@ class TransformedInputAccG(AccG):
         self.inputTransformAcc.add((self.dist, input), output, occ)
         self.acc.add(self.inputTransform(input), output, occ)
 
+    def statNames(self):
+        return ['occ']
+
     def addAccSingle(self, acc):
         self.occ += acc.occ
 
@@ -1431,6 +2077,9 @@ class TransformedOutputLearnDistAccEM(AccEM):
         self.acc.add(input, self.outputTransform(input, output), occ)
         self.logJac += self.outputTransform.logJac(input, output) * occ
 
+    def statNames(self):
+        return ['occ', 'logJac']
+
     def addAccSingle(self, acc):
         self.occ += acc.occ
         self.logJac += acc.logJac
@@ -1461,6 +2110,9 @@ class TransformedOutputLearnTransformAccEM(AccEM):
         self.occ += occ
         self.outputTransformAcc.add((self.dist, input), output, occ)
 
+    def statNames(self):
+        return ['occ']
+
     def addAccSingle(self, acc):
         self.occ += acc.occ
 
@@ -1501,6 +2153,9 @@ class TransformedOutputAccG(AccG):
         self.acc.add(input, self.outputTransform(input, output), occ)
         self.logJac += self.outputTransform.logJac(input, output) * occ
 
+    def statNames(self):
+        return ['occ', 'logJac']
+
     def addAccSingle(self, acc):
         self.occ += acc.occ
         self.logJac += acc.logJac
@@ -1526,6 +2181,9 @@ class PassThruAcc(Acc):
         self.occ += occ
         self.acc.add(input, output, occ)
 
+    def statNames(self):
+        return ['occ']
+
     def addAccSingle(self, acc):
         self.occ += acc.occ
 
@@ -1556,6 +2214,9 @@ class CountFramesAcc(Acc):
         self.frames += len(outSeq) * occ
         self.acc.add(input, outSeq, occ)
 
+    def statNames(self):
+        return ['occ', 'frames']
+
     def addAccSingle(self, acc):
         self.occ += acc.occ
         self.frames += acc.frames
@@ -1575,11 +2236,11 @@ class CountFramesAcc(Acc):
 
 @codeDeps(Acc, ForwardRef(lambda: DebugDist), Memo, Rat)
 class DebugAcc(Acc):
-    def __init__(self, maxOcc, acc, tag = None):
+    def __init__(self, maxOcc, acc, spillDir = None, tag = None):
         self.acc = acc
         self.tag = tag
 
-        self.memo = Memo(maxOcc = maxOcc)
+        self.memo = Memo(maxOcc = maxOcc, spillDir = spillDir)
 
     def children(self):
         return [self.acc]
@@ -1603,21 +2264,27 @@ class DebugAcc(Acc):
 
     def estimateAux(self, estimateChild):
         dist = estimateChild(self.acc)
-        overallDistNew = DebugDist(self.memo.maxOcc, dist, tag = self.tag)
+        overallDistNew = DebugDist(self.memo.maxOcc, dist,
+                                   spillDir = self.memo.spillDir,
+                                   tag = self.tag)
         return overallDistNew, (0.0, Rat.Exact)
 
 @codeDeps(Acc, ForwardRef(lambda: AutoregressiveSequenceDist), Rat,
-    contextualizeIter
+    contextualizeArray, contextualizeIter
 )
 class AutoregressiveSequenceAcc(Acc):
-    def __init__(self, depth, seqFor, fillFrames, acc, tag = None):
+    def __init__(self, depth, seqFor, fillFrames, acc, packContext = False,
+                 tag = None):
         self.depth = depth
         self.seqFor = seqFor
         self.fillFrames = fillFrames
         self.acc = acc
+        self.packContext = packContext
         self.tag = tag
 
         assert len(self.fillFrames) <= self.depth
+        if self.packContext:
+            assert len(self.fillFrames) == self.depth
 
         self.occ = 0.0
         self.frames = 0.0
@@ -1629,11 +2296,22 @@ class AutoregressiveSequenceAcc(Acc):
         inSeq = self.seqFor(input)
         assert len(inSeq) == len(outSeq)
         self.occ += occ
-        contextedOutSeq = contextualizeIter(self.depth, outSeq,
-                                            fillFrames = self.fillFrames)
-        for inFrame, (outContext, outFrame) in izip(inSeq, contextedOutSeq):
-            self.frames += occ
-            self.acc.add((inFrame, outContext), outFrame, occ)
+        if self.packContext:
+            outContexts, outFrames = contextualizeArray(self.depth, outSeq,
+                                                        self.fillFrames)
+            self.frames += len(outFrames) * occ
+            self.acc.addBatch(zip(inSeq, outContexts), outFrames,
+                              [occ] * len(outFrames))
+        else:
+            contextedOutSeq = contextualizeIter(self.depth, outSeq,
+                                                fillFrames = self.fillFrames)
+            for inFrame, (outContext, outFrame) in izip(inSeq,
+                                                        contextedOutSeq):
+                self.frames += occ
+                self.acc.add((inFrame, outContext), outFrame, occ)
+
+    def statNames(self):
+        return ['occ', 'frames']
 
     def addAccSingle(self, acc):
         self.occ += acc.occ
@@ -1650,22 +2328,57 @@ class AutoregressiveSequenceAcc(Acc):
 
     def estimateAux(self, estimateChild):
         dist = estimateChild(self.acc)
-        overallDistNew = AutoregressiveSequenceDist(self.depth, self.seqFor,
-                                                    self.fillFrames, dist,
-                                                    tag = self.tag)
+        overallDistNew = AutoregressiveSequenceDist(
+            self.depth, self.seqFor, self.fillFrames, dist,
+            packContext = self.packContext, tag = self.tag
+        )
         return overallDistNew, (0.0, Rat.Exact)
 
-@codeDeps(Acc, ForwardRef(lambda: AutoregressiveNetDist), Rat,
-    wnet.forwardBackwardAlt
+@codeDeps(Acc, ForwardRef(lambda: AutoregressiveNetDist), Lattice, Rat,
+    persist.secHashObject, readLattice, writeLattice
 )
 class AutoregressiveNetAcc(Acc):
-    def __init__(self, distPrev, durAcc, acAcc, verbosity, tag = None):
+    """Acc for AutoregressiveNetDist.
+
+    If latticeDir is not None and replayLattices is False then the pruned
+    edge posteriors computed for each utterance are written to latticeDir as
+    a lattice (see armspeech.modelling.lattice). If replayLattices is True
+    then instead of performing Forward-Backward the edge posteriors are read
+    from the lattices previously written to latticeDir, so accumulation uses
+    a fixed (soft) alignment. This allows cheap training iterations in
+    between full re-alignments. The log likelihood computed when replaying is
+    a lower bound on the true log likelihood.
+    Each lattice records the number of frames, the secHash of the dist used
+    to compute it and a hash of the net and acoustic context structure of
+    that dist (depth, fillFrames and netFor). When replaying, these are
+    checked against the utterance and against the structure of distPrev
+    (distPrev itself will typically have been re-estimated since the
+    lattices were written), and all the lattices replayed by an acc are
+    checked to have been computed using the same dist.
+
+    If netCache is not None it is used to cache the concretized net for each
+    input (see AutoregressiveNetDist.getConcreteNet).
+    """
+    def __init__(self, distPrev, durAcc, acAcc, verbosity, latticeDir = None,
+                 replayLattices = False, netCache = None, tag = None):
         self.distPrev = distPrev
         self.durAcc = durAcc
         self.acAcc = acAcc
         self.verbosity = verbosity
+        self.latticeDir = latticeDir
+        self.replayLattices = replayLattices
+        self.netCache = netCache
         self.tag = tag
 
+        assert self.latticeDir is not None or not self.replayLattices
+
+        if self.latticeDir is not None:
+            self.netHash = persist.secHashObject(
+                (distPrev.depth, distPrev.fillFrames, distPrev.netFor)
+            )
+            self.distHash = (None if self.replayLattices
+                             else persist.secHashObject(distPrev))
+
         self.occ = 0.0
         self.frames = 0.0
         self.entropy = 0.0
@@ -1673,60 +2386,127 @@ class AutoregressiveNetAcc(Acc):
     def children(self):
         return [self.durAcc, self.acAcc]
 
-    def add(self, (uttId, input), outSeq, occ = 1.0):
-        if self.verbosity >= 2:
-            print 'fb: uttId %s' % uttId
-        self.occ += occ
-        self.frames += len(outSeq) * occ
+    def latticeFile(self, uttId):
+        return os.path.join(self.latticeDir, '%s.lat' % uttId)
 
-        timedNet, labelToWeight = self.distPrev.getTimedNet(input, outSeq)
-        totalLogProb, edgeGen = wnet.forwardBackwardAlt(
-            timedNet,
-            labelToWeight = labelToWeight,
-            divisionRing = self.distPrev.ring,
-            getAgenda = self.distPrev.getAgenda
+    def computeLattice(self, input, outSeq):
+        """Performs Forward-Backward and returns the pruned edge posteriors.
+
+        Returns the total log prob and a Lattice containing the timed labels
+        (excluding None labels) whose log occupancy is above the pruning
+        threshold specified by pruneSpec.
+        """
+        totalLogProb, edgeGen, labelToWeight = (
+            self.distPrev.forwardBackward(input, outSeq,
+                                          netCache = self.netCache)
         )
 
         pruneSpec = self.distPrev.pruneSpec
-        numFilled = len(self.distPrev.fillFrames)
-        outSeqFilled = self.distPrev.fillFrames + outSeq
-        entropy = totalLogProb * occ
-        accedEdges = 0
-        for (label, labelStartTime, labelEndTime), logOcc in edgeGen:
+        lattice = Lattice(entropy = totalLogProb)
+        for timedLabel, logOcc in edgeGen:
+            label, labelStartTime, labelEndTime = timedLabel
             if label is not None and (pruneSpec is None or
                                       pruneSpec.logOccThresh is None or
                                       logOcc > -pruneSpec.logOccThresh):
-                labelOcc = math.exp(logOcc) * occ
-                entropy -= labelToWeight((label, labelStartTime,
-                                          labelEndTime)) * labelOcc
+                lattice.entropy -= labelToWeight(timedLabel) * math.exp(logOcc)
+                assert not label[0] or labelEndTime == labelStartTime + 1
+                lattice.add(timedLabel, logOcc)
+        return totalLogProb, lattice
 
-                acInput = outSeqFilled[
-                    max(labelStartTime - self.distPrev.depth + numFilled, 0):
-                    (labelStartTime + numFilled)
-                ]
-                if not label[0]:
-                    _, phInput, phOutput = label
-                    self.durAcc.add((phInput, acInput), phOutput, labelOcc)
-                else:
-                    _, phInput = label
-                    assert labelEndTime == labelStartTime + 1
-                    acOutput = outSeq[labelStartTime]
-                    self.acAcc.add((phInput, acInput), acOutput, labelOcc)
-                accedEdges += 1
+    def add(self, (uttId, input), outSeq, occ = 1.0):
+        if self.verbosity >= 2:
+            print 'fb: uttId %s' % uttId
+        self.occ += occ
+        self.frames += len(outSeq) * occ
+
+        if self.replayLattices:
+            totalLogProb = None
+            lattice = readLattice(self.latticeFile(uttId))
+            if lattice.numFrames != len(outSeq):
+                raise RuntimeError('lattice for utterance %s has %s frames'
+                                   ' (expected %s)' %
+                                   (uttId, lattice.numFrames, len(outSeq)))
+            if lattice.netHash != self.netHash:
+                raise RuntimeError('lattice for utterance %s was computed'
+                                   ' using a different net or acoustic'
+                                   ' context' % uttId)
+            if self.distHash is None:
+                self.distHash = lattice.distHash
+            elif lattice.distHash != self.distHash:
+                raise RuntimeError('lattice for utterance %s was computed'
+                                   ' using a different dist (%s) to previous'
+                                   ' lattices (%s)' %
+                                   (uttId, lattice.distHash, self.distHash))
+        else:
+            totalLogProb, lattice = self.computeLattice(input, outSeq)
+            if self.latticeDir is not None:
+                lattice.numFrames = len(outSeq)
+                lattice.distHash = self.distHash
+                lattice.netHash = self.netHash
+                writeLattice(lattice, self.latticeFile(uttId))
+
+        entropy = lattice.entropy * occ
+        # occupancies are collected per label and added to child accs in
+        #   blocks (each block being a (times, occs) pair)
+        blocks = defaultdict(lambda: ([], []))
+        for (label, labelStartTime, labelEndTime), logOcc in lattice.edges():
+            times, occs = blocks[label]
+            times.append(labelStartTime)
+            occs.append(math.exp(logOcc) * occ)
+        accedEdges = len(lattice)
+
+        acInputs = self.distPrev.getAcInputs(outSeq)
+        numShort = self.distPrev.getNumShortContext()
+        for label, (times, occs) in blocks.iteritems():
+            # (combine any repeated times)
+            occsByTime = np.bincount(times, weights = occs)
+            times = np.nonzero(occsByTime)[0]
+            occs = occsByTime[times]
+            if not label[0]:
+                _, phInput, phOutput = label
+                acc = self.durAcc
+                outputs = [phOutput] * len(times)
+            else:
+                _, phInput = label
+                acc = self.acAcc
+                outputs = [ outSeq[time] for time in times ]
+            inputs = [ (phInput, acInputs[time]) for time in times ]
+            # (frames with shorter acoustic context are added separately so
+            #   that blocks contain inputs of a fixed size)
+            numShortHere = np.searchsorted(times, numShort)
+            for index in range(numShortHere):
+                acc.add(inputs[index], outputs[index], float(occs[index]))
+            if len(times) > numShortHere:
+                acc.addBatch(inputs[numShortHere:], outputs[numShortHere:],
+                             occs[numShortHere:])
         self.entropy += entropy
 
         if self.verbosity >= 2:
-            print 'fb:    log like = %s (net path entropy = %s)' % (
-                (0.0, 0.0) if len(outSeq) == 0
-                else (totalLogProb / len(outSeq), entropy / len(outSeq))
-            )
+            if totalLogProb is None:
+                print 'fb:    replayed lattice (net path entropy = %s)' % (
+                    0.0 if len(outSeq) == 0 else entropy / len(outSeq)
+                )
+            else:
+                print 'fb:    log like = %s (net path entropy = %s)' % (
+                    (0.0, 0.0) if len(outSeq) == 0
+                    else (totalLogProb / len(outSeq), entropy / len(outSeq))
+                )
         if self.verbosity >= 3:
             print 'fb:    (accumulated over %s edges)' % accedEdges
         if self.verbosity >= 2:
             print 'fb:'
 
+    def statNames(self):
+        return ['occ', 'frames', 'entropy']
+
     # N.B. assumes distPrev is the same for self and acc (not checked).
     def addAccSingle(self, acc):
+        if self.replayLattices:
+            if self.distHash is None:
+                self.distHash = acc.distHash
+            elif acc.distHash is not None and acc.distHash != self.distHash:
+                raise RuntimeError('cannot combine accs which replayed lattices'
+                                   ' computed using different dists')
         self.occ += acc.occ
         self.frames += acc.frames
         self.entropy += acc.entropy
@@ -1753,6 +2533,7 @@ class AutoregressiveNetAcc(Acc):
                                         self.distPrev.fillFrames,
                                         durDist, acDist,
                                         self.distPrev.pruneSpec,
+                                        dense = self.distPrev.dense,
                                         tag = self.tag)
         return distNew, (self.entropy, Rat.LowerBound)
 
@@ -1765,6 +2546,15 @@ class Dist(object):
         abstract
     def logProb(self, input, output):
         abstract
+    def logProbBatch(self, inputs, outputs):
+        """Returns a vector of log probabilities for a block of frames.
+
+        Equivalent to calling logProb for each (input, output) pair in turn.
+        Subclasses may override this to evaluate the whole block at once.
+        """
+        return np.array([ self.logProb(input, output)
+                          for input, output in izip(inputs, outputs) ],
+                        dtype = np.float64)
     def logProbDerivInput(self, input, output):
         abstract
     def logProbDerivOutput(self, input, output):
@@ -1775,6 +2565,18 @@ class Dist(object):
         return self.createAcc(createAccChild)
     def synth(self, input, method = SynthMethod.Sample, actualOutput = None):
         abstract
+    def synthBatch(self, inputs, method = SynthMethod.Sample,
+                   actualOutputs = None):
+        """Returns a list (or array) of synthesized outputs for a block of inputs.
+
+        Equivalent to calling synth for each input (and actual output, if
+        actualOutputs is not None) in turn.
+        Subclasses may override this to synthesize the whole block at once.
+        """
+        if actualOutputs is None:
+            actualOutputs = [None] * len(inputs)
+        return [ self.synth(input, method, actualOutput)
+                 for input, actualOutput in izip(inputs, actualOutputs) ]
     def paramsSingle(self):
         abstract
     def paramsChildren(self, paramsChild):
@@ -1802,6 +2604,34 @@ class Dist(object):
         self.tag = tag
         return self
 
+@codeDeps()
+def synthBatchByKey(distForKey, keys, inputs, method, actualOutputs):
+    """Synthesizes a block of frames where each frame uses its own sub-dist.
+
+    The frames with a given key are synthesized as a single block using the
+    synthBatch method of distForKey(key), and the outputs are returned in the
+    original frame order.
+    """
+    if actualOutputs is None:
+        actualOutputs = [None] * len(inputs)
+    blocks = dict()
+    for frameIndex, (key, input, actualOutput) in enumerate(
+        izip(keys, inputs, actualOutputs)
+    ):
+        if key not in blocks:
+            blocks[key] = ([], [], [])
+        frameIndices, keyInputs, keyActualOutputs = blocks[key]
+        frameIndices.append(frameIndex)
+        keyInputs.append(input)
+        keyActualOutputs.append(actualOutput)
+    outputs = [None] * len(inputs)
+    for key, (frameIndices, keyInputs, keyActualOutputs) in blocks.iteritems():
+        keyOutputs = distForKey(key).synthBatch(keyInputs, method,
+                                                keyActualOutputs)
+        for frameIndex, output in izip(frameIndices, keyOutputs):
+            outputs[frameIndex] = output
+    return outputs
+
 @codeDeps(Dist)
 class TermDist(Dist):
     """Dist with no children."""
@@ -1906,6 +2736,14 @@ class LinearGaussian(TermDist):
         return (self.gConst - 0.5 * math.log(self.variance) +
                 -0.5 * (output - mean) ** 2 / self.variance)
 
+    def logProbBatch(self, inputs, outputs):
+        outputs = np.asarray(outputs, dtype = np.float64)
+        inputs = np.reshape(np.asarray(inputs, dtype = np.float64),
+                            (len(outputs), len(self.coeff)))
+        means = np.dot(inputs, self.coeff)
+        return (self.gConst - 0.5 * math.log(self.variance) +
+                -0.5 * (outputs - means) ** 2 / self.variance)
+
     def logProbDerivInput(self, input, output):
         mean = np.dot(self.coeff, input)
         return self.coeff * (output - mean) * 1.0 / self.variance
@@ -1930,6 +2768,19 @@ class LinearGaussian(TermDist):
         else:
             raise RuntimeError('unknown SynthMethod %r' % method)
 
+    def synthBatch(self, inputs, method = SynthMethod.Sample,
+                   actualOutputs = None):
+        inputs = np.reshape(np.asarray(inputs, dtype = np.float64),
+                            (len(inputs), len(self.coeff)))
+        means = np.dot(inputs, self.coeff)
+        if method == SynthMethod.Meanish:
+            return means
+        elif method == SynthMethod.Sample:
+            return (means +
+                    np.random.randn(len(means)) * math.sqrt(self.variance))
+        else:
+            raise RuntimeError('unknown SynthMethod %r' % method)
+
     def paramsSingle(self):
         return np.append(self.coeff, -math.log(self.variance))
 
@@ -1990,6 +2841,21 @@ class LinearGaussianVec(TermDist):
         )
         return np.sum(lps)
 
+    def logProbBatch(self, inputs, outputs):
+        order, inputLength = np.shape(self.coeffVec)
+        numFrames = len(outputs)
+        inputs = np.reshape(np.asarray(inputs, dtype = np.float64),
+                            (numFrames, inputLength, order))
+        outputs = np.reshape(np.asarray(outputs, dtype = np.float64),
+                             (numFrames, order))
+        meanVecs = np.einsum(inputs, [0, 2, 1], self.coeffVec, [1, 2], [0, 1])
+        lps = (
+            -0.5 * np.log(self.varianceVec) +
+            -0.5 * (outputs - meanVecs) ** 2 / self.varianceVec +
+            -0.5 * math.log(2.0 * math.pi)
+        )
+        return np.sum(lps, axis = 1)
+
     def logProbDerivInput(self, input, output):
         meanVec = np.sum(self.coeffVec * input.T, axis = 1)
         return self.coeffVec.T * (output - meanVec) * 1.0 / self.varianceVec
@@ -2017,6 +2883,20 @@ class LinearGaussianVec(TermDist):
         else:
             raise RuntimeError('unknown SynthMethod %r' % method)
 
+    def synthBatch(self, inputs, method = SynthMethod.Sample,
+                   actualOutputs = None):
+        order, inputLength = np.shape(self.coeffVec)
+        inputs = np.reshape(np.asarray(inputs, dtype = np.float64),
+                            (len(inputs), inputLength, order))
+        meanVecs = np.einsum(inputs, [0, 2, 1], self.coeffVec, [1, 2], [0, 1])
+        if method == SynthMethod.Meanish:
+            return meanVecs
+        elif method == SynthMethod.Sample:
+            return (meanVecs + np.random.randn(*np.shape(meanVecs)) *
+                    np.sqrt(self.varianceVec))
+        else:
+            raise RuntimeError('unknown SynthMethod %r' % method)
+
     def paramsSingle(self):
         return np.append(self.coeffVec, -np.log(self.varianceVec))
 
@@ -2078,6 +2958,17 @@ class GaussianVec(TermDist):
         )
         return np.sum(lps)
 
+    def logProbBatch(self, inputs, outputs):
+        order, = np.shape(self.meanVec)
+        outputs = np.reshape(np.asarray(outputs, dtype = np.float64),
+                             (len(outputs), order))
+        lps = (
+            -0.5 * np.log(self.varianceVec) +
+            -0.5 * (outputs - self.meanVec) ** 2 / self.varianceVec +
+            -0.5 * math.log(2.0 * math.pi)
+        )
+        return np.sum(lps, axis = 1)
+
     def logProbDerivOutput(self, input, output):
         return -(output - self.meanVec) * 1.0 / self.varianceVec
 
@@ -2145,6 +3036,12 @@ class StudentDist(TermDist):
         a = output * output * self.precision * 1.0 / self.df
         return self.gConst - 0.5 * (self.df + 1.0) * math.log(1.0 + a)
 
+    def logProbBatch(self, inputs, outputs):
+        outputs = np.asarray(outputs, dtype = np.float64)
+        assert np.ndim(outputs) == 1
+        a = outputs * outputs * self.precision * 1.0 / self.df
+        return self.gConst - 0.5 * (self.df + 1.0) * np.log(1.0 + a)
+
     def logProbDerivInput(self, input, output):
         assert np.shape(output) == ()
         return np.zeros(np.shape(input))
@@ -2219,6 +3116,11 @@ class ConstantClassifier(TermDist):
         prob = self.probs[classIndex]
         return math.log(prob) if prob != 0.0 else float('-inf')
 
+    def logProbBatch(self, inputs, classIndices):
+        classIndices = np.asarray(classIndices, dtype = np.int64)
+        # (np.log(0.0) is -inf, as for logProb)
+        return np.log(np.asarray(self.probs, dtype = np.float64)[classIndices])
+
     def logProbDerivInput(self, input, classIndex):
         return np.zeros(np.shape(input))
 
@@ -2275,7 +3177,7 @@ class ConstantClassifier(TermDist):
             return numFloored, len(self.probs) - 1
 
 @codeDeps(BinaryLogisticClassifierAcc, InvalidParamsError, SynthMethod,
-    TermDist, sigmoid
+    TermDist, sigmoid, sigmoidArray
 )
 class BinaryLogisticClassifier(TermDist):
     def __init__(self, coeff, coeffFloor, tag = None):
@@ -2306,6 +3208,14 @@ class BinaryLogisticClassifier(TermDist):
         else:
             return prob1
 
+    def logProbBatch(self, inputs, classIndices):
+        classIndices = np.asarray(classIndices)
+        inputs = np.reshape(np.asarray(inputs, dtype = np.float64),
+                            (len(classIndices), len(self.coeff)))
+        probs1 = sigmoidArray(np.dot(inputs, self.coeff))
+        probs = np.where(classIndices == 0, 1.0 - probs1, probs1)
+        return np.log(probs)
+
     def logProbDerivInput(self, input, classIndex):
         return self.coeff * (classIndex - sigmoid(np.dot(self.coeff, input)))
 
@@ -2348,7 +3258,9 @@ class BinaryLogisticClassifier(TermDist):
         ])
         return numFloored, len(self.coeff)
 
-@codeDeps(Dist, MixtureAcc, SynthMethod, logSum, parseConcat)
+@codeDeps(Dist, MixtureAcc, SynthMethod, logSum, logSumArray, parseConcat,
+    synthBatchByKey
+)
 class MixtureDist(Dist):
     def __init__(self, classDist, regDists, hardMean, tag = None):
         self.numComps = len(regDists)
@@ -2378,6 +3290,18 @@ class MixtureDist(Dist):
         return (self.classDist.logProb(input, comp) +
                 self.regDists[comp].logProb(input, output))
 
+    def logProbCompBatch(self, inputs, outputs):
+        """Returns a (numFrames, numComps) matrix of component log probs."""
+        numFrames = len(outputs)
+        return np.reshape(np.transpose([
+            (self.classDist.logProbBatch(inputs, [comp] * numFrames) +
+             self.regDists[comp].logProbBatch(inputs, outputs))
+            for comp in range(self.numComps)
+        ]), (numFrames, self.numComps))
+
+    def logProbBatch(self, inputs, outputs):
+        return logSumArray(self.logProbCompBatch(inputs, outputs), axis = 1)
+
     def logProbDerivInput(self, input, output):
         logTot = self.logProb(input, output)
         return np.sum([
@@ -2422,6 +3346,40 @@ class MixtureDist(Dist):
         else:
             raise RuntimeError('unknown SynthMethod %r' % method)
 
+    def synthBatch(self, inputs, method = SynthMethod.Sample,
+                   actualOutputs = None):
+        if method == SynthMethod.Meanish:
+            if self.hardMean:
+                # hard selection of mixture component
+                comps = [
+                    np.argmax([ self.classDist.logProb(input, comp)
+                                for comp in range(self.numComps) ])
+                    for input in inputs
+                ]
+                return synthBatchByKey(lambda comp: self.regDists[comp],
+                                       comps, inputs, method, actualOutputs)
+            else:
+                # soft selection of mixture component
+                outputsForComp = [
+                    regDist.synthBatch(inputs, SynthMethod.Meanish,
+                                       actualOutputs)
+                    for regDist in self.regDists
+                ]
+                return [
+                    np.sum([
+                        outputsForComp[comp][frameIndex] *
+                        math.exp(self.classDist.logProb(input, comp))
+                        for comp in range(self.numComps)
+                    ], axis = 0)
+                    for frameIndex, input in enumerate(inputs)
+                ]
+        elif method == SynthMethod.Sample:
+            comps = self.classDist.synthBatch(inputs, method)
+            return synthBatchByKey(lambda comp: self.regDists[comp], comps,
+                                   inputs, method, actualOutputs)
+        else:
+            raise RuntimeError('unknown SynthMethod %r' % method)
+
     def paramsSingle(self):
         return []
 
@@ -2434,7 +3392,9 @@ class MixtureDist(Dist):
                               tag = self.tag)
         return distNew, paramsLeft
 
-@codeDeps(Dist, IdentifiableMixtureAcc, SynthMethod, parseConcat)
+@codeDeps(Dist, IdentifiableMixtureAcc, SynthMethod, parseConcat,
+    synthBatchByKey
+)
 class IdentifiableMixtureDist(Dist):
     def __init__(self, classDist, regDists, tag = None):
         self.classDist = classDist
@@ -2479,6 +3439,22 @@ class IdentifiableMixtureDist(Dist):
         acOutput = self.regDists[comp].synth(input, method, actualAcOutput)
         return comp, acOutput
 
+    def synthBatch(self, inputs, method = SynthMethod.Sample,
+                   actualOutputs = None):
+        if actualOutputs is None:
+            actualOutputs = [None] * len(inputs)
+        actualComps, actualAcOutputs = [], []
+        for actualOutput in actualOutputs:
+            actualComp, actualAcOutput = (actualOutput
+                                          if actualOutput is not None
+                                          else (None, None))
+            actualComps.append(actualComp)
+            actualAcOutputs.append(actualAcOutput)
+        comps = self.classDist.synthBatch(inputs, method, actualComps)
+        acOutputs = synthBatchByKey(lambda comp: self.regDists[comp], comps,
+                                    inputs, method, actualAcOutputs)
+        return zip(comps, acOutputs)
+
     def paramsSingle(self):
         return []
 
@@ -2532,6 +3508,18 @@ class VectorDist(Dist):
             lp += self.distComps[outIndex].logProb(summary, output[outIndex])
         return lp
 
+    def logProbBatch(self, inputs, outputs):
+        lps = np.zeros((len(outputs),))
+        for outIndex in self.distComps:
+            summaries = [
+                self.vectorSummarizer(input, output[:outIndex], outIndex)
+                for input, output in izip(inputs, outputs)
+            ]
+            outputComps = [ output[outIndex] for output in outputs ]
+            lps += self.distComps[outIndex].logProbBatch(summaries,
+                                                         outputComps)
+        return lps
+
     def logProbDerivInput(self, input, output):
         # FIXME : complete
         notyetimplemented
@@ -2562,6 +3550,29 @@ class VectorDist(Dist):
             partialOutput.append(out)
         return partialOutput
 
+    def synthBatch(self, inputs, method = SynthMethod.Sample,
+                   actualOutputs = None):
+        partialOutputs = [ [] for input in inputs ]
+        for outIndex in range(self.order):
+            if not outIndex in self.distComps:
+                outs = [ actualOutput[outIndex]
+                         for actualOutput in actualOutputs ]
+            else:
+                summaries = [
+                    self.vectorSummarizer(input, partialOutput, outIndex)
+                    for input, partialOutput in izip(inputs, partialOutputs)
+                ]
+                outs = self.distComps[outIndex].synthBatch(
+                    summaries,
+                    method,
+                    (None if actualOutputs is None
+                     else [ actualOutput[outIndex]
+                            for actualOutput in actualOutputs ])
+                )
+            for partialOutput, out in izip(partialOutputs, outs):
+                partialOutput.append(out)
+        return partialOutputs
+
     def paramsSingle(self):
         return []
 
@@ -2581,7 +3592,9 @@ def createDiscreteDist(keys, createDistFor):
         distDict[key] = createDistFor(key)
     return DiscreteDist(keys, distDict)
 
-@codeDeps(DiscreteAcc, Dist, SynthMethod, orderedDictRepr, parseConcat)
+@codeDeps(DiscreteAcc, Dist, SynthMethod, orderedDictRepr, parseConcat,
+    synthBatchByKey
+)
 class DiscreteDist(Dist):
     def __init__(self, keys, distDict, tag = None):
         assert len(keys) == len(distDict)
@@ -2609,6 +3622,24 @@ class DiscreteDist(Dist):
         label, acInput = input
         return self.distDict[label].logProb(acInput, output)
 
+    def logProbBatch(self, inputs, outputs):
+        blocks = dict()
+        for frameIndex, ((label, acInput), output) in enumerate(
+            izip(inputs, outputs)
+        ):
+            if label not in blocks:
+                blocks[label] = ([], [], [])
+            frameIndices, acInputs, labelOutputs = blocks[label]
+            frameIndices.append(frameIndex)
+            acInputs.append(acInput)
+            labelOutputs.append(output)
+        lps = np.empty((len(outputs),))
+        for label, (frameIndices, acInputs, labelOutputs) in blocks.iteritems():
+            lps[frameIndices] = self.distDict[label].logProbBatch(
+                acInputs, labelOutputs
+            )
+        return lps
+
     def logProbDerivInput(self, input, output):
         label, acInput = input
         return self.distDict[label].logProbDerivInput(acInput, output)
@@ -2627,6 +3658,16 @@ class DiscreteDist(Dist):
         label, acInput = input
         return self.distDict[label].synth(acInput, method, actualOutput)
 
+    def synthBatch(self, inputs, method = SynthMethod.Sample,
+                   actualOutputs = None):
+        return synthBatchByKey(
+            lambda label: self.distDict[label],
+            [ label for label, acInput in inputs ],
+            [ acInput for label, acInput in inputs ],
+            method,
+            actualOutputs
+        )
+
     def paramsSingle(self):
         return []
 
@@ -2663,6 +3704,12 @@ class MappedInputDist(Dist):
     def logProb(self, input, output):
         return self.dist.logProb(self.inputTransform(input), output)
 
+    def logProbBatch(self, inputs, outputs):
+        inputTransform = self.inputTransform
+        return self.dist.logProbBatch(
+            [ inputTransform(input) for input in inputs ], outputs
+        )
+
     def logProbDerivInput(self, input, output):
         return np.dot(
             self.inputTransform.deriv(input),
@@ -2680,6 +3727,14 @@ class MappedInputDist(Dist):
         return self.dist.synth(self.inputTransform(input), method,
                                actualOutput)
 
+    def synthBatch(self, inputs, method = SynthMethod.Sample,
+                   actualOutputs = None):
+        inputTransform = self.inputTransform
+        return self.dist.synthBatch(
+            [ inputTransform(input) for input in inputs ], method,
+            actualOutputs
+        )
+
     def paramsSingle(self):
         return []
 
@@ -2717,6 +3772,15 @@ class MappedOutputDist(Dist):
         return (self.dist.logProb(input, self.outputTransform(input, output)) +
                 self.outputTransform.logJac(input, output))
 
+    def logProbBatch(self, inputs, outputs):
+        outputTransform = self.outputTransform
+        outputsT = [ outputTransform(input, output)
+                     for input, output in izip(inputs, outputs) ]
+        logJacs = np.array([ outputTransform.logJac(input, output)
+                             for input, output in izip(inputs, outputs) ],
+                           dtype = np.float64)
+        return self.dist.logProbBatch(inputs, outputsT) + logJacs
+
     def logProbDerivInput(self, input, output):
         outputT = self.outputTransform(input, output)
         return (np.dot(self.outputTransform.derivInput(input, output),
@@ -2745,6 +3809,20 @@ class MappedOutputDist(Dist):
             )
         )
 
+    def synthBatch(self, inputs, method = SynthMethod.Sample,
+                   actualOutputs = None):
+        outputTransform = self.outputTransform
+        outputs = self.dist.synthBatch(
+            inputs,
+            method,
+            (None if actualOutputs is None
+             else [ (None if actualOutput is None
+                     else outputTransform(input, actualOutput))
+                    for input, actualOutput in izip(inputs, actualOutputs) ])
+        )
+        return [ outputTransform.inv(input, output)
+                 for input, output in izip(inputs, outputs) ]
+
     def paramsSingle(self):
         return []
 
@@ -2812,6 +3890,14 @@ class TransformedInputDist(Dist):
         return self.dist.synth(self.inputTransform(input), method,
                                actualOutput)
 
+    def synthBatch(self, inputs, method = SynthMethod.Sample,
+                   actualOutputs = None):
+        inputTransform = self.inputTransform
+        return self.dist.synthBatch(
+            [ inputTransform(input) for input in inputs ], method,
+            actualOutputs
+        )
+
     def paramsSingle(self):
         return []
 
@@ -2897,6 +3983,20 @@ class TransformedOutputDist(Dist):
             )
         )
 
+    def synthBatch(self, inputs, method = SynthMethod.Sample,
+                   actualOutputs = None):
+        outputTransform = self.outputTransform
+        outputs = self.dist.synthBatch(
+            inputs,
+            method,
+            (None if actualOutputs is None
+             else [ (None if actualOutput is None
+                     else outputTransform(input, actualOutput))
+                    for input, actualOutput in izip(inputs, actualOutputs) ])
+        )
+        return [ outputTransform.inv(input, output)
+                 for input, output in izip(inputs, outputs) ]
+
     def paramsSingle(self):
         return []
 
@@ -2940,6 +4040,10 @@ class PassThruDist(Dist):
     def synth(self, input, method = SynthMethod.Sample, actualOutput = None):
         return self.dist.synth(input, method, actualOutput)
 
+    def synthBatch(self, inputs, method = SynthMethod.Sample,
+                   actualOutputs = None):
+        return self.dist.synthBatch(inputs, method, actualOutputs)
+
     def paramsSingle(self):
         return []
 
@@ -2980,6 +4084,10 @@ class CountFramesDist(Dist):
     def synth(self, input, method = SynthMethod.Sample, actualOutput = None):
         return self.dist.synth(input, method, actualOutput)
 
+    def synthBatch(self, inputs, method = SynthMethod.Sample,
+                   actualOutputs = None):
+        return self.dist.synthBatch(inputs, method, actualOutputs)
+
     def paramsSingle(self):
         return []
 
@@ -2992,19 +4100,24 @@ class CountFramesDist(Dist):
 
 @codeDeps(DebugAcc, Dist, SynthMethod)
 class DebugDist(Dist):
-    def __init__(self, maxOcc, dist, tag = None):
+    def __init__(self, maxOcc, dist, spillDir = None, tag = None):
         self.maxOcc = maxOcc
         self.dist = dist
+        self.spillDir = spillDir
         self.tag = tag
 
     def __repr__(self):
-        return 'DebugDist(%r, %r, tag=%r)' % (self.maxOcc, self.dist, self.tag)
+        return 'DebugDist(%r, %r, spillDir=%r, tag=%r)' % (self.maxOcc,
+                                                          self.dist,
+                                                          self.spillDir,
+                                                          self.tag)
 
     def children(self):
         return [self.dist]
 
     def mapChildren(self, mapChild):
-        return DebugDist(self.maxOcc, mapChild(self.dist), tag = self.tag)
+        return DebugDist(self.maxOcc, mapChild(self.dist),
+                         spillDir = self.spillDir, tag = self.tag)
 
     def logProb(self, input, output):
         return self.dist.logProb(input, output)
@@ -3016,11 +4129,16 @@ class DebugDist(Dist):
         return self.dist.logProbDerivOutput(input, output)
 
     def createAcc(self, createAccChild):
-        return DebugAcc(self.maxOcc, createAccChild(self.dist), tag = self.tag)
+        return DebugAcc(self.maxOcc, createAccChild(self.dist),
+                        spillDir = self.spillDir, tag = self.tag)
 
     def synth(self, input, method = SynthMethod.Sample, actualOutput = None):
         return self.dist.synth(input, method, actualOutput)
 
+    def synthBatch(self, inputs, method = SynthMethod.Sample,
+                   actualOutputs = None):
+        return self.dist.synthBatch(inputs, method, actualOutputs)
+
     def paramsSingle(self):
         return []
 
@@ -3029,23 +4147,45 @@ class DebugDist(Dist):
 
     def parseChildren(self, params, parseChild):
         dist, paramsLeft = parseChild(self.dist, params)
-        return DebugDist(self.maxOcc, dist, tag = self.tag), paramsLeft
+        return DebugDist(self.maxOcc, dist, spillDir = self.spillDir,
+                         tag = self.tag), paramsLeft
 
-@codeDeps(AutoregressiveSequenceAcc, Dist, SynthMethod, contextualizeIter)
+@codeDeps(AutoregressiveSequenceAcc, Dist, PackedFrames, SynthMethod,
+    contextualizeArray, contextualizeIter
+)
 class AutoregressiveSequenceDist(Dist):
-    def __init__(self, depth, seqFor, fillFrames, dist, tag = None):
+    """An autoregressive distribution over sequences.
+
+    Each output frame is generated by the sub-dist given the corresponding
+    input frame and the previous depth output frames.
+    If packContext is True then the output frames are packed into arrays so
+    that the context for each frame is a view of these arrays rather than a
+    freshly constructed list (see contextualizeArray).
+    Numeric frames of a uniform shape are packed into a single array.
+    Multi-stream frames (tuples with one element per stream) are packed into
+    one array per stream, with MSD streams such as lf0 stored as an MsdArray,
+    and each context is then a StreamContext.
+    In this case exactly depth fill frames must be provided, and a fill
+    element of None for an MSD stream appears in contexts as (0, None).
+    """
+    def __init__(self, depth, seqFor, fillFrames, dist, packContext = False,
+                 tag = None):
         self.depth = depth
         self.seqFor = seqFor
         self.fillFrames = fillFrames
         self.dist = dist
+        self.packContext = packContext
         self.tag = tag
 
         assert len(self.fillFrames) <= self.depth
+        if self.packContext:
+            assert len(self.fillFrames) == self.depth
 
     def __repr__(self):
-        return ('AutoregressiveSequenceDist(%r, %r, %r, %r, tag=%r)' %
+        return ('AutoregressiveSequenceDist(%r, %r, %r, %r, packContext=%r,'
+                ' tag=%r)' %
                 (self.depth, self.seqFor, self.fillFrames, self.dist,
-                 self.tag))
+                 self.packContext, self.tag))
 
     def children(self):
         return [self.dist]
@@ -3053,17 +4193,29 @@ class AutoregressiveSequenceDist(Dist):
     def mapChildren(self, mapChild):
         return AutoregressiveSequenceDist(self.depth, self.seqFor,
                                           self.fillFrames, mapChild(self.dist),
+                                          packContext = self.packContext,
                                           tag = self.tag)
 
+    def contextualize(self, outSeq):
+        """Returns an iterator over (outContext, outFrame) pairs."""
+        if self.packContext:
+            outContexts, outFrames = contextualizeArray(self.depth, outSeq,
+                                                        self.fillFrames)
+            return izip(outContexts, outFrames)
+        else:
+            return contextualizeIter(self.depth, outSeq,
+                                     fillFrames = self.fillFrames)
+
     def logProb(self, (uttId, input), outSeq):
         inSeq = self.seqFor(input)
-        lp = 0.0
         assert len(inSeq) == len(outSeq)
-        contextedOutSeq = contextualizeIter(self.depth, outSeq,
-                                            fillFrames = self.fillFrames)
+        contextedOutSeq = self.contextualize(outSeq)
+        inputs = []
+        outFrames = []
         for inFrame, (outContext, outFrame) in izip(inSeq, contextedOutSeq):
-            lp += self.dist.logProb((inFrame, outContext), outFrame)
-        return lp
+            inputs.append((inFrame, outContext))
+            outFrames.append(outFrame)
+        return np.sum(self.dist.logProbBatch(inputs, outFrames))
 
     def logProbDerivInput(self, (uttId, input), outSeq):
         # FIXME : complete
@@ -3076,8 +4228,7 @@ class AutoregressiveSequenceDist(Dist):
     def sum(self, (uttId, input), outSeq, computeValue):
         inSeq = self.seqFor(input)
         assert len(inSeq) == len(outSeq)
-        contextedOutSeq = contextualizeIter(self.depth, outSeq,
-                                            fillFrames = self.fillFrames)
+        contextedOutSeq = self.contextualize(outSeq)
         return sum([
             computeValue(self.dist, (inFrame, outContext), outFrame)
             for inFrame, (outContext, outFrame) in izip(inSeq, contextedOutSeq)
@@ -3087,6 +4238,7 @@ class AutoregressiveSequenceDist(Dist):
         return AutoregressiveSequenceAcc(self.depth, self.seqFor,
                                          self.fillFrames,
                                          createAccChild(self.dist),
+                                         packContext = self.packContext,
                                          tag = self.tag)
 
     def synth(self, (uttId, input), method = SynthMethod.Sample,
@@ -3094,13 +4246,70 @@ class AutoregressiveSequenceDist(Dist):
         return list(self.synthIterator((uttId, input), method = method,
                                        actualOutput = actualOutput))
 
+    def synthBatch(self, inputs, method = SynthMethod.Sample,
+                   actualOutputs = None):
+        """Synthesizes several utterances in lockstep.
+
+        At each frame index the contexts for all utterances which are still
+        being synthesized are collected and passed to a single synthBatch
+        call on the sub-dist, so the cost of synthesis is dominated by
+        vectorized computation in the leaf dists rather than by per-frame
+        Python dispatch.
+        """
+        inSeqs = [ self.seqFor(input) for uttId, input in inputs ]
+        if actualOutputs is not None:
+            for inSeq, actualOutSeq in izip(inSeqs, actualOutputs):
+                assert len(actualOutSeq) == len(inSeq)
+        outSeqs = [ [] for inSeq in inSeqs ]
+        if self.packContext:
+            # (see synthIteratorPacked)
+            histories = [ self.createHistory(len(inSeq)) for inSeq in inSeqs ]
+        else:
+            outContexts = [ deque(self.fillFrames) for inSeq in inSeqs ]
+
+        numFramesMax = max([0] + [ len(inSeq) for inSeq in inSeqs ])
+        for frameIndex in range(numFramesMax):
+            uttIndices = [ uttIndex for uttIndex, inSeq in enumerate(inSeqs)
+                           if frameIndex < len(inSeq) ]
+            if self.packContext:
+                contexts = [ histories[uttIndex].context(frameIndex,
+                                                         self.depth)
+                             for uttIndex in uttIndices ]
+            else:
+                contexts = [ list(outContexts[uttIndex])
+                             for uttIndex in uttIndices ]
+            outFrames = self.dist.synthBatch(
+                [ (inSeqs[uttIndex][frameIndex], context)
+                  for uttIndex, context in izip(uttIndices, contexts) ],
+                method,
+                (None if actualOutputs is None
+                 else [ actualOutputs[uttIndex][frameIndex]
+                        for uttIndex in uttIndices ])
+            )
+            for uttIndex, outFrame in izip(uttIndices, outFrames):
+                outSeqs[uttIndex].append(outFrame)
+                if self.packContext:
+                    if self.depth > 0:
+                        histories[uttIndex][frameIndex + self.depth] = outFrame
+                else:
+                    outContext = outContexts[uttIndex]
+                    outContext.append(outFrame)
+                    if len(outContext) > self.depth:
+                        outContext.popleft()
+        return outSeqs
+
     def synthIterator(self, (uttId, input), method = SynthMethod.Sample,
                       actualOutput = None):
         inSeq = self.seqFor(input)
         actualOutSeq = actualOutput
-        outContext = deque(self.fillFrames)
         if actualOutSeq is not None:
             assert len(actualOutSeq) == len(inSeq)
+        if self.packContext:
+            for outFrame in self.synthIteratorPacked(inSeq, method,
+                                                     actualOutSeq):
+                yield outFrame
+            return
+        outContext = deque(self.fillFrames)
         for frameIndex, inFrame in enumerate(inSeq):
             outFrame = self.dist.synth(
                 (inFrame, list(outContext)),
@@ -3114,6 +4323,38 @@ class AutoregressiveSequenceDist(Dist):
             if len(outContext) > self.depth:
                 outContext.popleft()
 
+    def createHistory(self, numFrames):
+        """Returns packed storage for the fill frames and numFrames frames.
+
+        (If depth is 0 then no frames are stored, and every context is
+        empty.)
+        """
+        if self.depth == 0:
+            return PackedFrames(0.0, 0)
+        history = PackedFrames(self.fillFrames[0], self.depth + numFrames)
+        for index, fillFrame in enumerate(self.fillFrames):
+            history[index] = fillFrame
+        return history
+
+    def synthIteratorPacked(self, inSeq, method, actualOutSeq):
+        # (frames are written into pre-allocated history arrays and each
+        #   context is a view of the previous depth frames. Frames before the
+        #   current one are never modified so contexts retained by the
+        #   sub-dist remain valid.)
+        history = self.createHistory(len(inSeq))
+        for frameIndex, inFrame in enumerate(inSeq):
+            outContext = history.context(frameIndex, self.depth)
+            outFrame = self.dist.synth(
+                (inFrame, outContext),
+                method,
+                None if actualOutSeq is None else actualOutSeq[frameIndex]
+            )
+
+            yield outFrame
+
+            if self.depth > 0:
+                history[frameIndex + self.depth] = outFrame
+
     def paramsSingle(self):
         return []
 
@@ -3122,9 +4363,10 @@ class AutoregressiveSequenceDist(Dist):
 
     def parseChildren(self, params, parseChild):
         dist, paramsLeft = parseChild(self.dist, params)
-        overallDistNew = AutoregressiveSequenceDist(self.depth, self.seqFor,
-                                                    self.fillFrames, dist,
-                                                    tag = self.tag)
+        overallDistNew = AutoregressiveSequenceDist(
+            self.depth, self.seqFor, self.fillFrames, dist,
+            packContext = self.packContext, tag = self.tag
+        )
         return overallDistNew, paramsLeft
 
 @codeDeps(wnet.FlatMappedNet, wnet.SequenceNet, wnet.probLeftToRightNet)
@@ -3145,10 +4387,34 @@ class SimpleLeftToRightNetFor(object):
         )
         return net
 
+@codeDeps()
+def autoregressiveNetDeltaTime(label):
+    return 0 if label is None or not label[0] else 1
+
+@codeDeps(autoregressiveNetDeltaTime, wnet.FlatMappedNet, wnet.MappedLabelNet,
+    wnet.TrivialNet, wnet.concretizeNetTopSort
+)
+def buildAutoregressiveNet(netFor, input):
+    """Returns the concretized net used by AutoregressiveNetDist for input."""
+    net0 = netFor(input)
+    net1 = wnet.MappedLabelNet(
+        lambda (phInput, phOutput): (False, phInput, phOutput),
+        net0
+    )
+    net2 = wnet.FlatMappedNet(
+        lambda phInput: wnet.TrivialNet((True, phInput)),
+        net1
+    )
+    net = wnet.concretizeNetTopSort(net2, autoregressiveNetDeltaTime)
+    return net
+
 @codeDeps(AutoregressiveNetAcc, Dist, SynthMethod, SynthSeqTooLongError,
-    memoize, sampleDiscrete, semiring.LogRealsField, wnet.FlatMappedNet,
-    wnet.MappedLabelNet, wnet.PriorityQueueSumAgenda, wnet.TrivialNet,
-    wnet.UnrolledNet, wnet.concretizeNetTopSort, wnet.nodeSetCompute, wnet.sum
+    autoregressiveNetDeltaTime, buildAutoregressiveNet, codedep.getHash,
+    persist.secHashObject, sampleDiscrete, semiring.ExpectationSemiring,
+    semiring.LogRealsField, semiring.ViterbiSemiring, wnet.BeamSumAgenda,
+    wnet.ConcreteNet, wnet.IntUnrolledNet, wnet.PriorityQueueSumAgenda,
+    wnet.TopSortEdgeArrays, wnet.forwardBackwardAlt, wnet.forwardBackwardDense,
+    wnet.getDenseWeights, wnet.sum, wnet.sumGetAlphaDense
 )
 class AutoregressiveNetDist(Dist):
     """An autoregressive distribution over sequences.
@@ -3198,9 +4464,20 @@ class AutoregressiveNetDist(Dist):
     given node, then there should be two edges leaving this node, one with
     phonetic output 0 and one with phonetic output 1, and both with the given
     phonetic context.
+
+    If dense is True then forward-backward is computed using dense
+    vectorized recursions over (time, node) arrays (see
+    wnet.forwardBackwardDense) rather than the generic agenda-based algorithm.
+    The dense engine does not use pruneSpec.betaThresh (no beam pruning is
+    performed), though pruneSpec.logOccThresh is still applied during
+    accumulation.
+
+    The concretized net for each input may be cached by passing a netCache to
+    createAcc (see getConcreteNet). The cache is not part of the dist itself,
+    so it does not affect the dist's repr or pickled state.
     """
     def __init__(self, depth, netFor, fillFrames, durDist, acDist, pruneSpec,
-                 tag = None):
+                 dense = False, tag = None):
         self.depth = depth
         self.netFor = netFor
         self.fillFrames = fillFrames
@@ -3211,6 +4488,7 @@ class AutoregressiveNetDist(Dist):
         #   to use pruning during logProb computation, though, which we
         #   probably want to do.)
         self.pruneSpec = pruneSpec
+        self.dense = dense
         self.tag = tag
 
         assert len(self.fillFrames) <= self.depth
@@ -3218,9 +4496,10 @@ class AutoregressiveNetDist(Dist):
         self.ring = semiring.LogRealsField()
 
     def __repr__(self):
-        return ('AutoregressiveNetDist(%r, %r, %r, %r, %r, %r, tag=%r)' %
+        return ('AutoregressiveNetDist(%r, %r, %r, %r, %r, %r, dense=%r,'
+                ' tag=%r)' %
                 (self.depth, self.netFor, self.fillFrames, self.durDist,
-                 self.acDist, self.pruneSpec, self.tag))
+                 self.acDist, self.pruneSpec, self.dense, self.tag))
 
     def children(self):
         return [self.durDist, self.acDist]
@@ -3230,98 +4509,397 @@ class AutoregressiveNetDist(Dist):
                                      mapChild(self.durDist),
                                      mapChild(self.acDist),
                                      self.pruneSpec,
+                                     dense = self.dense,
                                      tag = self.tag)
 
+    def deltaTime(self, label):
+        return autoregressiveNetDeltaTime(label)
+
+    def buildNet(self, input):
+        return buildAutoregressiveNet(self.netFor, input)
+
+    def getConcreteNet(self, input, netCache = None):
+        """Returns the concretized net for input and its edge arrays.
+
+        If netCache is not None it should be an LruCache (see
+        armspeech.util.memoize), and the net and its edge arrays are looked up
+        in (or added to) netCache, so the net for a given input is only
+        constructed once (e.g. rather than on every iteration of training).
+        Values are keyed on a hash of netFor and input together with the code
+        hashes of buildAutoregressiveNet and wnet.TopSortEdgeArrays, so
+        netCache may safely be shared between dists with different netFor,
+        and cached nets persisted to disk are not reused after the code which
+        builds them changes. Otherwise the edge arrays are only computed if
+        needed (that is, if dense is True), and are None otherwise.
+        """
+        def build():
+            net = self.buildNet(input)
+            return net, wnet.TopSortEdgeArrays(net, self.deltaTime)
+        if netCache is not None:
+            key = persist.secHashObject((
+                codedep.getHash(buildAutoregressiveNet),
+                codedep.getHash(wnet.TopSortEdgeArrays),
+                self.netFor, input
+            ))
+            return netCache.get(key, build)
+        elif self.dense:
+            return build()
+        else:
+            return self.buildNet(input), None
+
     def getNet(self, input):
-        net0 = self.netFor(input)
-        net1 = wnet.MappedLabelNet(
-            lambda (phInput, phOutput): (False, phInput, phOutput),
-            net0
-        )
-        net2 = wnet.FlatMappedNet(
-            lambda phInput: wnet.TrivialNet((True, phInput)),
-            net1
-        )
-        def deltaTime(label):
-            return 0 if label is None or not label[0] else 1
-        net = wnet.concretizeNetTopSort(net2, deltaTime)
-        return net, deltaTime
-
-    def getTimedNet(self, input, outSeq, preComputeLabelToWeight = False):
-        net, deltaTime = self.getNet(input)
-        timedNet = wnet.UnrolledNet(net, startTime = 0, endTime = len(outSeq),
-                                    deltaTime = deltaTime)
-        labelToWeight = self.getLabelToWeight(outSeq)
-
-        if preComputeLabelToWeight:
-            times = range(len(outSeq) + 1)
-            times0 = zip(times, times)
-            times1 = zip(times, times[1:])
-            for node in wnet.nodeSetCompute(net, accessibleOnly = False):
-                for label, nextNode in net.next(node, forwards = True):
-                    delta = deltaTime(label)
-                    assert delta == 0 or delta == 1
-                    times0or1 = times0 if delta == 0 else times1
-                    for labelStartTime, labelEndTime in times0or1:
-                        labelToWeight((label, labelStartTime, labelEndTime))
+        net, edgeArrays = self.getConcreteNet(input)
+        return net, self.deltaTime
 
+    def getTimedNet(self, input, outSeq):
+        timedNet, edgeArrays, labelToWeight = self.getTimedNetArrays(input,
+                                                                     outSeq)
         return timedNet, labelToWeight
 
-    def getLabelToWeight(self, outSeq):
+    def getTimedNetArrays(self, input, outSeq, netCache = None):
+        net, edgeArrays = self.getConcreteNet(input, netCache = netCache)
+        timedNet = wnet.IntUnrolledNet(net, startTime = 0,
+                                       endTime = len(outSeq),
+                                       deltaTime = self.deltaTime)
+        if edgeArrays is not None:
+            labels = edgeArrays.labels0 + edgeArrays.labels1
+        else:
+            labels = [ label
+                       for node in range(net.numNodes)
+                       for label, nextNode in net.next(node, forwards = True) ]
+        labelToWeight = self.getLabelToWeight(outSeq, labels)
+        return timedNet, edgeArrays, labelToWeight
+
+    def getAcInputs(self, outSeq):
+        """Returns the acoustic context for each time 0, ..., len(outSeq)."""
         numFilled = len(self.fillFrames)
         outSeqFilled = self.fillFrames + outSeq
+        return [ outSeqFilled[max(time - self.depth + numFilled, 0):
+                              (time + numFilled)]
+                 for time in range(len(outSeq) + 1) ]
+
+    def getNumShortContext(self):
+        """Returns the number of initial times with a short acoustic context."""
+        return max(self.depth - len(self.fillFrames), 0)
+
+    def getLabelToWeight(self, outSeq, labels):
+        """Returns a function giving the log prob of each timed label.
+
+        The log probs for all the given (untimed) labels at all times are
+        precomputed and stored in numpy tables, one row per phonetic context
+        for emitting labels and one row per (phonetic context, phonetic
+        output) pair for duration labels. Each row is computed using a single
+        logProbBatch call (apart from any initial frames with shorter acoustic
+        context), and the returned function just does table lookups.
+        """
+        numFrames = len(outSeq)
+        acInputs = self.getAcInputs(outSeq)
+        numShort = self.getNumShortContext()
+
+        def computeRow(dist, phInput, outputs):
+            # (frames with shorter acoustic context are computed separately
+            #   so that batches contain inputs of a fixed size)
+            numShortHere = min(numShort, len(outputs))
+            lpsShort = [ dist.logProb((phInput, acInputs[time]), outputs[time])
+                         for time in range(numShortHere) ]
+            if len(outputs) > numShortHere:
+                lpsFull = dist.logProbBatch(
+                    [ (phInput, acInputs[time])
+                      for time in range(numShortHere, len(outputs)) ],
+                    outputs[numShortHere:]
+                )
+            else:
+                lpsFull = []
+            return np.concatenate([np.asarray(lpsShort, dtype = np.float64),
+                                   np.asarray(lpsFull, dtype = np.float64)])
+
+        acIndex = dict()
+        durIndex = dict()
+        for label in labels:
+            if label is None:
+                pass
+            elif not label[0]:
+                if label not in durIndex:
+                    durIndex[label] = len(durIndex)
+            else:
+                if label not in acIndex:
+                    acIndex[label] = len(acIndex)
+        acTable = np.empty((len(acIndex), numFrames))
+        for label, index in acIndex.iteritems():
+            _, phInput = label
+            acTable[index] = computeRow(self.acDist, phInput, outSeq)
+        durTable = np.empty((len(durIndex), numFrames + 1))
+        for label, index in durIndex.iteritems():
+            _, phInput, phOutput = label
+            durTable[index] = computeRow(self.durDist, phInput,
+                                         [phOutput] * (numFrames + 1))
+
         def timedLabelToLogProb((label, labelStartTime, labelEndTime)):
             if label is None:
                 return 0.0
+            elif not label[0]:
+                return float(durTable[durIndex[label], labelStartTime])
             else:
-                acInput = outSeqFilled[
-                    max(labelStartTime - self.depth + numFilled, 0):
-                    (labelStartTime + numFilled)
-                ]
-                if not label[0]:
-                    _, phInput, phOutput = label
-                    return self.durDist.logProb((phInput, acInput), phOutput)
-                else:
-                    _, phInput = label
-                    assert labelEndTime == labelStartTime + 1
-                    acOutput = outSeq[labelStartTime]
-                    return self.acDist.logProb((phInput, acInput), acOutput)
-        return memoize(timedLabelToLogProb)
-
-    def getAgenda(self, forwards):
-        def negMap((time, nodeIndex)):
-            return -time, -nodeIndex
-        def pruneTrigger(nodePrevPop, nodeCurrPop):
-            # compare times
-            return (nodePrevPop[0] != nodeCurrPop[0])
-        pruneThresh = (None if self.pruneSpec is None
-                       else self.pruneSpec.betaThresh)
-        agenda = wnet.PriorityQueueSumAgenda(self.ring, forwards,
-                                             negMap = negMap,
-                                             pruneThresh = pruneThresh,
-                                             pruneTrigger = pruneTrigger)
-        return agenda
+                assert labelEndTime == labelStartTime + 1
+                return float(acTable[acIndex[label], labelStartTime])
+        return timedLabelToLogProb
+
+    def getAgenda(self, timedNet):
+        """Returns a getAgenda function for timedNet (see getTimedNet)."""
+        return self.getAgendaForRing(self.ring, timedNet)
+
+    def getAgendaForRing(self, ring, timedNet):
+        """Returns a getAgenda function for the given ring and timedNet.
+
+        ring should be a semiring over log weights with a lift method (such
+        as LogRealsField, ViterbiSemiring or ExpectationSemiring), and
+        pruning is as specified by pruneSpec.
+        """
+        pruneThresh = (None if self.pruneSpec is None or
+                       self.pruneSpec.betaThresh is None
+                       else ring.lift(self.pruneSpec.betaThresh))
+        beamSize = (None if self.pruneSpec is None
+                    else getattr(self.pruneSpec, 'beamSize', None))
+        def getAgenda(forwards):
+            if pruneThresh is None and beamSize is None:
+                return wnet.PriorityQueueSumAgenda(
+                    ring, forwards, negMap = lambda node: -node
+                )
+            return wnet.BeamSumAgenda(
+                ring, forwards, pruneThresh = pruneThresh,
+                beamSize = beamSize,
+                nodeToTime = lambda node: timedNet.decode(node)[0]
+            )
+        return getAgenda
+
+    def forwardBackward(self, input, outSeq, netCache = None):
+        """Performs Forward-Backward algorithm for the given input and output.
+
+        Returns total log prob, an iterator over (timed label, logOcc) pairs
+        and the labelToWeight function used.
+        The engine used is determined by self.dense. netCache is as for
+        getConcreteNet.
+        """
+        timedNet, edgeArrays, labelToWeight = self.getTimedNetArrays(
+            input, outSeq, netCache = netCache
+        )
+        if self.dense:
+            totalLogProb, edgeGen = wnet.forwardBackwardDense(
+                timedNet,
+                labelToWeight = labelToWeight,
+                edgeArrays = edgeArrays
+            )
+        else:
+            totalLogProb, edgeGen = wnet.forwardBackwardAlt(
+                timedNet,
+                labelToWeight = labelToWeight,
+                divisionRing = self.ring,
+                getAgenda = self.getAgenda(timedNet)
+            )
+        return totalLogProb, edgeGen, labelToWeight
 
     def logProb(self, (uttId, input), outSeq):
-        timedNet, labelToWeight = self.getTimedNet(input, outSeq)
-        totalLogProb = wnet.sum(timedNet, labelToWeight = labelToWeight,
-                                ring = self.ring, getAgenda = self.getAgenda)
+        timedNet, edgeArrays, labelToWeight = self.getTimedNetArrays(input,
+                                                                     outSeq)
+        if self.dense:
+            weights0, weights1 = wnet.getDenseWeights(timedNet, labelToWeight,
+                                                      edgeArrays)
+            totalLogProb, _ = wnet.sumGetAlphaDense(edgeArrays, weights0,
+                                                    weights1)
+        else:
+            totalLogProb = wnet.sum(timedNet, labelToWeight = labelToWeight,
+                                    ring = self.ring,
+                                    getAgenda = self.getAgenda(timedNet))
         return totalLogProb
 
+    def viterbi(self, (uttId, input), outSeq):
+        """Finds the best path through the unrolled net.
+
+        Returns the log prob of the best path and the list of timed labels
+        (label, labelStartTime, labelEndTime) along it.
+        Pruning (if any) is as specified by pruneSpec.
+        """
+        bestLogProb, path = self.viterbiPath((uttId, input), outSeq)
+        return bestLogProb, [ timedLabel for timedLabel, node in path ]
+
+    def viterbiPath(self, (uttId, input), outSeq):
+        """Finds the best path through the unrolled net.
+
+        Returns the log prob of the best path and the list of
+        (timed label, node) pairs along it, where node is the node of the
+        concretized net (see getConcreteNet) that the labelled edge leaves.
+        Pruning (if any) is as specified by pruneSpec.
+        """
+        ring = semiring.ViterbiSemiring()
+        net, _ = self.getConcreteNet(input)
+        # (label each edge with the node it leaves)
+        nodeNet = wnet.ConcreteNet(
+            startNode = net.start(forwards = True),
+            endNode = net.end(forwards = True),
+            elems = [ net.elem(node) for node in range(net.numNodes) ],
+            edgesForwards = [
+                [ ((label, node), nextNode)
+                  for label, nextNode in net.next(node, forwards = True) ]
+                for node in range(net.numNodes)
+            ]
+        )
+        timedNet = wnet.IntUnrolledNet(
+            nodeNet, startTime = 0, endTime = len(outSeq),
+            deltaTime = lambda (label, node): self.deltaTime(label)
+        )
+        labelToLogProb = self.getLabelToWeight(
+            outSeq,
+            [ label
+              for node in range(net.numNodes)
+              for label, nextNode in net.next(node, forwards = True) ]
+        )
+        def labelToWeight(((label, node), labelStartTime, labelEndTime)):
+            timedLabel = label, labelStartTime, labelEndTime
+            return ring.lift(labelToLogProb(timedLabel), [(timedLabel, node)])
+        best = wnet.sum(timedNet, labelToWeight = labelToWeight, ring = ring,
+                        getAgenda = self.getAgendaForRing(ring, timedNet))
+        bestLogProb, _ = best
+        return bestLogProb, ring.traceback(best)
+
+    def viterbiAlign(self, (uttId, input), outSeq):
+        """Returns the best two-level alignment of outSeq.
+
+        Phonetic contexts should be (label, subLabel) pairs, as for
+        SimpleLeftToRightNetFor. The alignment is a list of
+        (startTime, endTime, label, subAlignment) segments, where subAlignment
+        is a list of (startTime, endTime, subLabel, None) segments (see
+        alignment.py for details of this format). Each state-level segment
+        consists of the consecutive frames emitted from a single node of the
+        net along the best path, so repeated labels give separate segments.
+        A new label-level segment starts whenever label changes or a subLabel
+        is repeated within the current segment, since each subLabel of a
+        left-to-right label is visited at most once.
+        """
+        bestLogProb, path = self.viterbiPath((uttId, input), outSeq)
+        if bestLogProb == float('-inf'):
+            raise RuntimeError('no path through net for utterance %s' % uttId)
+        states = []
+        nodePrev = None
+        for (label, labelStartTime, labelEndTime), node in path:
+            if label is not None and label[0]:
+                _, phInput = label
+                if states and node == nodePrev:
+                    startTime, _, _ = states.pop()
+                else:
+                    startTime = labelStartTime
+                states.append((startTime, labelEndTime, phInput))
+                nodePrev = node
+        alignment = []
+        for startTime, endTime, (label, subLabel) in states:
+            if (alignment and alignment[-1][2] == label and
+                    subLabel not in [ subLabelPrev for _, _, subLabelPrev, _
+                                      in alignment[-1][3] ]):
+                labelStartTime, _, _, subAlignment = alignment.pop()
+            else:
+                labelStartTime, subAlignment = startTime, []
+            subAlignment.append((startTime, endTime, subLabel, None))
+            alignment.append((labelStartTime, endTime, label, subAlignment))
+        return alignment
+
+    def expectedSum(self, input, outSeq, labelToValue):
+        """Computes the posterior expectation of a sum over timed labels.
+
+        labelToValue gives an additive value (a float or numpy array) for each
+        timed label (label, labelStartTime, labelEndTime), and the expected
+        value of the sum of these values along a path through the unrolled
+        net is computed using the expectation semiring in a single forwards
+        pass. Returns the total log prob and the expected value (which is 0.0
+        if there is no path through the net).
+        Pruning (if any) is as specified by pruneSpec.
+        """
+        ring = semiring.ExpectationSemiring()
+        timedNet, labelToLogProb = self.getTimedNet(input, outSeq)
+        def labelToWeight(label):
+            return ring.lift(labelToLogProb(label), labelToValue(label))
+        totalLogProb, value = wnet.sum(
+            timedNet, labelToWeight = labelToWeight, ring = ring,
+            getAgenda = self.getAgendaForRing(ring, timedNet)
+        )
+        return totalLogProb, value
+
     def logProbDerivOutput(self, (uttId, input), outSeq):
-        # FIXME : complete
-        notyetimplemented
+        """Computes the derivative of logProb with respect to outSeq.
+
+        The derivative is the sum over timed labels of the posterior
+        occupancy of the label times the derivative of its log prob. The
+        occupancies are computed using forwardBackward, and each label only
+        affects the frames in its acoustic context, so the derivative is
+        accumulated in place into a single array, in time proportional to
+        the number of timed labels times depth.
+        """
+        acInputs = self.getAcInputs(outSeq)
+        deriv = np.zeros(np.shape(np.asarray(outSeq, dtype = np.float64)))
+
+        def addContextDeriv(time, occ, contextDeriv):
+            # (the last min(time, depth) frames of the acoustic context at
+            #   time are the preceding frames of outSeq)
+            numOut = min(time, self.depth)
+            if numOut > 0:
+                deriv[(time - numOut):time] += (
+                    occ * np.asarray(contextDeriv)[-numOut:]
+                )
+
+        _, edgeGen, _ = self.forwardBackward(input, outSeq)
+        for (label, labelStartTime, labelEndTime), logOcc in edgeGen:
+            if label is None:
+                continue
+            occ = math.exp(logOcc)
+            time = labelStartTime
+            if not label[0]:
+                _, phInput, phOutput = label
+                durInput = phInput, acInputs[time]
+                addContextDeriv(
+                    time, occ,
+                    self.durDist.logProbDerivInput(durInput, phOutput)
+                )
+            else:
+                _, phInput = label
+                acInput = phInput, acInputs[time]
+                deriv[time] += occ * np.asarray(
+                    self.acDist.logProbDerivOutput(acInput, outSeq[time])
+                )
+                addContextDeriv(
+                    time, occ,
+                    self.acDist.logProbDerivInput(acInput, outSeq[time])
+                )
+        return deriv
 
     def arError(self, (uttId, input), outSeq, distError):
-        # FIXME : complete (compute using expectation semiring?)
-        notyetimplemented
+        """Computes the expected error of acDist over the utterance.
 
-    def createAcc(self, createAccChild, verbosity = 0):
+        distError(dist, input, output) gives the error (a float or numpy
+        array) for a single frame, and is called with acDist for each
+        emitting label and time. The error is summed over frames and
+        the expectation is taken over the posterior distribution of paths
+        through the unrolled net.
+        """
+        acInputs = self.getAcInputs(outSeq)
+
+        def labelToValue((label, labelStartTime, labelEndTime)):
+            if label is None or not label[0]:
+                return 0.0
+            _, phInput = label
+            return distError(self.acDist, (phInput, acInputs[labelStartTime]),
+                             outSeq[labelStartTime])
+
+        _, error = self.expectedSum(input, outSeq, labelToValue)
+        return error
+
+    def createAcc(self, createAccChild, verbosity = 0, latticeDir = None,
+                  replayLattices = False, netCache = None):
         return AutoregressiveNetAcc(
             distPrev = self,
             durAcc = createAccChild(self.durDist),
             acAcc = createAccChild(self.acDist),
             verbosity = verbosity,
+            latticeDir = latticeDir,
+            replayLattices = replayLattices,
+            netCache = netCache,
             tag = self.tag
         )
 
@@ -3382,7 +4960,8 @@ class AutoregressiveNetDist(Dist):
         distNew = AutoregressiveNetDist(self.depth, self.netFor,
                                         self.fillFrames,
                                         durDist, acDist,
-                                        self.pruneSpec, tag = self.tag)
+                                        self.pruneSpec, dense = self.dense,
+                                        tag = self.tag)
         return distNew, paramsLeft
 
 @codeDeps(GaussianVecAcc, LinearGaussianAcc, LinearGaussianVec,
@@ -5,36 +5,159 @@
 # This file is part of armspeech.
 # See `License` for details of license and warranty.
 
+import multiprocessing
+import numpy as np
+
 from codedep import codeDeps
-from bisque.distribute import liftLocal, lit, lift
+from bisque.distribute import liftLocal, lit, lift, lazy
 
 import armspeech.modelling.dist as d
 
-@codeDeps()
-def accumulate(distPrev, corpus, uttIds, createAcc):
+@codeDeps(d.getAccArena)
+def accumulateChunk(distPrev, corpus, uttIds, createAcc, useArena = False):
+    """Accumulates over the given utterances in the current process."""
     acc = createAcc(distPrev)
     for uttId in uttIds:
         input, output = corpus.data(uttId)
         acc.add(input, output)
+    if useArena:
+        arena = d.getAccArena(acc)
+        if arena is not None:
+            return arena
     return acc
 
-@codeDeps(accumulate, d.getDefaultCreateAcc, lift, liftLocal)
+@codeDeps()
+class AccumulateWorkerState(object):
+    """State of an accumulation worker process (set by initAccumulateWorker).
+
+    args is a (distPrev, corpus, createAcc) triple.
+    """
+    args = None
+
+@codeDeps(AccumulateWorkerState)
+def initAccumulateWorker(distPrev, corpus, createAcc):
+    AccumulateWorkerState.args = distPrev, corpus, createAcc
+
+@codeDeps(AccumulateWorkerState, accumulateChunk)
+def accumulateWorker(uttIds):
+    distPrev, corpus, createAcc = AccumulateWorkerState.args
+    return accumulateChunk(distPrev, corpus, uttIds, createAcc,
+                           useArena = True)
+
+@codeDeps(accumulateChunk, accumulateWorker, d.addAccs, d.getAccArena,
+    initAccumulateWorker
+)
+def accumulate(distPrev, corpus, uttIds, createAcc, useArena = False,
+               numWorkers = 1):
+    """Accumulates over the given utterances.
+
+    If useArena is True then the statistics are returned as an AccArena where
+    the acc supports this, which is much quicker to pickle and to merge.
+
+    If numWorkers is greater than 1 then the utterances are split between a
+    pool of numWorkers worker processes, each of which accumulates into its own
+    acc created using createAcc(distPrev), and the worker accs are then summed
+    using d.addAccs. Worker processes are forked, so distPrev, corpus and
+    createAcc are not pickled, but each worker acc is pickled (as an AccArena
+    where possible) to be sent back.
+    """
+    uttIds = list(uttIds)
+    numChunks = min(numWorkers, len(uttIds))
+    if numChunks <= 1:
+        return accumulateChunk(distPrev, corpus, uttIds, createAcc,
+                               useArena = useArena)
+
+    uttIdChunks = [ uttIds[start::numChunks] for start in range(numChunks) ]
+    pool = multiprocessing.Pool(numChunks, initializer = initAccumulateWorker,
+                                initargs = (distPrev, corpus, createAcc))
+    try:
+        accsFrom = pool.map(accumulateWorker, uttIdChunks)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    acc = createAcc(distPrev)
+    d.addAccs(acc, accsFrom)
+    if useArena:
+        arena = d.getAccArena(acc)
+        if arena is not None:
+            return arena
+    return acc
+
+@codeDeps(accumulate, d.getDefaultCreateAcc, lift, liftLocal, lit)
 def accumulateJobSet(
     distPrevArt,
     corpusArt,
     uttIdChunkArts,
     createAccArt = liftLocal(d.getDefaultCreateAcc)(),
+    useArenaArt = lit(False),
+    numWorkersArt = lit(1),
 ):
     accArts = [ lift(accumulate)(distPrevArt, corpusArt, uttIdChunkArt,
-                                 createAccArt)
+                                 createAccArt, useArenaArt, numWorkersArt)
                 for uttIdChunkArt in uttIdChunkArts ]
     return accArts
 
-@codeDeps(d.addAcc)
+@codeDeps(d.AccArena, d.addAcc)
+def reduceAccs(distPrev, createAcc, *accThunks):
+    """Sums accs, loading each one only when it is needed.
+
+    Each of accThunks should be a function with no arguments returning an acc
+    or an AccArena (for example the value of a LazyArtifact), so that at most
+    one input acc is in memory at any one time in addition to the running
+    total.
+    If all the inputs are AccArenas then the result is an AccArena.
+    """
+    accTot = None
+    arenaTot = None
+    for accThunk in accThunks:
+        acc = accThunk()
+        if isinstance(acc, d.AccArena):
+            if arenaTot is None:
+                arenaTot = d.AccArena(acc.layout, np.copy(acc.buffer))
+            else:
+                arenaTot.addArena(acc)
+        else:
+            if accTot is None:
+                accTot = createAcc(distPrev)
+            d.addAcc(accTot, acc)
+        del acc
+    if accTot is None:
+        return arenaTot
+    if arenaTot is not None:
+        arenaTot.addToAcc(accTot)
+    return accTot
+
+@codeDeps(d.getDefaultCreateAcc, lazy, lift, liftLocal, lit, reduceAccs)
+def reduceAccsJobSet(
+    distPrevArt,
+    accArts,
+    createAccArt = liftLocal(d.getDefaultCreateAcc)(),
+    fanoutArt = lit(2),
+):
+    """Returns job set to sum accs using a tree of jobs.
+
+    Each job sums at most fanout accs, loading them lazily one at a time, so
+    peak memory use per job does not grow with the number of accs.
+    Returns a single artifact whose value is the summed acc.
+    """
+    fanout = fanoutArt.litValue
+    assert fanout >= 2
+    assert len(accArts) >= 1
+    while len(accArts) > 1:
+        accArts = [
+            lift(reduceAccs)(distPrevArt, createAccArt,
+                             *[ lazy(accArt)
+                                for accArt in accArts[start:(start + fanout)] ])
+            for start in range(0, len(accArts), fanout)
+        ]
+    accArt, = accArts
+    return accArt
+
+@codeDeps(d.addAccs)
 def estimate(distPrev, createAcc, estimateDist, afterAcc, verbosity, *accs):
     accTot = createAcc(distPrev)
-    for acc in accs:
-        d.addAcc(accTot, acc)
+    d.addAccs(accTot, accs)
     if afterAcc is not None:
         afterAcc(accTot)
     logLikePrev = accTot.logLike()
@@ -62,12 +185,11 @@ def estimateJobSet(
         *accArts
     )
 
-@codeDeps(d.Rat, d.addAcc)
+@codeDeps(d.Rat, d.addAccs)
 def estimateWithTotAux(distPrev, createAcc, estimateTotAux, afterAcc,
                        monotoneAux, verbosity, *accs):
     accTot = createAcc(distPrev)
-    for acc in accs:
-        d.addAcc(accTot, acc)
+    d.addAccs(accTot, accs)
     if afterAcc is not None:
         afterAcc(accTot)
     logLikePrev = accTot.logLike()
@@ -103,7 +225,7 @@ def estimateWithTotAuxJobSet(
     )
 
 @codeDeps(accumulateJobSet, d.getDefaultCreateAcc, d.getDefaultEstimateTotAux,
-    estimateWithTotAuxJobSet, liftLocal, lit
+    estimateWithTotAuxJobSet, liftLocal, lit, reduceAccsJobSet
 )
 def expectationMaximizationJobSet(
     distPrevArt,
@@ -114,10 +236,22 @@ def expectationMaximizationJobSet(
     afterAccArt = lit(None),
     monotoneAuxArt = lit(True),
     verbosityArt = lit(0),
+    useArenaArt = lit(False),
+    reduceFanoutArt = lit(None),
+    numWorkersArt = lit(1),
 ):
-    """Returns job set to perform one step of expectation maximization."""
+    """Returns job set to perform one step of expectation maximization.
+
+    If reduceFanoutArt is not lit(None) then the chunk accs are summed using
+    reduceAccsJobSet with this fanout before estimation.
+    numWorkersArt specifies the number of worker processes used within each
+    accumulation job (see accumulate).
+    """
     accArts = accumulateJobSet(distPrevArt, corpusArt, uttIdChunkArts,
-                               createAccArt)
+                               createAccArt, useArenaArt, numWorkersArt)
+    if reduceFanoutArt.litValue is not None:
+        accArts = [reduceAccsJobSet(distPrevArt, accArts, createAccArt,
+                                    reduceFanoutArt)]
     distArt = estimateWithTotAuxJobSet(distPrevArt, accArts, createAccArt,
                                        estimateTotAuxArt, afterAccArt,
                                        monotoneAuxArt, verbosityArt)
@@ -136,6 +270,9 @@ def trainEMJobSet(
     afterAccArt = lit(None),
     monotoneAuxArt = lit(True),
     verbosityArt = lit(0),
+    useArenaArt = lit(False),
+    reduceFanoutArt = lit(None),
+    numWorkersArt = lit(1),
 ):
     numIterations = numIterationsLit.litValue
     distArt = distInitArt
@@ -143,5 +280,7 @@ def trainEMJobSet(
         distArt = expectationMaximizationJobSet(distArt, corpusArt,
                                                 uttIdChunkArts, createAccArt,
                                                 estimateTotAuxArt, afterAccArt,
-                                                monotoneAuxArt, verbosityArt)
+                                                monotoneAuxArt, verbosityArt,
+                                                useArenaArt, reduceFanoutArt,
+                                                numWorkersArt)
     return distArt
@@ -0,0 +1,127 @@
+"""Representation and I/O for lattices of edge posteriors."""
+
+# Copyright 2011, 2012, 2013, 2014, 2015 Matt Shannon
+
+# This file is part of armspeech.
+# See `License` for details of license and warranty.
+
+import os
+import struct
+import tempfile
+import cPickle as pickle
+from itertools import izip
+import numpy as np
+
+from codedep import codeDeps
+
+import armspeech.numpy_settings
+
+@codeDeps()
+class Lattice(object):
+    """A collection of timed labels together with their log occupancies.
+
+    Stores the (typically pruned) edge posteriors computed by Forward-Backward
+    for one utterance, as (label, labelStartTime, labelEndTime) timed labels
+    and their log occupancies, along with the entropy of the posterior
+    distribution over paths.
+    Each distinct label is stored once, and timed labels refer to labels by
+    index.
+    numFrames is the number of frames in the utterance, and distHash and
+    netHash are hashes identifying the dist used to compute the lattice and
+    the net and acoustic context structure its labels refer to (see
+    AutoregressiveNetAcc), so that stale lattices can be detected on replay.
+    """
+    # (magic string and header format used by writeLattice and readLattice)
+    magic = 'ARMLAT02'
+    headerFormat = '<dqqq40s40s'
+
+    def __init__(self, entropy = 0.0, labels = None, labelIndices = None,
+                 startTimes = None, endTimes = None, logOccs = None,
+                 numFrames = 0, distHash = '', netHash = ''):
+        self.entropy = entropy
+        self.labels = [] if labels is None else labels
+        self.labelIndices = [] if labelIndices is None else labelIndices
+        self.startTimes = [] if startTimes is None else startTimes
+        self.endTimes = [] if endTimes is None else endTimes
+        self.logOccs = [] if logOccs is None else logOccs
+        self.numFrames = numFrames
+        self.distHash = distHash
+        self.netHash = netHash
+
+        self.labelToIndex = dict([ (label, index)
+                                   for index, label in enumerate(self.labels) ])
+
+    def __len__(self):
+        return len(self.logOccs)
+
+    def add(self, (label, labelStartTime, labelEndTime), logOcc):
+        if label not in self.labelToIndex:
+            self.labelToIndex[label] = len(self.labels)
+            self.labels.append(label)
+        self.labelIndices.append(self.labelToIndex[label])
+        self.startTimes.append(labelStartTime)
+        self.endTimes.append(labelEndTime)
+        self.logOccs.append(logOcc)
+
+    def edges(self):
+        """Returns an iterator over (timed label, logOcc) pairs."""
+        for labelIndex, labelStartTime, labelEndTime, logOcc in izip(
+            self.labelIndices, self.startTimes, self.endTimes, self.logOccs
+        ):
+            yield ((self.labels[labelIndex], int(labelStartTime),
+                    int(labelEndTime)), float(logOcc))
+
+@codeDeps(Lattice)
+def writeLattice(lattice, fileName):
+    """Writes lattice to fileName in a compact binary format.
+
+    The format is a short header (including the entropy, number of edges,
+    number of frames and hashes), the pickled list of distinct labels, and
+    then the label indices, start times and end times as little-endian 32-bit
+    integer arrays and the log occupancies as a little-endian 64-bit float
+    array.
+    The lattice is written to a temporary file which is then moved into
+    place, so fileName is never left partially written.
+    """
+    labelsString = pickle.dumps(lattice.labels, protocol = 2)
+    head, tail = os.path.split(fileName)
+    with tempfile.NamedTemporaryFile(prefix = '.'+tail+'.', dir = head,
+                                     mode = 'wb', delete = False) as f:
+        tempFileName = f.name
+        f.write(Lattice.magic)
+        f.write(struct.pack(Lattice.headerFormat, lattice.entropy,
+                            len(lattice), len(labelsString),
+                            lattice.numFrames, lattice.distHash,
+                            lattice.netHash))
+        f.write(labelsString)
+        for values, dtype in [(lattice.labelIndices, '<i4'),
+                              (lattice.startTimes, '<i4'),
+                              (lattice.endTimes, '<i4'),
+                              (lattice.logOccs, '<f8')]:
+            f.write(np.asarray(values, dtype = dtype).tostring())
+    # (move into place atomically (at least on linux))
+    os.rename(tempFileName, fileName)
+
+@codeDeps(Lattice)
+def readLattice(fileName):
+    """Reads a lattice written by writeLattice."""
+    with open(fileName, 'rb') as f:
+        magic = f.read(len(Lattice.magic))
+        if magic != Lattice.magic:
+            raise RuntimeError('%s is not a lattice file' % fileName)
+        (entropy, numEdges, labelsLength, numFrames, distHash,
+         netHash) = struct.unpack(
+            Lattice.headerFormat, f.read(struct.calcsize(Lattice.headerFormat))
+        )
+        labels = pickle.loads(f.read(labelsLength))
+        labelIndices, startTimes, endTimes, logOccs = [
+            np.fromstring(f.read(numEdges * np.dtype(dtype).itemsize),
+                          dtype = dtype)
+            for dtype in ['<i4', '<i4', '<i4', '<f8']
+        ]
+        if len(logOccs) != numEdges:
+            raise RuntimeError('lattice file %s is truncated' % fileName)
+    return Lattice(entropy, labels, labelIndices, startTimes, endTimes,
+                   logOccs, numFrames = numFrames,
+                   distHash = distHash.rstrip('\0'),
+                   netHash = netHash.rstrip('\0'))
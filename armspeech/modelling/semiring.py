@@ -7,9 +7,13 @@
 
 from __future__ import division
 
+import math
+import numpy as np
+
 from codedep import codeDeps
 
 from armspeech.util.mathhelp import logAdd, logSum
+import armspeech.numpy_settings
 
 # N.B. ldivide should be such that ring.times(a, ring.ldivide(a, b)) == b
 #   (so ldivide(a, b) == a^{-1} b if a is invertible)
@@ -51,6 +55,9 @@ class LogRealsField(object):
     @property
     def one(self):
         return 0.0
+    def lift(self, logWeight):
+        """Returns the element with the given log weight."""
+        return logWeight
     def plus(self, a, b):
         return logAdd(a, b)
     def sum(self, it):
@@ -69,3 +76,135 @@ class LogRealsField(object):
         return a < b
     def max(self, it):
         return max(it)
+
+@codeDeps()
+class MaxPlusSemiring(object):
+    """The tropical (max-plus) semiring over log weights.
+
+    Summing over paths in this semiring gives the log weight of the best path.
+    """
+    @property
+    def zero(self):
+        return float('-inf')
+    @property
+    def one(self):
+        return 0.0
+    def plus(self, a, b):
+        return max(a, b)
+    def sum(self, it):
+        return max(it) if it else self.zero
+    def times(self, a, b):
+        return a + b
+    def inv(self, a):
+        return -a
+    def divide(self, a, b):
+        return a - b
+    def ldivide(self, a, b):
+        return b - a
+    def isClose(self, a, b):
+        return abs(a - b) < 1e-8
+    def lt(self, a, b):
+        return a < b
+    def max(self, it):
+        return max(it)
+
+@codeDeps()
+class ViterbiSemiring(object):
+    """The max-plus semiring with backpointer tracking.
+
+    Elements are (logWeight, backpointer) pairs, where backpointer encodes the
+    sequence of items along the best path as a linked list of
+    (backpointer, item) pairs ending with None. Summing over paths in this
+    semiring gives the log weight of the best path together with a
+    backpointer from which the best path can be recovered using traceback.
+    Ties are broken in favour of the first argument to plus.
+    """
+    @property
+    def zero(self):
+        return float('-inf'), None
+    @property
+    def one(self):
+        return 0.0, None
+    def lift(self, logWeight, items = []):
+        """Returns the element with the given log weight and path."""
+        back = None
+        for item in items:
+            back = back, item
+        return logWeight, back
+    def traceback(self, (logWeight, back)):
+        """Returns the list of items on the path for the given element."""
+        items = []
+        while back is not None:
+            back, item = back
+            items.append(item)
+        return list(reversed(items))
+    def plus(self, a, b):
+        return a if a[0] >= b[0] else b
+    def sum(self, it):
+        return reduce(self.plus, it, self.zero)
+    def times(self, (logWeightA, backA), (logWeightB, backB)):
+        logWeight = logWeightA + logWeightB
+        if logWeight == float('-inf'):
+            return self.zero
+        items = []
+        while backB is not None:
+            backB, item = backB
+            items.append(item)
+        back = backA
+        for item in reversed(items):
+            back = back, item
+        return logWeight, back
+    def isClose(self, a, b):
+        return abs(a[0] - b[0]) < 1e-8
+    def lt(self, a, b):
+        return a[0] < b[0]
+    def max(self, it):
+        return max(it, key = lambda (logWeight, back): logWeight)
+
+@codeDeps(logAdd)
+class ExpectationSemiring(object):
+    """The expectation (first-order) semiring over log weights.
+
+    Elements are (logWeight, value) pairs, where value is the expected value,
+    under the distribution over paths given by the weights, of the sum of the
+    values of the edges along a path. value may be a float or a numpy array.
+    Summing over paths in this semiring gives the total log weight together
+    with the posterior expectation of the additive path value in a single
+    pass. In particular if each edge value is the derivative of the log
+    weight of that edge then the expectation is the derivative of the total
+    log weight.
+
+    (Values are stored normalized by the weight rather than as weighted sums
+    to avoid overflow.)
+    """
+    @property
+    def zero(self):
+        return float('-inf'), 0.0
+    @property
+    def one(self):
+        return 0.0, 0.0
+    def lift(self, logWeight, value = 0.0):
+        """Returns the element with the given log weight and value."""
+        return logWeight, value
+    def plus(self, (logWeightA, valueA), (logWeightB, valueB)):
+        if logWeightA == float('-inf'):
+            return logWeightB, valueB
+        elif logWeightB == float('-inf'):
+            return logWeightA, valueA
+        logWeight = logAdd(logWeightA, logWeightB)
+        return logWeight, (math.exp(logWeightA - logWeight) * valueA +
+                           math.exp(logWeightB - logWeight) * valueB)
+    def sum(self, it):
+        return reduce(self.plus, it, self.zero)
+    def times(self, (logWeightA, valueA), (logWeightB, valueB)):
+        logWeight = logWeightA + logWeightB
+        if logWeight == float('-inf'):
+            return self.zero
+        return logWeight, valueA + valueB
+    def isClose(self, a, b):
+        return (abs(a[0] - b[0]) < 1e-8 and
+                np.allclose(a[1], b[1], rtol = 1e-8, atol = 1e-8))
+    def lt(self, a, b):
+        return a[0] < b[0]
+    def max(self, it):
+        return max(it, key = lambda (logWeight, value): logWeight)
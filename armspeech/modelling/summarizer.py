@@ -12,6 +12,7 @@ import numpy as np
 from codedep import codeDeps
 
 import armspeech.modelling.dist as d
+from armspeech.util.iterhelp import StreamContext
 import armspeech.numpy_settings
 
 @codeDeps()
@@ -49,7 +50,9 @@ class IdentitySummarizer(object):
         vectorSummarizer = ContextualVectorSummarizer(self) if contextual else self
         return d.createVectorAcc(self.order, self.outIndices, vectorSummarizer, createAccForIndex)
 
-@codeDeps(ContextualVectorSummarizer, d.createVectorAcc, d.createVectorDist)
+@codeDeps(ContextualVectorSummarizer, StreamContext, d.createVectorAcc,
+    d.createVectorDist
+)
 class VectorSeqSummarizer(object):
     def __init__(self, order, depths, strictAboutDepth = True):
         self.order = order
@@ -66,7 +69,11 @@ class VectorSeqSummarizer(object):
             raise RuntimeError('input to summarize is too short (length of input '+str(len(input))+' < specified depth '+str(depth)+')')
         startSummaryIndex = max(len(input) - depth, 0)
         endSummaryIndex = len(input)
-        summary = [ v[outIndex] for v in input[startSummaryIndex:endSummaryIndex] ]
+        if isinstance(input, StreamContext):
+            # (packed context, so take a slice of the array for this stream)
+            summary = input.stream(outIndex)[startSummaryIndex:endSummaryIndex]
+        else:
+            summary = [ v[outIndex] for v in input[startSummaryIndex:endSummaryIndex] ]
         return summary
 
     def createDist(self, contextual, createDistForIndex):
@@ -7,9 +7,12 @@
 
 import unittest
 import logging
-from collections import deque
+from collections import deque, defaultdict
 import math
 import random
+import os
+import shutil
+import tempfile
 import numpy as np
 from numpy.random import randn, randint
 import numpy.linalg as la
@@ -27,11 +30,14 @@ from armspeech.modelling import summarizer
 import armspeech.modelling.transform as xf
 from armspeech.modelling import cluster
 from armspeech.modelling import wnet
+from armspeech.modelling.alignment import checkAlignment
+from armspeech.modelling.lattice import readLattice
 from armspeech.util.mathhelp import logSum
 from armspeech.util.iterhelp import chunkList
 from armspeech.util.mathhelp import assert_allclose
 from armspeech.util.mathhelp import AsArray
-from armspeech.util.util import MapElem
+from armspeech.util.memoize import LruCache
+from armspeech.util.util import MapElem, ElemGetter
 from armspeech.modelling import test_transform_questions
 from armspeech.modelling import test_transform
 import armspeech.numpy_settings
@@ -338,12 +344,12 @@ def gen_stable_autoregressive_dist(depth = 2):
 @codeDeps(d.AutoregressiveSequenceDist, d.createDiscreteDist,
     gen_stable_autoregressive_dist, randTag, randUttId, xf.IdentityTransform
 )
-def gen_AutoregressiveSequenceDist(depth = 2):
+def gen_AutoregressiveSequenceDist(depth = 2, packContext = False):
     labels = string.lowercase[:randint(1, 10)]
     acDist = d.createDiscreteDist(labels, lambda label:
         gen_stable_autoregressive_dist(depth)[0]
     )
-    dist = d.AutoregressiveSequenceDist(depth, xf.IdentityTransform(), [ 0.0 for i in range(depth) ], acDist).withTag(randTag())
+    dist = d.AutoregressiveSequenceDist(depth, xf.IdentityTransform(), [ 0.0 for i in range(depth) ], acDist, packContext = packContext).withTag(randTag())
 
     def getInputGen():
         while True:
@@ -353,6 +359,50 @@ def gen_AutoregressiveSequenceDist(depth = 2):
     inputGen = getInputGen()
     return dist, getInputGen()
 
+@codeDeps(AsArray, ElemGetter, d.AutoregressiveSequenceDist,
+    d.BinaryLogisticClassifier, d.FixedValueDist, d.IdentifiableMixtureDist,
+    d.LinearGaussian, d.MappedInputDist, randTag, randUttId,
+    summarizer.IndexSpecSummarizer, summarizer.VectorSeqSummarizer, xf.AddBias,
+    xf.IdentityTransform, xf.Msd01ToVector
+)
+def gen_multiStream_AutoregressiveSequenceDist(depth = 2, mgcOrder = 3, packContext = False):
+    """Generates a dist over sequences of (mgc, lf0, bap)-style frames.
+
+    Here mgc is a vector, lf0 is an MSD element and bap is a scalar.
+    """
+    def getLinearGaussian(inputLength):
+        return d.LinearGaussian(coeff = randn(inputLength) * 0.2, variance = math.exp(randn()), varianceFloor = 0.0)
+    frameSummarizer = summarizer.VectorSeqSummarizer(order = 3, depths = {0: depth, 1: depth, 2: depth})
+    mgcSummarizer = summarizer.IndexSpecSummarizer(range(mgcOrder), fromOffset = 0, toOffset = 0, order = mgcOrder, depth = depth)
+    streamDists = [
+        mgcSummarizer.createDist(False, lambda outIndex:
+            d.MappedInputDist(xf.AddBias(),
+                getLinearGaussian(mgcSummarizer.vectorLength(outIndex) + 1)
+            )
+        ),
+        d.MappedInputDist(xf.Msd01ToVector(),
+            d.MappedInputDist(xf.AddBias(),
+                d.IdentifiableMixtureDist(
+                    d.BinaryLogisticClassifier(coeff = randn(2 * depth + 1) * 0.2, coeffFloor = np.ones((2 * depth + 1,)) * 5.0),
+                    [d.FixedValueDist(None), getLinearGaussian(2 * depth + 1)]
+                )
+            )
+        ),
+        d.MappedInputDist(AsArray(), getLinearGaussian(depth)),
+    ]
+    dist = d.AutoregressiveSequenceDist(depth, xf.IdentityTransform(),
+        [ (np.zeros((mgcOrder,)), (0, None), 0.0) for i in range(depth) ],
+        frameSummarizer.createDist(True, lambda streamIndex:
+            d.MappedInputDist(ElemGetter(1, 2), streamDists[streamIndex])
+        ),
+        packContext = packContext
+    ).withTag(randTag())
+
+    def getInputGen():
+        while True:
+            yield randUttId(), [ None for i in range(randint(0, 10)) ]
+    return dist, getInputGen()
+
 @codeDeps(wnet.ConcreteNet)
 def add_autoregressive_style_labels(concreteNet, genLabels):
     net = concreteNet
@@ -459,8 +509,8 @@ def gen_constant_AutoregressiveNetDist(depth = 2):
     acDist = d.createDiscreteDist(list(phInputsAc), lambda phInput:
         gen_stable_autoregressive_dist(depth)[0]
     )
-    pruneSpec = None if randBool() else d.SimplePruneSpec(betaThresh = (None if randBool() else 1000.0), logOccThresh = (None if randBool() else 1000.0))
-    dist = d.AutoregressiveNetDist(depth, xf.ConstantTransform(net), [ 0.0 for i in range(depth) ], durDist, acDist, pruneSpec).withTag(randTag())
+    pruneSpec = None if randBool() else d.SimplePruneSpec(betaThresh = (None if randBool() else 1000.0), logOccThresh = (None if randBool() else 1000.0), beamSize = (None if randBool() else 1000))
+    dist = d.AutoregressiveNetDist(depth, xf.ConstantTransform(net), [ 0.0 for i in range(depth) ], durDist, acDist, pruneSpec, dense = randBool()).withTag(randTag())
 
     def getInputGen():
         while True:
@@ -485,8 +535,8 @@ def gen_inSeq_AutoregressiveNetDist(depth = 2):
     acDist = d.createDiscreteDist(labelledSubLabels, lambda (label, subLabel):
         gen_stable_autoregressive_dist(depth)[0]
     )
-    pruneSpec = None if randBool() else d.SimplePruneSpec(betaThresh = (None if randBool() else 1000.0), logOccThresh = (None if randBool() else 1000.0))
-    dist = d.AutoregressiveNetDist(depth, d.SimpleLeftToRightNetFor(subLabels), [ 0.0 for i in range(depth) ], durDist, acDist, pruneSpec).withTag(randTag())
+    pruneSpec = None if randBool() else d.SimplePruneSpec(betaThresh = (None if randBool() else 1000.0), logOccThresh = (None if randBool() else 1000.0), beamSize = (None if randBool() else 1000))
+    dist = d.AutoregressiveNetDist(depth, d.SimpleLeftToRightNetFor(subLabels), [ 0.0 for i in range(depth) ], durDist, acDist, pruneSpec, dense = randBool()).withTag(randTag())
 
     def getInputGen():
         while True:
@@ -613,6 +663,55 @@ def check_addAcc(dist, trainingAll, ps):
     assert_allclose(logLikeFull, logLikeAll, atol = 1e-10)
     assert_allclose(derivParamsFull, derivParamsAll, atol = 1e-10)
 
+@codeDeps(assert_allclose, d.getDefaultCreateAcc, trainedAcc)
+def check_addBatch(dist, training):
+    accAll = trainedAcc(dist, training)
+    accBatch = d.getDefaultCreateAcc()(dist)
+    inputs = [ input for input, output, occ in training ]
+    outputs = [ output for input, output, occ in training ]
+    occs = [ occ for input, output, occ in training ]
+    accBatch.addBatch(inputs, outputs, occs)
+
+    assert_allclose(accBatch.occ, accAll.occ)
+    assert_allclose(accBatch.count(), accAll.count())
+    assert_allclose(accBatch.logLike(), accAll.logLike(), atol = 1e-10)
+
+@codeDeps(assert_allclose, chunkList, d.addAccs, d.getAccArena,
+    d.getDefaultCreateAcc, randBool, trainedAcc
+)
+def check_addAccs(dist, trainingAll):
+    accAll = trainedAcc(dist, trainingAll)
+
+    trainingParts = chunkList(trainingAll, numChunks = randint(1, 5))
+    accs = [ trainedAcc(dist, trainingPart) for trainingPart in trainingParts ]
+    arenas = [ d.getAccArena(acc) for acc in accs ]
+    accsFrom = [ (acc if arena is None or randBool() else pickle.loads(pickle.dumps(arena, protocol = 2))) for acc, arena in zip(accs, arenas) ]
+    accFull = d.getDefaultCreateAcc()(dist)
+    d.addAccs(accFull, accsFrom)
+
+    assert_allclose(accFull.occ, accAll.occ)
+    assert_allclose(accFull.count(), accAll.count())
+    assert_allclose(accFull.logLike(), accAll.logLike(), atol = 1e-10)
+
+@codeDeps(assert_allclose, d.addAcc, d.getPackedCreateAcc, trainedAcc)
+def check_packedAcc(dist, training):
+    accAll = trainedAcc(dist, training)
+    accPacked = d.getPackedCreateAcc()(dist)
+    accPackedOther = d.getPackedCreateAcc()(dist)
+    split = randint(0, len(training) + 1)
+    for input, output, occ in training[:split]:
+        accPacked.add(input, output, occ)
+    accPackedOther.addBatch([ input for input, output, occ in training[split:] ],
+                            [ output for input, output, occ in training[split:] ],
+                            [ occ for input, output, occ in training[split:] ])
+    d.addAcc(accPacked, accPackedOther)
+
+    assert_allclose(accPacked.occ, accAll.occ)
+    assert_allclose(accPacked.count(), accAll.count())
+    assert_allclose(accPacked.logLike(), accAll.logLike(), atol = 1e-10)
+    accPackedRound = pickle.loads(pickle.dumps(accPacked, protocol = 2))
+    assert_allclose(accPackedRound.logLike(), accPacked.logLike())
+
 @codeDeps(assert_allclose, iidLogProb, trainedAcc, trainedAccG)
 def check_occ_and_logLike(dist, training, iid, hasEM):
     assert iid == True
@@ -757,15 +856,16 @@ def getTrainingSet(dist, inputGen, typicalSize, iid, unitOcc):
     assert len(trainingSet) == trainingSetSize
     return trainingSet
 
-@codeDeps(assert_allclose, check_addAcc, check_derivParams,
-    check_logProbDerivInput, check_logProbDerivInput_hasDiscrete,
-    check_logProbDerivOutput, check_logProbDerivOutput_hasDiscrete,
-    check_occ_and_logLike, d.eval_local, d.getDefaultCreateAcc,
+@codeDeps(assert_allclose, check_addAcc, check_addAccs, check_addBatch,
+    check_derivParams, check_logProbDerivInput,
+    check_logProbDerivInput_hasDiscrete, check_logProbDerivOutput,
+    check_logProbDerivOutput_hasDiscrete, check_occ_and_logLike,
+    check_packedAcc, d.SynthMethod, d.eval_local, d.getDefaultCreateAcc,
     d.getDefaultParamSpec, d.isolateDist, dagInfoExtract, getTrainCG,
     getTrainEM, getTrainingSet, persist.roundTrip, reparse, trainedAcc,
     trainedAccG
 )
-def checkLots(dist, inputGen, hasParams, eps, numPoints, iid = True, unitOcc = False, hasEM = True, evalShouldWork = True, ps = d.getDefaultParamSpec(), logProbDerivInputCheck = False, logProbDerivInput_hasDiscrete_check = False, logProbDerivOutputCheck = False, logProbDerivOutput_hasDiscrete_checkFor = lambda output: False, checkAdditional = None, checkAccAdditional = None):
+def checkLots(dist, inputGen, hasParams, eps, numPoints, iid = True, unitOcc = False, hasEM = True, evalShouldWork = True, ps = d.getDefaultParamSpec(), logProbDerivInputCheck = False, logProbDerivInput_hasDiscrete_check = False, logProbDerivOutputCheck = False, logProbDerivOutput_hasDiscrete_checkFor = lambda output: False, synthBatchCheck = True, checkAdditional = None, checkAccAdditional = None):
     assert dist.tag is not None
     if hasEM:
         assert d.getDefaultCreateAcc()(dist).tag == dist.tag
@@ -780,6 +880,15 @@ def checkLots(dist, inputGen, hasParams, eps, numPoints, iid = True, unitOcc = F
         points.append((input, output))
 
     logProbsBefore = [ dist.logProb(input, output) for input, output in points ]
+    if True:
+        logProbsBatch = dist.logProbBatch([ input for input, output in points ], [ output for input, output in points ])
+        assert_allclose(logProbsBatch, logProbsBefore)
+    if synthBatchCheck:
+        outputsBatch = dist.synthBatch([ input for input, output in points ], d.SynthMethod.Meanish, [ output for input, output in points ])
+        assert len(outputsBatch) == len(points)
+        for (input, output), outputBatch in zip(points, outputsBatch):
+            assert_allclose(outputBatch, dist.synth(input, d.SynthMethod.Meanish, output))
+        assert len(dist.synthBatch([ input for input, output in points ])) == len(points)
     if hasParams:
         paramsBefore = ps.params(dist)
 
@@ -840,6 +949,10 @@ def checkLots(dist, inputGen, hasParams, eps, numPoints, iid = True, unitOcc = F
         check_addAcc(dist, training, ps)
     if iid:
         check_occ_and_logLike(dist, training, iid = iid, hasEM = hasEM)
+    if hasEM:
+        check_addBatch(dist, training)
+        check_packedAcc(dist, training)
+        check_addAccs(dist, training)
     if hasParams:
         check_derivParams(dist, training, ps, eps = eps)
     if checkAccAdditional is not None:
@@ -862,24 +975,33 @@ def checkLots(dist, inputGen, hasParams, eps, numPoints, iid = True, unitOcc = F
         if len(training) >= numPoints - 1:
             getTrainCG(dist, length = -2)(training)
 
-@codeDeps(assert_allclose, checkLots, check_est, cluster.ClusteringSpec,
-    cluster.MdlUtilitySpec, cluster.decisionTreeCluster,
-    cluster.decisionTreeClusterDepthBased, d.AutoGrowingDiscreteAcc,
-    d.ConstantClassifierAcc, d.LinearGaussianAcc, d.Memo,
-    d.estimateInitialMixtureOfTwoExperts, gen_AutoregressiveSequenceDist,
-    gen_BinaryLogisticClassifier, gen_ConstantClassifier, gen_CountFramesDist,
-    gen_DebugDist, gen_DecisionTree_with_LinearGaussian_leaves,
-    gen_DiscreteDist, gen_GaussianVec, gen_IdentifiableMixtureDist,
-    gen_LinearGaussian, gen_LinearGaussianVec, gen_MappedInputDist,
-    gen_MappedOutputDist, gen_MixtureDist, gen_MixtureOfTwoExperts,
-    gen_PassThruDist, gen_StudentDist, gen_TransformedInputDist,
-    gen_TransformedOutputDist, gen_VectorDist,
+@codeDeps(LruCache, assert_allclose, checkAlignment, checkLots, check_est,
+    cluster.BitsetAccSummer, cluster.ClusteringSpec, cluster.MdlUtilitySpec,
+    cluster.NodeBasedFirstLevelAccSummer, cluster.SecondLevelAccSummer,
+    cluster.decisionTreeCluster, cluster.decisionTreeClusterDepthBased,
+    cluster.removeTrivialQuestions, d.AutoGrowingDiscreteAcc,
+    d.AutoregressiveNetDist, d.AutoregressiveSequenceDist, d.ConstantClassifier,
+    d.ConstantClassifierAcc, d.DebugDist, d.EstimationError, d.LinearGaussian,
+    d.LinearGaussianAcc, d.LinearGaussianVecAcc, d.MappedInputDist, d.Memo,
+    d.SimpleLeftToRightNetFor, d.SimplePruneSpec, d.SynthMethod,
+    d.createDiscreteDist, d.estimateInitialMixtureOfTwoExperts, d.eval_local,
+    d.getAccArena, d.getDefaultCreateAcc, d.getDefaultEstimate,
+    d.getLatticeNetCreateAcc, d.getNetCacheCreateAcc,
+    gen_AutoregressiveSequenceDist, gen_BinaryLogisticClassifier,
+    gen_ConstantClassifier, gen_CountFramesDist, gen_DebugDist,
+    gen_DecisionTree_with_LinearGaussian_leaves, gen_DiscreteDist,
+    gen_GaussianVec, gen_IdentifiableMixtureDist, gen_LinearGaussian,
+    gen_LinearGaussianVec, gen_MappedInputDist, gen_MappedOutputDist,
+    gen_MixtureDist, gen_MixtureOfTwoExperts, gen_PassThruDist, gen_StudentDist,
+    gen_TransformedInputDist, gen_TransformedOutputDist, gen_VectorDist,
     gen_constant_AutoregressiveNetDist, gen_inSeq_AutoregressiveNetDist,
-    gen_nestedTransformDist, gen_shared_DiscreteDist, getTrainCG, getTrainEM,
-    getTrainFromAcc, randBool, randTag, randomizeParams,
+    gen_multiStream_AutoregressiveSequenceDist, gen_nestedTransformDist,
+    gen_shared_DiscreteDist, getTrainCG, getTrainEM, getTrainFromAcc,
+    persist.secHashObject, randBool, randTag, randomizeParams, readLattice,
     restrictTypicalOutputLength, test_transform_questions.SimplePhoneset,
     test_transform_questions.getQuestionGroups, trn.trainEM,
-    wnet.netIsTopSorted, wnet.nodeSetCompute
+    wnet.IntUnrolledNet, wnet.netIsTopSorted, wnet.nodeSetCompute, wnet.sum,
+    xf.AddBias
 )
 class TestDist(unittest.TestCase):
     def setUp(self):
@@ -899,6 +1021,68 @@ class TestDist(unittest.TestCase):
                 # (FIXME : thresh hardcoded for 'its' value (and small n, k). Could compute instead.)
                 self.assertTrue(la.norm(count / its * n - k) <= 0.05 * n, msg = 'histogram '+repr(count / its)+' for (n, k) = '+repr((n, k)))
 
+    def test_Memo_addAcc_random_subset(self, its = 10000):
+        """Memo addAcc should give random subsets equally likely to include each element"""
+        for n in range(0, 5):
+            for k in range(n + 1):
+                count = np.zeros(n)
+                for rep in xrange(its):
+                    split = randint(0, n + 1)
+                    acc = d.Memo(maxOcc = k)
+                    for i in xrange(split):
+                        acc.add(i, i)
+                    accOther = d.Memo(maxOcc = k)
+                    for i in xrange(split, n):
+                        accOther.add(i, i)
+                    acc.addAccSingle(accOther)
+                    assert acc.occ == n
+                    assert acc.fakeOcc == len(acc.outputs) == min(n, k)
+                    for i in acc.outputs:
+                        count[i] += 1.0
+                self.assertTrue(la.norm(count / its * n - k) <= 0.05 * n, msg = 'histogram '+repr(count / its)+' for (n, k) = '+repr((n, k)))
+
+    def test_Memo_storage(self, numPoints = 50):
+        spillDir = tempfile.mkdtemp()
+        try:
+            for spill in [False, True]:
+                maxOcc = random.choice([None, 10, 100])
+                acc = d.Memo(maxOcc = maxOcc, spillDir = spillDir if spill else None)
+                for i in range(numPoints):
+                    acc.add((('a' if i % 2 == 0 else 'b', i), randn(3)), randn(2))
+                assert isinstance(acc.outputs, np.ndarray)
+                assert acc.outputs.shape == (len(acc.inputs), 2)
+                assert isinstance(acc.inputs, list)
+                # (structured inputs are stored column-wise)
+                labelColumn, acInputColumn = acc.inputStore.columns
+                assert isinstance(labelColumn.values(), list)
+                assert isinstance(acInputColumn.values(), np.ndarray)
+                assert acInputColumn.values().shape == (len(acc.inputs), 3)
+                accOther = d.Memo(maxOcc = maxOcc, spillDir = spillDir if spill else None)
+                for i in range(numPoints):
+                    accOther.add((('c', i), randn(3)), randn(2))
+                inputs = list(acc.inputs) + list(accOther.inputs)
+                outputs = list(acc.outputs) + list(accOther.outputs)
+                acc.addAccSingle(accOther)
+                assert len(acc.outputs) == len(acc.inputs) == acc.fakeOcc
+                assert isinstance(acc.inputStore.columns[1].values(), np.ndarray)
+                for label, acInput in acc.inputs:
+                    assert any([ label == labelOrig and np.all(acInput == acInputOrig) for labelOrig, acInputOrig in inputs ])
+                for output in acc.outputs:
+                    assert any([ np.all(output == outputOrig) for outputOrig in outputs ])
+                accRound = pickle.loads(pickle.dumps(acc, protocol = 2))
+                assert np.all(accRound.outputs == acc.outputs)
+                assert [ label for label, acInput in accRound.inputs ] == [ label for label, acInput in acc.inputs ]
+                assert os.listdir(spillDir) == []
+
+            # spillDir is threaded from DebugDist through to its memo
+            dist = d.DebugDist(10, gen_LinearGaussian(3)[0], spillDir = spillDir)
+            assert d.eval_local(repr(dist)).spillDir == spillDir
+            acc = d.getDefaultCreateAcc()(dist)
+            assert acc.memo.spillDir == spillDir
+            assert d.getDefaultEstimate()(acc).spillDir == spillDir
+        finally:
+            shutil.rmtree(spillDir)
+
     def test_LinearGaussian(self, eps = 1e-8, numDists = 50, numPoints = 100):
         for distIndex in range(numDists):
             bias = random.choice([True, False])
@@ -913,12 +1097,35 @@ class TestDist(unittest.TestCase):
                 check_est(dist, getTrainFromAcc(createAcc), inputGen, hasParams = True)
 
     def test_LinearGaussianVec(self, eps = 1e-8, numDists = 30, numPoints = 100):
+        def checkAccAdditional(acc, training):
+            # stacked estimation should agree with estimating each dimension separately
+            if isinstance(acc, d.LinearGaussianVecAcc) and len(training) > 0:
+                order, dimIn = np.shape(acc.distPrev.coeffVec)
+                try:
+                    distEst, _ = acc.estimateSingleAux()
+                except d.EstimationError:
+                    distEst = None
+                distEstComps = []
+                for vecIndex in range(order):
+                    accComp = d.LinearGaussianAcc(inputLength = dimIn, varianceFloor = acc.varianceFloorVec[vecIndex])
+                    for input, output, occ in training:
+                        accComp.add(input[:, vecIndex], output[vecIndex], occ)
+                    try:
+                        distEstComps.append(accComp.estimateSingleAux()[0])
+                    except d.EstimationError:
+                        distEstComps.append(None)
+                if distEst is None:
+                    assert any([ distComp is None for distComp in distEstComps ])
+                else:
+                    for vecIndex, distComp in enumerate(distEstComps):
+                        assert_allclose(distEst.coeffVec[vecIndex], distComp.coeff, rtol = 1e-6, atol = 1e-8)
+                        assert_allclose(distEst.varianceVec[vecIndex], distComp.variance, rtol = 1e-6)
         for distIndex in range(numDists):
             bias = random.choice([True, False])
             order = randint(0, 10)
             dimIn = randint(1 if bias else 0, 5)
             dist, inputGen = gen_LinearGaussianVec(order, dimIn, bias = bias)
-            checkLots(dist, inputGen, hasParams = True, eps = eps, numPoints = numPoints, logProbDerivInputCheck = True, logProbDerivOutputCheck = True)
+            checkLots(dist, inputGen, hasParams = True, eps = eps, numPoints = numPoints, logProbDerivInputCheck = True, logProbDerivOutputCheck = True, checkAccAdditional = checkAccAdditional)
             if self.deepTest:
                 initEstDist = gen_LinearGaussianVec(order, dimIn)[0]
                 check_est(dist, getTrainEM(initEstDist), inputGen, hasParams = True)
@@ -1001,7 +1208,18 @@ class TestDist(unittest.TestCase):
         for distIndex in range(numDists):
             dimIn = randint(0, 5)
             dist, inputGen = gen_IdentifiableMixtureDist(dimIn)
-            checkLots(dist, inputGen, hasParams = True, eps = eps, numPoints = numPoints, logProbDerivInputCheck = True, logProbDerivOutput_hasDiscrete_checkFor = lambda (comp, acOutput): acOutput is not None)
+            # (outputs may contain None so cannot be compared numerically)
+            checkLots(dist, inputGen, hasParams = True, eps = eps, numPoints = numPoints, logProbDerivInputCheck = True, logProbDerivOutput_hasDiscrete_checkFor = lambda (comp, acOutput): acOutput is not None, synthBatchCheck = False)
+            inputs = [ input for input, pointIndex in zip(inputGen, range(numPoints)) ]
+            outputsBatch = dist.synthBatch(inputs, d.SynthMethod.Meanish)
+            assert len(outputsBatch) == len(inputs)
+            for input, (compBatch, acOutputBatch) in zip(inputs, outputsBatch):
+                comp, acOutput = dist.synth(input, d.SynthMethod.Meanish)
+                assert compBatch == comp
+                if acOutput is None:
+                    assert acOutputBatch is None
+                else:
+                    assert_allclose(acOutputBatch, acOutput)
             if self.deepTest:
                 initEstDist = gen_IdentifiableMixtureDist(dimIn, blcUseZeroCoeff = True)[0]
                 check_est(dist, getTrainEM(initEstDist), inputGen, hasParams = True)
@@ -1048,13 +1266,15 @@ class TestDist(unittest.TestCase):
             dimIn = randint(0, 5)
             dist, inputGen = gen_DecisionTree_with_LinearGaussian_leaves(splitProb = 0.49, dimIn = dimIn)
             useDepthBasedTraining = randBool()
+            useBitsets = randBool()
             def train(training):
                 acc = d.AutoGrowingDiscreteAcc(createAcc = lambda: d.LinearGaussianAcc(inputLength = dimIn, varianceFloor = 0.0))
                 for input, output, occ in training:
                     acc.add(input, output, occ)
                 utilitySpec = cluster.MdlUtilitySpec(1.0)
                 clusteringSpec = cluster.ClusteringSpec(
-                    utilitySpec, questionGroups, minCount = 0.1, verbosity = 0
+                    utilitySpec, questionGroups, minCount = 0.1,
+                    useBitsets = useBitsets, verbosity = 0
                 )
                 if useDepthBasedTraining:
                     return cluster.decisionTreeClusterDepthBased(
@@ -1070,6 +1290,30 @@ class TestDist(unittest.TestCase):
                 # check decision tree clustering runs at all
                 training = [ (input, dist.synth(input), math.exp(randn())) for input, index in zip(inputGen, range(numPoints)) ]
                 estDist = train(training)
+            if True:
+                # check bitset-based acc summing agrees with value-based acc summing
+                acc = d.AutoGrowingDiscreteAcc(createAcc = lambda: d.LinearGaussianAcc(inputLength = dimIn, varianceFloor = 0.0))
+                for input, index in zip(inputGen, range(numPoints)):
+                    acc.add(input, dist.synth(input), math.exp(randn()))
+                labelsAll = acc.accDict.keys()
+                labels = random.sample(labelsAll, randint(1, len(labelsAll) + 1))
+                minCount = random.choice([0.0, 1.0])
+                accForLabel = lambda label: acc.accDict[label]
+                questionGroupsNode = cluster.removeTrivialQuestions(labelsAll, questionGroups)
+                accSummerBitset = cluster.BitsetAccSummer(labelsAll, accForLabel, acc.createAcc, questionGroupsNode, rowsPerBlock = randint(1, 5))
+                accSummer1 = cluster.NodeBasedFirstLevelAccSummer(accForLabel, acc.createAcc)
+                accSummer2 = cluster.SecondLevelAccSummer(acc.createAcc)
+                assert_allclose(d.getAccArena(accSummerBitset.all(labels)).buffer, d.getAccArena(accSummer1.all(labels)).buffer)
+                accsForQuestionGroupsBitset = accSummerBitset.forQuestionGroups(labels, questionGroupsNode, minCount = minCount)
+                accsForQuestionGroups = accSummer2.forQuestionGroups(accSummer1.getQgToValueToAcc(labels, questionGroupsNode), questionGroupsNode, minCount = minCount)
+                assert len(accsForQuestionGroupsBitset) == len(accsForQuestionGroups)
+                for (labelValuerBitset, accsForQuestionsBitset), (labelValuer, accsForQuestions) in zip(accsForQuestionGroupsBitset, accsForQuestionGroups):
+                    assert labelValuerBitset is labelValuer
+                    assert len(accsForQuestionsBitset) == len(accsForQuestions)
+                    for (questionBitset, accForAnswerBitset), (question, accForAnswer) in zip(accsForQuestionsBitset, accsForQuestions):
+                        assert questionBitset is question
+                        for accBitset, accGood in zip(accForAnswerBitset, accForAnswer):
+                            assert_allclose(d.getAccArena(accBitset).buffer, d.getAccArena(accGood).buffer)
             if self.deepTest:
                 check_est(dist, train, inputGen, hasParams = True)
 
@@ -1175,23 +1419,231 @@ class TestDist(unittest.TestCase):
                 check_est(dist, getTrainCG(initEstDist), inputGen, hasParams = True)
 
     def test_AutoregressiveSequenceDist(self, eps = 1e-8, numDists = 10, numPoints = 100):
+        def checkAdditional(dist, input, output, eps):
+            # packed and list-based contexts should give the same result
+            distOther = d.AutoregressiveSequenceDist(dist.depth, dist.seqFor, dist.fillFrames, dist.dist, packContext = not dist.packContext, tag = dist.tag)
+            assert_allclose(distOther.logProb(input, output), dist.logProb(input, output))
         def checkAccAdditional(acc, training):
             assert_allclose(acc.frames, sum([ len(output) * occ for input, output, occ in training ]))
         for distIndex in range(numDists):
             depth = randint(0, 5)
-            dist, inputGen = gen_AutoregressiveSequenceDist(depth)
-            checkLots(dist, inputGen, hasParams = True, eps = eps, numPoints = numPoints, checkAccAdditional = checkAccAdditional)
+            dist, inputGen = gen_AutoregressiveSequenceDist(depth, packContext = randBool())
+            checkLots(dist, inputGen, hasParams = True, eps = eps, numPoints = numPoints, checkAdditional = checkAdditional, checkAccAdditional = checkAccAdditional)
             if self.deepTest:
                 initEstDist = randomizeParams(dist)
                 check_est(dist, getTrainEM(initEstDist), inputGen, hasParams = True)
                 check_est(dist, getTrainCG(initEstDist), inputGen, hasParams = True)
 
+    def test_AutoregressiveSequenceDist_multiStream(self, numDists = 10, numPoints = 20):
+        def checkFramesClose(outSeq, outSeqGood):
+            assert len(outSeq) == len(outSeqGood)
+            for (mgc, lf0, bap), (mgcGood, lf0Good, bapGood) in zip(outSeq, outSeqGood):
+                assert_allclose(mgc, mgcGood)
+                assert lf0[0] == lf0Good[0]
+                if lf0Good[0] != 0:
+                    assert_allclose(lf0[1], lf0Good[1])
+                assert_allclose(bap, bapGood)
+        for distIndex in range(numDists):
+            depth = randint(0, 4)
+            dist, inputGen = gen_multiStream_AutoregressiveSequenceDist(depth)
+            distPacked = d.AutoregressiveSequenceDist(dist.depth, dist.seqFor, dist.fillFrames, dist.dist, packContext = True, tag = dist.tag)
+            training = [ (input, dist.synth(input), math.exp(randn())) for input, pointIndex in zip(inputGen, range(numPoints)) ]
+            for input, output, occ in training:
+                assert_allclose(distPacked.logProb(input, output), dist.logProb(input, output))
+
+            # packed and list-based synthesis should agree
+            inputs = [ input for input, output, occ in training ]
+            outputsGood = [ dist.synth(input, d.SynthMethod.Meanish) for input in inputs ]
+            for input, outputGood in zip(inputs, outputsGood):
+                checkFramesClose(distPacked.synth(input, d.SynthMethod.Meanish), outputGood)
+            for output, outputGood in zip(distPacked.synthBatch(inputs, d.SynthMethod.Meanish), outputsGood):
+                checkFramesClose(output, outputGood)
+
+            # packed and list-based accumulation should agree
+            acc = d.getDefaultCreateAcc()(dist)
+            accPacked = d.getDefaultCreateAcc()(distPacked)
+            for input, output, occ in training:
+                acc.add(input, output, occ)
+                accPacked.add(input, output, occ)
+            assert_allclose(accPacked.frames, acc.frames)
+            assert_allclose(accPacked.logLike(), acc.logLike())
+
+    def test_AutoregressiveNetDist_netCache(self):
+        cacheDir = tempfile.mkdtemp()
+        try:
+            netCache = LruCache(0, cacheDir = cacheDir)
+            def getDist(subLabels):
+                return d.AutoregressiveNetDist(0, d.SimpleLeftToRightNetFor(subLabels), [], None, None, None)
+            input = ['a', 'b']
+            net1, _ = getDist([0]).getConcreteNet(input, netCache = netCache)
+            net2, _ = getDist([0, 1]).getConcreteNet(input, netCache = netCache)
+            # (nets persisted for one netFor are not reused for another)
+            assert len(os.listdir(cacheDir)) == 2
+            assert len(wnet.nodeSetCompute(net2)) > len(wnet.nodeSetCompute(net1))
+            net1Again, _ = getDist([0]).getConcreteNet(input, netCache = netCache)
+            assert len(wnet.nodeSetCompute(net1Again)) == len(wnet.nodeSetCompute(net1))
+            assert len(os.listdir(cacheDir)) == 2
+            # (the cache is specified during accumulation and is not part of
+            #   the dist or the re-estimated dist)
+            dist, inputGen = gen_inSeq_AutoregressiveNetDist(depth = randint(0, 2))
+            netCacheAcc = LruCache(1, cacheDir = cacheDir)
+            acc = d.getNetCacheCreateAcc(netCacheAcc)(dist)
+            uttId, input = inputGen.next()
+            acc.add((uttId, input), [ randn() for i in range(randint(0, 5)) ])
+            assert len(netCacheAcc.mem) == 1
+            distNew = d.getDefaultEstimate()(acc)
+            for distOther in [dist, distNew]:
+                assert 'netCache' not in distOther.__dict__
+                assert cacheDir not in repr(distOther)
+                assert cacheDir not in pickle.dumps(distOther)
+        finally:
+            shutil.rmtree(cacheDir)
+
+    def test_AutoregressiveNetDist_viterbiAlign(self):
+        subLabels = [0, 1]
+        means = { ('a', 0): 0.0, ('a', 1): 10.0, ('b', 0): 20.0, ('b', 1): 30.0 }
+        durDist = d.createDiscreteDist(means.keys(), lambda phInput:
+            d.ConstantClassifier(probs = np.array([0.5, 0.5]), probFloors = np.zeros((2,)))
+        )
+        acDist = d.createDiscreteDist(means.keys(), lambda phInput:
+            d.MappedInputDist(xf.AddBias(),
+                d.LinearGaussian(coeff = np.array([means[phInput]]), variance = 0.01, varianceFloor = 0.0)
+            )
+        )
+        # (the repeated label is aligned as two separate label-level segments)
+        input = ['a', 'a', 'b']
+        alignmentRef = [
+            (0, 3, 'a', [(0, 2, 0, None), (2, 3, 1, None)]),
+            (3, 6, 'a', [(3, 4, 0, None), (4, 6, 1, None)]),
+            (6, 8, 'b', [(6, 7, 0, None), (7, 8, 1, None)]),
+        ]
+        outSeq = [ means[(label, subLabel)] for _, _, label, subAlignment in alignmentRef for startTime, endTime, subLabel, _ in subAlignment for time in range(startTime, endTime) ]
+        for pruneSpec in [None, d.SimplePruneSpec(betaThresh = 1000.0, logOccThresh = None, beamSize = 1000)]:
+            dist = d.AutoregressiveNetDist(0, d.SimpleLeftToRightNetFor(subLabels), [], durDist, acDist, pruneSpec)
+            alignment = dist.viterbiAlign(('uttId', input), outSeq)
+            checkAlignment(alignment, startTimeReq = 0, endTimeReq = len(outSeq), allowZeroDur = False)
+            assert alignment == alignmentRef
+            # (consecutive repeated states are not merged, though here where
+            #   the boundary between them lies is arbitrary)
+            dist = d.AutoregressiveNetDist(0, d.SimpleLeftToRightNetFor([0]), [], durDist, acDist, pruneSpec)
+            alignment = dist.viterbiAlign(('uttId', ['a', 'a', 'b']), [0.0, 0.0, 0.0, 20.0])
+            checkAlignment(alignment, startTimeReq = 0, endTimeReq = 4, allowZeroDur = False)
+            assert [ label for _, _, label, _ in alignment ] == ['a', 'a', 'b']
+            assert [ len(subAlignment) for _, _, _, subAlignment in alignment ] == [1, 1, 1]
+
     # (FIXME : check this is not unnecessarily slow for any reason)
     def test_AutoregressiveNetDist(self, eps = 1e-8, numDists = 5, numPoints = 100):
         def checkAdditional(dist, (uttId, input), outSeq, eps):
             # check result of getTimedNet is topologically sorted
-            timedNet, labelToWeight = dist.getTimedNet(input, outSeq, preComputeLabelToWeight = randBool())
+            timedNet, labelToWeight = dist.getTimedNet(input, outSeq)
+            # check precomputed labelToWeight agrees with direct computation
+            net, deltaTime = dist.getNet(input)
+            outSeqFilled = dist.fillFrames + outSeq
+            for node in range(net.numNodes):
+                for label, nextNode in net.next(node, forwards = True):
+                    if label is not None and len(outSeq) + 1 - deltaTime(label) > 0:
+                        time = randint(0, len(outSeq) + 1 - deltaTime(label))
+                        acInput = outSeqFilled[max(time - dist.depth + len(dist.fillFrames), 0):(time + len(dist.fillFrames))]
+                        if not label[0]:
+                            _, phInput, phOutput = label
+                            lp = dist.durDist.logProb((phInput, acInput), phOutput)
+                        else:
+                            _, phInput = label
+                            lp = dist.acDist.logProb((phInput, acInput), outSeq[time])
+                        assert_allclose(labelToWeight((label, time, time + deltaTime(label))), lp)
             assert wnet.netIsTopSorted(timedNet, wnet.nodeSetCompute(timedNet, accessibleOnly = False), deltaTime = lambda label: 0)
+            # check the agenda-based engine traverses timedNet using precomputed
+            #   edge arrays rather than allocating lists of edges
+            timedNet, labelToWeight = dist.getTimedNet(input, outSeq)
+            assert isinstance(timedNet, wnet.IntUnrolledNet)
+            def nextDisallowed(node, forwards):
+                raise AssertionError('next called during agenda-based sum')
+            timedNet.next = nextDisallowed
+            totalLogProbAgenda = wnet.sum(timedNet, labelToWeight = labelToWeight, ring = dist.ring, getAgenda = dist.getAgenda(timedNet))
+            assert timedNet.edgeArrays
+            del timedNet.next
+            # check dense and agenda-based forward-backward agree
+            distOther = d.AutoregressiveNetDist(dist.depth, dist.netFor, dist.fillFrames, dist.durDist, dist.acDist, dist.pruneSpec, dense = not dist.dense, tag = dist.tag)
+            totalLogProb, edgeGen, _ = dist.forwardBackward(input, outSeq)
+            totalLogProbOther, edgeGenOther, _ = distOther.forwardBackward(input, outSeq)
+            assert_allclose(totalLogProbOther, totalLogProb)
+            assert_allclose(distOther.logProb((uttId, input), outSeq), totalLogProb)
+            assert_allclose(totalLogProbAgenda, totalLogProb)
+            occs = defaultdict(float)
+            for label, logOcc in edgeGen:
+                occs[label] += math.exp(logOcc)
+            for label, logOcc in edgeGenOther:
+                occs[label] -= math.exp(logOcc)
+            assert_allclose(occs.values(), np.zeros((len(occs),)), atol = 1e-8)
+            # check blocked accumulation agrees with adding edge by edge
+            acc = d.getDefaultCreateAcc()(dist)
+            acc.add((uttId, input), outSeq)
+            accRef = d.getDefaultCreateAcc()(dist)
+            _, edgeGen, _ = dist.forwardBackward(input, outSeq)
+            acInputs = dist.getAcInputs(outSeq)
+            for (label, labelStartTime, labelEndTime), logOcc in edgeGen:
+                if label is not None and (dist.pruneSpec is None or dist.pruneSpec.logOccThresh is None or logOcc > -dist.pruneSpec.logOccThresh):
+                    if not label[0]:
+                        _, phInput, phOutput = label
+                        accRef.durAcc.add((phInput, acInputs[labelStartTime]), phOutput, math.exp(logOcc))
+                    else:
+                        _, phInput = label
+                        accRef.acAcc.add((phInput, acInputs[labelStartTime]), outSeq[labelStartTime], math.exp(logOcc))
+            for child, childRef in [(acc.durAcc, accRef.durAcc), (acc.acAcc, accRef.acAcc)]:
+                assert_allclose(d.getAccArena(child).buffer, d.getAccArena(childRef).buffer, rtol = 1e-6, atol = 1e-8)
+            # check accumulating by replaying a lattice agrees with accumulating directly
+            latticeDir = tempfile.mkdtemp()
+            try:
+                accWrite = d.getLatticeNetCreateAcc(latticeDir)(dist)
+                accWrite.add((uttId, input), outSeq)
+                assert os.listdir(latticeDir) == ['%s.lat' % uttId]
+                accReplay = d.getLatticeNetCreateAcc(latticeDir, replayLattices = True)(dist)
+                accReplay.add((uttId, input), outSeq)
+                # check stale lattices are detected when replaying
+                lattice = readLattice(os.path.join(latticeDir, '%s.lat' % uttId))
+                assert lattice.numFrames == len(outSeq)
+                assert lattice.distHash == persist.secHashObject(dist)
+                accStale = d.getLatticeNetCreateAcc(latticeDir, replayLattices = True)(dist)
+                self.assertRaises(RuntimeError, accStale.add, (uttId, input), outSeq + [0.0])
+                distOtherNet = d.AutoregressiveNetDist(dist.depth, d.SimpleLeftToRightNetFor(['x']), dist.fillFrames, dist.durDist, dist.acDist, dist.pruneSpec)
+                accStale = d.getLatticeNetCreateAcc(latticeDir, replayLattices = True)(distOtherNet)
+                self.assertRaises(RuntimeError, accStale.add, (uttId, input), outSeq)
+                accStale = d.getLatticeNetCreateAcc(latticeDir, replayLattices = True)(dist)
+                accStale.distHash = persist.secHashObject(distOtherNet)
+                self.assertRaises(RuntimeError, accStale.add, (uttId, input), outSeq)
+            finally:
+                shutil.rmtree(latticeDir)
+            for accOther in [accWrite, accReplay]:
+                assert_allclose(accOther.logLike(), acc.logLike(), rtol = 1e-6, atol = 1e-8)
+                assert_allclose(d.getAccArena(accOther).buffer, d.getAccArena(acc).buffer, rtol = 1e-6, atol = 1e-8)
+            # check Viterbi alignment
+            bestLogProb, timedLabels = dist.viterbi((uttId, input), outSeq)
+            assert bestLogProb <= totalLogProb + 1e-8
+            if bestLogProb != float('-inf'):
+                assert_allclose(sum([ labelToWeight(label) for label in timedLabels ]), bestLogProb)
+                alignment = dist.viterbiAlign((uttId, input), outSeq)
+                if outSeq:
+                    checkAlignment(alignment, startTimeReq = 0, endTimeReq = len(outSeq), allowZeroDur = False)
+                else:
+                    assert alignment == []
+            # check expectation semiring computations
+            occs = defaultdict(float)
+            _, edgeGen, _ = dist.forwardBackward(input, outSeq)
+            for label, logOcc in edgeGen:
+                occs[label] += math.exp(logOcc)
+            def distError(acDist, acInput, acOutput):
+                return (acOutput - acDist.synth(acInput, d.SynthMethod.Meanish)) ** 2
+            errorRef = sum([ occ * distError(dist.acDist, (label[1], acInputs[labelStartTime]), outSeq[labelStartTime]) for (label, labelStartTime, labelEndTime), occ in occs.items() if label is not None and label[0] ])
+            assert_allclose(dist.arError((uttId, input), outSeq, distError), errorRef, rtol = 1e-6, atol = 1e-8)
+            if totalLogProb != float('-inf'):
+                epsDeriv = 1e-6
+                outputDirection = randn(len(outSeq))
+                numericDeriv = (
+                    dist.logProb((uttId, input), list(outSeq + outputDirection * epsDeriv)) -
+                    dist.logProb((uttId, input), list(outSeq - outputDirection * epsDeriv))
+                ) / (epsDeriv * 2.0)
+                analyticDeriv = np.sum(outputDirection * dist.logProbDerivOutput((uttId, input), outSeq))
+                assert_allclose(numericDeriv, analyticDeriv, atol = 1e-6, rtol = 1e-4)
         def checkAccAdditional(acc, training):
             assert_allclose(acc.frames, sum([ len(output) * occ for input, output, occ in training ]))
         for distIndex in range(numDists):
@@ -1201,7 +1653,9 @@ class TestDist(unittest.TestCase):
                 dist, inputGen = restrictTypicalOutputLength(genDist = lambda: gen_constant_AutoregressiveNetDist(depth = depth), numPoints = numPoints)
             else:
                 dist, inputGen = restrictTypicalOutputLength(genDist = lambda: gen_inSeq_AutoregressiveNetDist(depth = depth), numPoints = numPoints)
-            checkLots(dist, inputGen, hasParams = True, eps = eps, numPoints = numPoints, checkAdditional = checkAdditional, checkAccAdditional = checkAccAdditional)
+            # (synthesis from an AutoregressiveNetDist samples durations even for
+            #   SynthMethod.Meanish, so synthBatch is not checked against synth)
+            checkLots(dist, inputGen, hasParams = True, eps = eps, numPoints = numPoints, synthBatchCheck = False, checkAdditional = checkAdditional, checkAccAdditional = checkAccAdditional)
             if self.deepTest:
                 check_est(dist, getTrainEM(dist), inputGen, hasParams = True)
                 check_est(dist, getTrainCG(dist), inputGen, hasParams = True)
@@ -6,16 +6,104 @@
 # See `License` for details of license and warranty.
 
 import unittest
+import random
+from numpy.random import randn, randint
 
 from codedep import codeDeps
+from bisque.distribute import lit
+import bisque.queuer as qr
+from bisque.filehelp import TempDir
 
-@codeDeps()
+import armspeech.modelling.dist as d
+from armspeech.modelling import jobs_train
+from armspeech.modelling.corpus import Corpus
+from armspeech.util.mathhelp import assert_allclose
+import armspeech.numpy_settings
+
+@codeDeps(Corpus)
+class DictCorpus(Corpus):
+    def __init__(self, dataDict):
+        self.dataDict = dataDict
+    def data(self, uttId):
+        return self.dataDict[uttId]
+
+@codeDeps(DictCorpus, assert_allclose, d.LinearGaussian, d.SynthMethod)
 class TestCorpus(unittest.TestCase):
-    pass
+    def test_synthBatch(self, numUtts = 10):
+        dist = d.LinearGaussian(randn(2), 1.0, 0.0)
+        corpus = DictCorpus(dict([
+            ('utt%s' % uttIndex, (randn(2), randn()))
+            for uttIndex in range(numUtts)
+        ]))
+        uttIds = sorted(corpus.dataDict.keys())
+        outputs = corpus.synthBatch(dist, uttIds, d.SynthMethod.Meanish)
+        assert len(outputs) == len(uttIds)
+        for uttId, output in zip(uttIds, outputs):
+            assert_allclose(output, corpus.synth(dist, uttId, d.SynthMethod.Meanish))
+        assert len(corpus.synthBatch(dist, [])) == 0
 
-@codeDeps()
+@codeDeps(DictCorpus, TempDir, assert_allclose, d.DiscreteDist,
+    d.LinearGaussian, d.addAcc, d.getAccArena, d.getDefaultCreateAcc,
+    jobs_train.accumulate, jobs_train.reduceAccsJobSet, lit, qr.BuildRepo,
+    qr.LocalQueuer
+)
 class TestTrain(unittest.TestCase):
-    pass
+    def test_reduceAccsJobSet(self, numChunksMax = 12, numPoints = 20):
+        keys = ['a', 'b', 'c']
+        dist = d.DiscreteDist(keys, dict([
+            (key, d.LinearGaussian(randn(2), 1.0, 0.0)) for key in keys
+        ]))
+        for numChunks in range(1, numChunksMax + 1):
+            accs = []
+            for chunkIndex in range(numChunks):
+                acc = d.getDefaultCreateAcc()(dist)
+                for pointIndex in range(numPoints):
+                    acc.add((random.choice(keys), randn(2)), randn())
+                accs.append(acc)
+            accFlat = d.getDefaultCreateAcc()(dist)
+            for acc in accs:
+                d.addAcc(accFlat, acc)
+
+            useArena = random.choice([False, True])
+            accArts = [ lit(d.getAccArena(acc) if useArena else acc)
+                        for acc in accs ]
+            fanout = randint(2, 5)
+            accArt = jobs_train.reduceAccsJobSet(lit(dist), accArts,
+                                                 fanoutArt = lit(fanout))
+            with TempDir() as tempDir:
+                buildRepo = qr.BuildRepo(base = tempDir.location)
+                queuer = qr.LocalQueuer(buildRepo = buildRepo)
+                queuer.generateArtifacts([accArt], verbosity = 0)
+                accReduced = accArt.loadValue(buildRepo)
+            if useArena:
+                accReduced, arena = d.getDefaultCreateAcc()(dist), accReduced
+                arena.addToAcc(accReduced)
+
+            assert_allclose(accReduced.occ, accFlat.occ)
+            assert_allclose(accReduced.logLike(), accFlat.logLike())
+            assert_allclose(d.getAccArena(accReduced).buffer,
+                            d.getAccArena(accFlat).buffer)
+
+    def test_accumulate_numWorkers(self, numUtts = 30):
+        keys = ['a', 'b', 'c']
+        dist = d.DiscreteDist(keys, dict([
+            (key, d.LinearGaussian(randn(2), 1.0, 0.0)) for key in keys
+        ]))
+        corpus = DictCorpus(dict([
+            ('utt%s' % uttIndex, ((random.choice(keys), randn(2)), randn()))
+            for uttIndex in range(numUtts)
+        ]))
+        uttIds = sorted(corpus.dataDict.keys())
+        accRef = jobs_train.accumulate(dist, corpus, uttIds, d.getDefaultCreateAcc())
+        for numWorkers in [2, 3, numUtts + 2]:
+            useArena = random.choice([False, True])
+            acc = jobs_train.accumulate(dist, corpus, uttIds, d.getDefaultCreateAcc(), useArena = useArena, numWorkers = numWorkers)
+            if useArena:
+                acc, arena = d.getDefaultCreateAcc()(dist), acc
+                arena.addToAcc(acc)
+            assert_allclose(acc.occ, accRef.occ)
+            assert_allclose(acc.logLike(), accRef.logLike())
+            assert_allclose(d.getAccArena(acc).buffer, d.getAccArena(accRef).buffer)
 
 @codeDeps(TestCorpus, TestTrain)
 def suite():
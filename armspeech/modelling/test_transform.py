@@ -8,6 +8,7 @@
 import unittest
 import math
 import random
+import cPickle as pickle
 import numpy as np
 from numpy.random import randn, randint
 
@@ -481,7 +482,7 @@ class TestOutputTransform(unittest.TestCase):
             axf = gen_ShiftOutputTransform(shapeInput = shapeInput, shapeOutput = shapeOutput)
             checkOutputTransform(axf, shapeInput, shapeOutput, hasParams = True, eps = eps, its = itsPerTransform, checkAdditional = checkAdditional)
 
-@codeDeps(cluster.partitionLabels, randTag, xf.DecisionTree)
+@codeDeps(cluster.partitionLabels, randBool, randTag, xf.DecisionTree)
 def gen_DecisionTree(questionGroups, labels, splitProb = 0.49):
     numLeavess = [0]
     def gen_tree(labelsLeft):
@@ -504,7 +505,7 @@ def gen_DecisionTree(questionGroups, labels, splitProb = 0.49):
                                     for labels in labelsForAnswer ])
 
     tree = gen_tree(labels)
-    return xf.DecisionTree(tree, numLeaves = numLeavess[0]).withTag(randTag())
+    return xf.DecisionTree(tree, numLeaves = numLeavess[0], compiled = randBool()).withTag(randTag())
 
 @codeDeps(assert_allclose, xf.eval_local)
 def checkDiscreteTransform(transform, domain, codomain, its,
@@ -522,8 +523,8 @@ def checkDiscreteTransform(transform, domain, codomain, its,
 
 @codeDeps(checkDiscreteTransform, gen_DecisionTree,
     test_transform_questions.SimplePhoneset,
-    test_transform_questions.getQuestionGroups, xf.DecisionTree, xf.applyTree,
-    xf.getTreeLeaves
+    test_transform_questions.getQuestionGroups, xf.CompiledTree,
+    xf.DecisionTree, xf.applyTree, xf.getTreeLeaves
 )
 class TestDiscreteTransform(unittest.TestCase):
     def test_DecisionTree_fixed(self):
@@ -550,6 +551,14 @@ class TestDiscreteTransform(unittest.TestCase):
             return fullQuestion
         tree = (fq(0), [0, (fq(1), [1, 2, (fq(2), [3, 4, 5]), 6])])
         assert xf.getTreeLeaves(tree) == [0, 1, 2, 3, 4, 5, 6]
+        compiledTree = xf.CompiledTree(tree)
+        assert len(compiledTree.questionIds) == 3
+        assert len(compiledTree.children) == 9
+        for label in ['axx', 'bax', 'bbx', 'bca', 'bcb', 'bcc', 'bdx']:
+            assert compiledTree(label) == xf.applyTree(tree, label)
+        decTreeCompiled = xf.DecisionTree(tree, compiled = True)
+        assert list(decTreeCompiled.leavesFor(['bcc', 'axx', 'bcc', 'bdx'])) == [5, 0, 5, 6]
+        assert decTreeCompiled.leafCache == {'axx': 0, 'bcc': 5, 'bdx': 6}
         assert xf.applyTree(tree, 'axx') == 0
         assert xf.applyTree(tree, 'bax') == 1
         assert xf.applyTree(tree, 'bbx') == 2
@@ -607,6 +616,13 @@ class TestDiscreteTransform(unittest.TestCase):
             decTree.checkTree()
             checkDiscreteTransform(decTree, labels, range(decTree.numLeaves),
                                    its = itsPerTransform)
+            compiledTree = xf.CompiledTree(decTree.tree)
+            leafIndices = [ xf.applyTree(decTree.tree, label) for label in labels ]
+            assert [ compiledTree(label) for label in labels ] == leafIndices
+            assert list(decTree.leavesFor(labels)) == leafIndices
+            decTreeRound = pickle.loads(pickle.dumps(decTree, protocol = 2))
+            assert 'leafCache' not in decTreeRound.__dict__
+            assert list(decTreeRound.leavesFor(labels)) == leafIndices
 
 @codeDeps(TestDiscreteTransform, TestOutputTransform, TestTransform)
 def suite():
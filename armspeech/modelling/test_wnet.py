@@ -6,7 +6,10 @@
 # See `License` for details of license and warranty.
 
 import unittest
+import math
 import random
+from collections import defaultdict
+import numpy as np
 from numpy.random import randn, randint
 
 from codedep import codeDeps
@@ -14,6 +17,7 @@ from codedep import codeDeps
 from armspeech.util.memoize import memoize
 from armspeech.modelling import wnet
 from armspeech.modelling import semiring
+from armspeech.util.mathhelp import assert_allclose
 import armspeech.numpy_settings
 
 @codeDeps()
@@ -74,11 +78,17 @@ def defaultGenLabel():
 def defaultDeltaTime(label):
     return 0 if label is None else 1
 
-@codeDeps(defaultDeltaTime, defaultGenLabel, gen_simple_ConcreteNet,
-    is_valid_topSort, memoize, randBool, semiring.LogRealsField,
-    wnet.ConcreteNet, wnet.HasCycleError, wnet.SimpleSumAgenda, wnet.TrivialNet,
-    wnet.concretizeNetSimple, wnet.concretizeNetTopSort, wnet.isConsistent,
-    wnet.netIsTopSorted, wnet.nodeSetCompute, wnet.sum, wnet.topSort
+@codeDeps(assert_allclose, defaultDeltaTime, defaultGenLabel,
+    gen_simple_ConcreteNet, is_valid_topSort, memoize, randBool,
+    semiring.ExpectationSemiring, semiring.LogRealsField,
+    semiring.MaxPlusSemiring, semiring.ViterbiSemiring, wnet.BeamSumAgenda,
+    wnet.ConcreteNet, wnet.HasCycleError, wnet.IntUnrolledNet,
+    wnet.PriorityQueueSumAgenda, wnet.SimpleSumAgenda, wnet.TopSortEdgeArrays,
+    wnet.TrackRepeatPopsSumAgenda, wnet.TrivialNet, wnet.UnrolledNet,
+    wnet.concretizeNetSimple, wnet.concretizeNetTopSort,
+    wnet.forwardBackwardAlt, wnet.forwardBackwardDense, wnet.isConsistent,
+    wnet.netIsTopSorted, wnet.nodeSetCompute, wnet.sum, wnet.sumGetAlpha,
+    wnet.topSort
 )
 class TestWnet(unittest.TestCase):
     def test_TrivialNet_one_parameter_construction(self):
@@ -180,6 +190,171 @@ class TestWnet(unittest.TestCase):
             totalWeightForwards = wnet.sum(net, labelToWeight, ring, getAgenda = getAgenda, forwards = True)
             totalWeightBackwards = wnet.sum(net, labelToWeight, ring, getAgenda = getAgenda, forwards = True)
             assert ring.isClose(totalWeightForwards, totalWeightBackwards)
+    def test_forwardBackwardDense(self, its = 200):
+        for it in range(its):
+            netTop = wnet.concretizeNetTopSort(gen_simple_ConcreteNet(defaultGenLabel, defaultDeltaTime, sortable = True, pathMustExist = True), defaultDeltaTime)
+            startTime = randint(0, 3)
+            net = wnet.UnrolledNet(netTop, startTime = startTime, endTime = startTime + randint(0, 6), deltaTime = defaultDeltaTime)
+
+            ring = semiring.LogRealsField()
+            labelToWeight = memoize(lambda (label, labelStartTime, labelEndTime): ring.one if label is None else randn())
+            def getAgenda(forwards):
+                return wnet.PriorityQueueSumAgenda(ring, forwards, negMap = lambda (time, node): (-time, -node))
+            def getOccs(edgeGen):
+                occs = defaultdict(float)
+                for label, logOcc in edgeGen:
+                    occs[label] += math.exp(logOcc)
+                return occs
+            edgeArrays = wnet.TopSortEdgeArrays(netTop, defaultDeltaTime) if randBool() else None
+            totalWeightDense, edgeGenDense = wnet.forwardBackwardDense(net, labelToWeight, edgeArrays = edgeArrays)
+            occsDense = getOccs(edgeGenDense)
+            if totalWeightDense == ring.zero:
+                # (forwardBackwardAlt warns for nets with no complete path)
+                assert wnet.sum(net, labelToWeight, ring, getAgenda = getAgenda) == ring.zero
+                assert not occsDense
+                continue
+            totalWeight, edgeGen = wnet.forwardBackwardAlt(net, labelToWeight, ring, getAgenda = getAgenda)
+            occs = getOccs(edgeGen)
+            assert ring.isClose(totalWeightDense, totalWeight)
+            assert sorted(occsDense.keys()) == sorted([ label for label in occs if occs[label] != 0.0 ])
+            for label in occsDense:
+                assert_allclose(occsDense[label], occs[label])
+    def test_BeamSumAgenda(self, its = 200):
+        for it in range(its):
+            netTop = wnet.concretizeNetTopSort(gen_simple_ConcreteNet(defaultGenLabel, defaultDeltaTime, sortable = True, pathMustExist = True), defaultDeltaTime)
+            net = wnet.UnrolledNet(netTop, startTime = 0, endTime = randint(0, 6), deltaTime = defaultDeltaTime)
+
+            ring = semiring.LogRealsField()
+            labelToWeight = memoize(lambda (label, labelStartTime, labelEndTime): ring.one if label is None else randn())
+            def getAgendaRef(forwards):
+                return wnet.PriorityQueueSumAgenda(ring, forwards, negMap = lambda (time, node): (-time, -node))
+            forwards = randBool()
+            totalWeightRef = wnet.sum(net, labelToWeight, ring, getAgenda = getAgendaRef, forwards = forwards)
+
+            # without pruning the beam agenda is exact and has no repeat pops
+            agendas = []
+            def getAgenda(forwards, pruneThresh = None, beamSize = None):
+                agenda = wnet.TrackRepeatPopsSumAgenda(wnet.BeamSumAgenda(ring, forwards, pruneThresh = pruneThresh, beamSize = beamSize), verbose = False)
+                agendas.append(agenda)
+                return agenda
+            totalWeight = wnet.sum(net, labelToWeight, ring, getAgenda = getAgenda, forwards = forwards)
+            assert totalWeight == totalWeightRef or ring.isClose(totalWeight, totalWeightRef)
+            nodesPopped, pops = agendas[-1].summary()
+            assert pops == nodesPopped
+            assert agendas[-1].sa.numPruned == 0
+
+            # a threshold and beam which never prune are exact, and the
+            #   pruning decision is only re-checked when a time is entered
+            agenda = wnet.BeamSumAgenda(ring, forwards, pruneThresh = 1e6, beamSize = 1000000)
+            numPrunes = [0]
+            prune = agenda.prune
+            def countingPrune():
+                numPrunes[0] += 1
+                prune()
+            agenda.prune = countingPrune
+            totalWeight = wnet.sum(net, labelToWeight, ring, getAgenda = lambda forwards: agenda, forwards = forwards)
+            assert totalWeight == totalWeightRef or ring.isClose(totalWeight, totalWeightRef)
+            assert agenda.numPruned == 0
+            assert numPrunes[0] <= net.endTime - net.startTime + 1
+
+            # with pruning the total weight can only decrease and pruned nodes
+            #   are never popped
+            pruneThresh = None if randBool() else abs(randn()) * 2.0
+            beamSize = randint(1, 4)
+            totalWeightPruned = wnet.sum(net, labelToWeight, ring, getAgenda = lambda forwards: getAgenda(forwards, pruneThresh, beamSize), forwards = forwards)
+            assert totalWeightPruned <= totalWeightRef + 1e-8
+            nodesPopped, pops = agendas[-1].summary()
+            assert pops == nodesPopped
+            assert not set(agendas[-1].popped).intersection(agendas[-1].sa.pruned)
+            # the beam bounds all the nodes popped at each time
+            poppedPerTime = defaultdict(int)
+            for time, nodeIndex in agendas[-1].popped:
+                poppedPerTime[time] += 1
+            assert max(poppedPerTime.values() + [0]) <= beamSize
+    def test_ViterbiSemiring(self, its = 200):
+        for it in range(its):
+            netTop = wnet.concretizeNetTopSort(gen_simple_ConcreteNet(defaultGenLabel, defaultDeltaTime, sortable = True, pathMustExist = True), defaultDeltaTime)
+            endTime = randint(0, 6)
+            net = wnet.UnrolledNet(netTop, startTime = 0, endTime = endTime, deltaTime = defaultDeltaTime)
+
+            ringMaxPlus = semiring.MaxPlusSemiring()
+            ring = semiring.ViterbiSemiring()
+            labelToLogWeight = memoize(lambda (label, labelStartTime, labelEndTime): 0.0 if label is None else randn())
+            def labelToWeight(label):
+                return ring.lift(labelToLogWeight(label), [label])
+            def getAgendaFor(ring):
+                return lambda forwards: wnet.PriorityQueueSumAgenda(ring, forwards, negMap = lambda (time, node): (-time, -node))
+            forwards = randBool()
+            bestLogWeight = wnet.sum(net, labelToLogWeight, ringMaxPlus, getAgenda = getAgendaFor(ringMaxPlus), forwards = forwards)
+            best = wnet.sum(net, labelToWeight, ring, getAgenda = getAgendaFor(ring), forwards = forwards)
+            if bestLogWeight == ringMaxPlus.zero:
+                assert best == ring.zero
+                continue
+            assert ringMaxPlus.isClose(best[0], bestLogWeight)
+            path = ring.traceback(best)
+            assert path[0][1] == 0 and path[-1][2] == endTime
+            for (_, _, labelEndTimePrev), (_, labelStartTime, _) in zip(path, path[1:]):
+                assert labelStartTime == labelEndTimePrev
+            assert_allclose(sum([ labelToLogWeight(label) for label in path ]), bestLogWeight)
+    def test_ExpectationSemiring(self, its = 200):
+        for it in range(its):
+            netTop = wnet.concretizeNetTopSort(gen_simple_ConcreteNet(defaultGenLabel, defaultDeltaTime, sortable = True, pathMustExist = True), defaultDeltaTime)
+            net = wnet.UnrolledNet(netTop, startTime = 0, endTime = randint(0, 6), deltaTime = defaultDeltaTime)
+
+            ringRef = semiring.LogRealsField()
+            ring = semiring.ExpectationSemiring()
+            labelToLogWeight = memoize(lambda (label, labelStartTime, labelEndTime): 0.0 if label is None else randn())
+            labelToValue = memoize(lambda label: randn(2))
+            def labelToWeight(label):
+                return ring.lift(labelToLogWeight(label), labelToValue(label))
+            def getAgendaFor(ring):
+                return lambda forwards: wnet.PriorityQueueSumAgenda(ring, forwards, negMap = lambda (time, node): (-time, -node))
+            forwards = randBool()
+            totalLogWeightRef = wnet.sum(net, labelToLogWeight, ringRef, getAgenda = getAgendaFor(ringRef), forwards = forwards)
+            totalLogWeight, value = wnet.sum(net, labelToWeight, ring, getAgenda = getAgendaFor(ring), forwards = forwards)
+            if totalLogWeightRef == ringRef.zero:
+                assert totalLogWeight == ringRef.zero
+                continue
+            assert ringRef.isClose(totalLogWeight, totalLogWeightRef)
+            _, edgeGen = wnet.forwardBackwardAlt(net, labelToLogWeight, ringRef, getAgenda = getAgendaFor(ringRef))
+            valueRef = np.zeros((2,))
+            for label, logOcc in edgeGen:
+                valueRef += math.exp(logOcc) * labelToValue(label)
+            assert_allclose(value, valueRef)
+    def test_IntUnrolledNet(self, its = 200):
+        for it in range(its):
+            netTop = wnet.concretizeNetTopSort(gen_simple_ConcreteNet(defaultGenLabel, defaultDeltaTime, sortable = True, pathMustExist = True), defaultDeltaTime)
+            startTime = randint(0, 3)
+            endTime = startTime + randint(0, 6)
+            net = wnet.UnrolledNet(netTop, startTime = startTime, endTime = endTime, deltaTime = defaultDeltaTime)
+            netInt = wnet.IntUnrolledNet(netTop, startTime = startTime, endTime = endTime, deltaTime = defaultDeltaTime)
+
+            # tuple-based API agrees with UnrolledNet
+            for forwards in [True, False]:
+                assert netInt.decode(netInt.start(forwards)) == net.start(forwards)
+            for time in range(startTime, endTime + 1):
+                for nodeTop in range(netTop.numNodes):
+                    node = netInt.encode((time, nodeTop))
+                    assert netInt.decode(node) == (time, nodeTop)
+                    for forwards in [True, False]:
+                        nextInt = [ (label, netInt.decode(nextNode)) for label, nextNode in netInt.next(node, forwards) ]
+                        assert nextInt == net.next((time, nodeTop), forwards)
+
+            ring = semiring.LogRealsField()
+            labelToWeight = memoize(lambda (label, labelStartTime, labelEndTime): ring.one if label is None else randn())
+            def getAgendaRef(forwards):
+                return wnet.PriorityQueueSumAgenda(ring, forwards, negMap = lambda (time, node): (-time, -node))
+            def getAgenda(forwards):
+                return wnet.PriorityQueueSumAgenda(ring, forwards, negMap = lambda node: -node)
+            forwards = randBool()
+            totalWeightRef, alphaRef = wnet.sumGetAlpha(net, labelToWeight, ring, getAgenda = getAgendaRef, forwards = forwards)
+            totalWeight = wnet.sum(netInt, labelToWeight, ring, getAgenda = getAgenda, forwards = forwards)
+            totalWeightAlt, alpha = wnet.sumGetAlpha(netInt, labelToWeight, ring, getAgenda = getAgenda, forwards = forwards)
+            for weight in [totalWeight, totalWeightAlt]:
+                assert weight == totalWeightRef or ring.isClose(weight, totalWeightRef)
+            for nodeRef, weightRef in alphaRef.items():
+                weight = alpha[netInt.encode(nodeRef)]
+                assert weight == weightRef or ring.isClose(weight, weightRef)
     # FIXME : add tests for other stuff in wnet
 
 @codeDeps(TestWnet)
@@ -780,11 +780,78 @@ def applyTree(tree, label):
             value = question(labelValuer(label))
             tree = subTrees[value]
 
-@codeDeps(DiscreteTransform, applyTree, getTreeLeaves)
+@codeDeps()
+class CompiledTree(object):
+    """A decision tree compiled into flat arrays.
+
+    Each node is encoded as an integer, with a non-negative value denoting the
+    internal node with that index and a negative value code denoting the leaf
+    with leaf index -1 - code.
+    For internal node node, fullQuestions[questionIds[node]] is the
+    (labelValuer, question) pair asked at that node and
+    children[childStarts[node] + answer] is the encoded child node for the
+    given answer.
+    Each distinct full question is stored only once.
+    """
+    def __init__(self, tree):
+        self.fullQuestions = []
+        # (python lists are used since they are quicker than numpy arrays to
+        #   index with scalars)
+        self.questionIds = []
+        self.childStarts = []
+        self.children = []
+
+        questionIdFor = dict()
+        agenda = []
+        def allocate(tree):
+            if not isinstance(tree, tuple):
+                leafIndex = tree
+                return -1 - leafIndex
+            else:
+                node = len(self.questionIds)
+                self.questionIds.append(None)
+                self.childStarts.append(None)
+                agenda.append((node, tree))
+                return node
+        self.root = allocate(tree)
+        while agenda:
+            node, (fullQuestion, subTrees) = agenda.pop()
+            labelValuer, question = fullQuestion
+            key = id(labelValuer), id(question)
+            if key not in questionIdFor:
+                questionIdFor[key] = len(self.fullQuestions)
+                self.fullQuestions.append(fullQuestion)
+            self.questionIds[node] = questionIdFor[key]
+            self.childStarts[node] = len(self.children)
+            self.children.extend([ allocate(subTree) for subTree in subTrees ])
+
+    def __call__(self, label):
+        fullQuestions = self.fullQuestions
+        questionIds = self.questionIds
+        childStarts = self.childStarts
+        children = self.children
+        node = self.root
+        while node >= 0:
+            labelValuer, question = fullQuestions[questionIds[node]]
+            node = children[childStarts[node] + question(labelValuer(label))]
+        return -1 - node
+
+@codeDeps(CompiledTree, DiscreteTransform, applyTree, getTreeLeaves,
+    lazyproperty
+)
 class DecisionTree(DiscreteTransform):
-    def __init__(self, tree, numLeaves = None, tag = None):
+    """A decision tree mapping labels to leaf indices.
+
+    If compiled is True then the tree is compiled to a CompiledTree when first
+    used, and the leaf index for each label is cached, so that each distinct
+    label is only passed down the tree once.
+    (In this case labels should be hashable. Unhashable labels are passed down
+    the tree each time.)
+    """
+    def __init__(self, tree, numLeaves = None, compiled = False, tag = None):
         self.tree = tree
         self.numLeaves = numLeaves
+        self.compiled = compiled
         self.tag = tag
 
         if self.numLeaves is None:
@@ -795,8 +862,23 @@ class DecisionTree(DiscreteTransform):
             self.numLeaves = numLeaves
 
     def __repr__(self):
-        return ('DecisionTree(%r, numLeaves=%r, tag=%r)' %
-                (self.tree, self.numLeaves, self.tag))
+        return ('DecisionTree(%r, numLeaves=%r, compiled=%r, tag=%r)' %
+                (self.tree, self.numLeaves, self.compiled, self.tag))
+
+    def __getstate__(self):
+        # (compiled tree and cache are recomputed lazily when needed)
+        state = dict(self.__dict__)
+        state.pop('compiledTree', None)
+        state.pop('leafCache', None)
+        return state
+
+    @lazyproperty
+    def compiledTree(self):
+        return CompiledTree(self.tree)
+
+    @lazyproperty
+    def leafCache(self):
+        return dict()
 
     def checkTree(self, checkNoTiedLeaves = True, checkNoUnreachable = True):
         leafIndices = getTreeLeaves(self.tree)
@@ -808,4 +890,19 @@ class DecisionTree(DiscreteTransform):
             assert set(leafIndices) == set(range(self.numLeaves))
 
     def __call__(self, label):
-        return applyTree(self.tree, label)
+        if not self.compiled:
+            return applyTree(self.tree, label)
+        leafCache = self.leafCache
+        try:
+            return leafCache[label]
+        except KeyError:
+            leafIndex = self.compiledTree(label)
+            leafCache[label] = leafIndex
+            return leafIndex
+        except TypeError:
+            # unhashable label
+            return self.compiledTree(label)
+
+    def leavesFor(self, labels):
+        """Returns an array of the leaf indices for a sequence of labels."""
+        return np.array([ self(label) for label in labels ], dtype = int)
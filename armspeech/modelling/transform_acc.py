@@ -34,6 +34,9 @@ class DerivInputTransformAccG(TransformAccG):
             dist.logProbDerivInput(inputT, output)
         ) * occ
 
+    def statNames(self):
+        return ['derivParams']
+
     def addAccSingle(self, acc):
         self.derivParams += acc.derivParams
 
@@ -68,6 +71,9 @@ class DerivOutputTransformAccG(OutputTransformAccG):
         ) * occ
         self.derivParams += self.outputTransform.logJacDerivParams(input, output) * occ
 
+    def statNames(self):
+        return ['derivParams']
+
     def addAccSingle(self, acc):
         self.derivParams += acc.derivParams
 
@@ -9,9 +9,14 @@ import logging
 import math
 import heapq
 from collections import deque, defaultdict
+from itertools import izip
+from functools import cmp_to_key
+import numpy as np
 
 from codedep import codeDeps, ForwardRef
 
+import armspeech.numpy_settings
+
 @codeDeps()
 class Net(object):
     def start(self, forwards):
@@ -605,6 +610,77 @@ class UnrolledNet(Net):
                 ret.append(((label, labelStartTime, labelEndTime), (nextTime, nextNodeTop)))
         return ret
 
+@codeDeps(Net, basicChecks)
+class IntUnrolledNet(Net):
+    """Unrolls given concrete net over time, using integer nodes.
+
+    Equivalent to UnrolledNet except that the node (time, nodeIndex) is
+    encoded as the integer (time - startTime) * numNodes + nodeIndex, so nodes
+    are cheap to hash and compare. If netTop is topologically sorted then so
+    is this net. netTop should be a ConcreteNet.
+
+    As well as the usual next method, nextArrays returns the edges leaving a
+    node as preallocated arrays (see below), avoiding allocating a new list of
+    timed labels and nodes for each call. sum and sumGetAlpha use nextArrays
+    automatically (see nextIter).
+    """
+    def __init__(self, netTop, startTime, endTime, deltaTime):
+        self.netTop = netTop
+        self.startTime = startTime
+        self.endTime = endTime
+        self.deltaTime = deltaTime
+
+        assert endTime >= startTime
+        self.numNodesTop = netTop.numNodes
+        self.numNodes = (endTime - startTime + 1) * self.numNodesTop
+        self.maxDelta = max([0] + [
+            deltaTime(label)
+            for nodeTop in range(self.numNodesTop)
+            for label, nextNodeTop in netTop.next(nodeTop, True)
+        ])
+        self.edgeArrays = dict()
+        basicChecks(self)
+    def encode(self, (time, nodeTop)):
+        return (time - self.startTime) * self.numNodesTop + nodeTop
+    def decode(self, node):
+        timeIndex, nodeTop = divmod(node, self.numNodesTop)
+        return timeIndex + self.startTime, nodeTop
+    def start(self, forwards):
+        return self.encode((self.startTime if forwards else self.endTime, self.netTop.start(forwards)))
+    def elem(self, node):
+        return self.netTop.elem(node % self.numNodesTop)
+    def next(self, node, forwards):
+        time, nodeTop = self.decode(node)
+        labels, deltas, offsets = self.nextArrays(node, forwards)
+        ret = []
+        for label, delta, offset in zip(labels, deltas, offsets):
+            nextTime = time + delta if forwards else time - delta
+            labelStartTime, labelEndTime = (time, nextTime) if forwards else (nextTime, time)
+            ret.append(((label, labelStartTime, labelEndTime), node + offset))
+        return ret
+    def nextArrays(self, node, forwards):
+        """Returns the edges leaving node as (labels, deltas, offsets).
+
+        labels are the (untimed) labels of netTop, deltas the corresponding
+        time changes and offsets are such that node + offset is the next node.
+        The returned arrays are computed once and shared between all nodes
+        with the same nodeIndex and the same (capped) distance to the end of
+        the net, so should not be modified.
+        """
+        time, nodeTop = self.decode(node)
+        timeLeft = self.endTime - time if forwards else time - self.startTime
+        key = nodeTop, forwards, min(timeLeft, self.maxDelta)
+        if key not in self.edgeArrays:
+            labels, deltas, offsets = [], [], []
+            for label, nextNodeTop in self.netTop.next(nodeTop, forwards):
+                delta = self.deltaTime(label)
+                if delta <= timeLeft:
+                    labels.append(label)
+                    deltas.append(delta)
+                    offsets.append((delta if forwards else -delta) * self.numNodesTop + nextNodeTop - nodeTop)
+            self.edgeArrays[key] = labels, deltas, offsets
+        return self.edgeArrays[key]
+
 @codeDeps(Net, basicChecks)
 class ReweightedNet(Net):
     def __init__(self, net, labelToWeight, divisionRing, beta):
@@ -770,6 +846,197 @@ class TimeSyncSumAgenda(SumAgenda):
                 queueNew.append(node)
         self.queue[self.time] = deque(queueNew)
 @codeDeps(SumAgenda)
+class BeamSumAgenda(SumAgenda):
+    """Time-synchronous SumAgenda with beam pruning for an UnrolledNet.
+
+    Nodes should be (time, nodeIndex) pairs, as for an UnrolledNet of a
+    topologically sorted ConcreteNet, or if nodeToTime is specified then
+    integers, as for an IntUnrolledNet, with nodeToTime(node) giving the time
+    of node. Nodes are kept in per-time buckets, and each bucket is a heap
+    keyed on nodeIndex (or the integer node) negated when forwards == False,
+    so nodes within a time are popped in topological order and there are no
+    repeat pops.
+
+    When the agenda moves on to a new time the nodes in that time's bucket are
+    pruned. Any node whose weight is worse than the best weight seen at that
+    time by more than pruneThresh is removed, and if beamSize is not None then
+    at most beamSize nodes are popped at each time. Pruned nodes are evicted
+    from the agenda and never popped while pruned.
+    Nodes may still be added at the current time after it has been entered
+    (e.g. via non-emitting edges), and weight may still arrive at pruned nodes
+    at the current time (the weight of pruned nodes is retained). A new node
+    which could not survive pruning is pruned immediately. If instead an add
+    could change the pruning decision for the current time (it improves on the
+    best weight seen, overflows the beam, or brings a pruned node back within
+    the threshold and beam) then the decision is re-checked on the next pop,
+    over the unpopped nodes together with the pruned nodes. The best of these
+    are kept subject to pruneThresh and to the remaining beam (beamSize less
+    the number of nodes already popped at this time), so a pruned node which
+    has received enough extra weight is reinstated, and the beam bounds all
+    the nodes popped at each time, not just those present when the time was
+    entered. Reinstated nodes have received weight from a node popped earlier,
+    so they are still popped in topological order.
+    If pruneThresh and beamSize are both None then no pruning is done.
+    """
+    def __init__(self, ring, forwards, pruneThresh = None, beamSize = None,
+                 nodeToTime = None):
+        self.ring = ring
+        self.forwards = forwards
+        self.pruneThresh = pruneThresh
+        self.beamSize = beamSize
+        self.nodeToTime = nodeToTime
+
+        assert self.beamSize is None or self.beamSize >= 1
+        self.pruning = self.pruneThresh is not None or self.beamSize is not None
+
+        self.active = dict()
+        self.buckets = dict()
+        self.time = None
+        # (pruned nodes at the current time, with their accumulated weight)
+        self.pruned = dict()
+        self.numPopped = 0
+        # (best weight seen at the current time)
+        self.best = None
+        # (lower bound on the weight of the unpopped nodes kept at the current
+        #   time, or None if there are none)
+        self.worstKept = None
+        self.dirty = False
+        self.numPruned = 0
+    def __nonzero__(self):
+        # (dirty is only set when there are active nodes or a pruned node is
+        #   certain to be reinstated)
+        return bool(self.active) or self.dirty
+    def isWithinThresh(self, weight):
+        ring = self.ring
+        thresh = self.pruneThresh
+        return thresh is None or not ring.lt(
+            ring.times(weight, thresh) if self.forwards
+            else ring.times(thresh, weight),
+            self.best
+        )
+    def admits(self, weight):
+        """Returns True if a node at the current time with weight could be kept.
+
+        Assumes the node is not currently in the bucket.
+        """
+        if not self.isWithinThresh(weight):
+            return False
+        if self.beamSize is not None:
+            if self.numPopped >= self.beamSize:
+                return False
+            elif self.numPopped + len(self.buckets[self.time]) >= self.beamSize:
+                return (self.worstKept is not None and
+                        self.ring.lt(self.worstKept, weight))
+        return True
+    def add(self, node, weight):
+        ring = self.ring
+        time = node[0] if self.nodeToTime is None else self.nodeToTime(node)
+        current = self.pruning and time == self.time
+        if node in self.active:
+            weight = self.active[node] = ring.plus(self.active[node], weight)
+        elif node in self.pruned:
+            weight = self.pruned[node] = ring.plus(self.pruned[node], weight)
+            if self.admits(weight):
+                self.dirty = True
+            return
+        else:
+            if self.time is not None and (time < self.time and self.forwards or
+                                          time > self.time and not self.forwards):
+                raise RuntimeError('cannot insert agenda item into past')
+            if current:
+                if not self.admits(weight):
+                    self.pruned[node] = weight
+                    self.numPruned += 1
+                    return
+                bucket = self.buckets[self.time]
+                if (self.beamSize is not None and
+                        self.numPopped + len(bucket) >= self.beamSize):
+                    self.dirty = True
+                self.worstKept = (weight if self.worstKept is None
+                                   else min(self.worstKept, weight,
+                                            key = cmp_to_key(self.cmp)))
+            if time not in self.buckets:
+                self.buckets[time] = []
+            key = self.toKey(node)
+            heapq.heappush(self.buckets[time], key if self.forwards else -key)
+            self.active[node] = weight
+        if current and self.pruneThresh is not None and ring.lt(self.best, weight):
+            self.best = weight
+            if (self.worstKept is not None and
+                    not self.isWithinThresh(self.worstKept)):
+                self.dirty = True
+    def toKey(self, node):
+        return node[1] if self.nodeToTime is None else node
+    def fromKey(self, key):
+        if not self.forwards:
+            key = -key
+        return (self.time, key) if self.nodeToTime is None else key
+    def cmp(self, a, b):
+        # (compare using ring.lt since semiring elements need not be directly
+        #   comparable)
+        return -1 if self.ring.lt(a, b) else 1 if self.ring.lt(b, a) else 0
+    def pop(self):
+        if self.dirty:
+            self.prune()
+        if not self.active:
+            raise IndexError('pop from an empty agenda')
+        if self.time is None or not self.buckets[self.time]:
+            if self.time is not None:
+                del self.buckets[self.time]
+            self.time = min(self.buckets) if self.forwards else max(self.buckets)
+            self.pruned = dict()
+            self.numPopped = 0
+            self.best = None
+            self.worstKept = None
+            if self.pruning:
+                self.prune()
+        node = self.fromKey(heapq.heappop(self.buckets[self.time]))
+        weight = self.active[node]
+        del self.active[node]
+        self.numPopped += 1
+        return node, weight
+    def prune(self):
+        """(Re-)prunes the unpopped and pruned nodes at the current time."""
+        ring = self.ring
+        self.dirty = False
+        bucket = self.buckets[self.time]
+        weightOf = dict(self.pruned)
+        for key in bucket:
+            node = self.fromKey(key)
+            weightOf[node] = self.active[node]
+        nodes = weightOf.keys()
+
+        if nodes:
+            self.best = ring.max(weightOf.values() +
+                                 ([] if self.best is None else [self.best]))
+        keep = nodes
+        if self.pruneThresh is not None:
+            keep = [ node for node in keep
+                     if self.isWithinThresh(weightOf[node]) ]
+        if self.beamSize is not None:
+            beamLeft = max(self.beamSize - self.numPopped, 0)
+            if len(keep) > beamLeft:
+                key = cmp_to_key(self.cmp)
+                keep = heapq.nlargest(beamLeft, keep, key = lambda node: key(weightOf[node]))
+
+        keepSet = set(keep)
+        prunedNew = dict()
+        for node in nodes:
+            if node in keepSet:
+                self.active[node] = weightOf[node]
+            else:
+                if node in self.active:
+                    del self.active[node]
+                    self.numPruned += 1
+                prunedNew[node] = weightOf[node]
+        self.pruned = prunedNew
+        self.worstKept = (min([ weightOf[node] for node in keep ],
+                               key = cmp_to_key(self.cmp))
+                           if keep else None)
+        keys = [ self.toKey(node) for node in keep ]
+        self.buckets[self.time] = keys if self.forwards else [ -key for key in keys ]
+        heapq.heapify(self.buckets[self.time])
+@codeDeps(SumAgenda)
 class TrackRepeatPopsSumAgenda(SumAgenda):
     def __init__(self, sumAgenda, verbose = True):
         self.sa = sumAgenda
@@ -806,6 +1073,24 @@ class TrackRepeatPopsSumAgenda(SumAgenda):
                 print 'SumAgenda:\t', node, '->', count, 'times'
 
 @codeDeps()
+def nextIter(net, node, forwards):
+    """Returns an iterator over the (label, nextNode) edges leaving node.
+
+    If net has a nextArrays method (e.g. an IntUnrolledNet) then this is used
+    to traverse edges without allocating a list of edges for each node.
+    """
+    if not hasattr(net, 'nextArrays'):
+        return iter(net.next(node, forwards))
+    time = net.decode(node)[0]
+    labels, deltas, offsets = net.nextArrays(node, forwards)
+    if forwards:
+        return ( ((label, time, time + delta), node + offset)
+                 for label, delta, offset in izip(labels, deltas, offsets) )
+    else:
+        return ( ((label, time - delta, time), node + offset)
+                 for label, delta, offset in izip(labels, deltas, offsets) )
+
+@codeDeps(nextIter)
 def sum(net, labelToWeight, ring, getAgenda, forwards = True):
     """Sums over all paths in the given net.
 
@@ -826,7 +1111,7 @@ def sum(net, labelToWeight, ring, getAgenda, forwards = True):
         if weight != ring.zero:
             if node == endNode:
                 totalWeight = ring.plus(totalWeight, weight)
-            for label, nextNode in net.next(node, forwards):
+            for label, nextNode in nextIter(net, node, forwards):
                 linkWeight = labelToWeight(label)
                 newWeight = ring.times(weight, linkWeight) if forwards else ring.times(linkWeight, weight)
                 if newWeight != ring.zero:
@@ -834,7 +1119,7 @@ def sum(net, labelToWeight, ring, getAgenda, forwards = True):
 
     agenda.printStats()
     return totalWeight
-@codeDeps()
+@codeDeps(nextIter)
 def sumGetAlpha(net, labelToWeight, ring, getAgenda, forwards = True):
     """Sums over all paths in the given net, storing alpha for all nodes.
 
@@ -852,7 +1137,7 @@ def sumGetAlpha(net, labelToWeight, ring, getAgenda, forwards = True):
     while agenda:
         node, weight = agenda.pop()
         if weight != ring.zero:
-            for label, nextNode in net.next(node, forwards):
+            for label, nextNode in nextIter(net, node, forwards):
                 linkWeight = labelToWeight(label)
                 newWeight = ring.times(weight, linkWeight) if forwards else ring.times(linkWeight, weight)
                 if newWeight != ring.zero:
@@ -933,3 +1218,185 @@ def forwardBackwardAlt(net, labelToWeight, divisionRing, getAgenda):
     # remove extra part of label added by reweighting
     edgeGen = ( (label, logOcc) for (label, _), logOcc in edgeGen )
     return totalWeight, edgeGen
+
+@codeDeps()
+class TopSortEdgeArrays(object):
+    """Edge arrays for a topologically sorted ConcreteNet.
+
+    Used by the dense Forward-Backward engine for nets of the form
+    UnrolledNet(concretizeNetTopSort(net, deltaTime), ...). Edges are split
+    into non-emitting edges (deltaTime(label) == 0), which connect nodes within
+    a time frame, and emitting edges (deltaTime(label) == 1), which connect one
+    time frame to the next.
+
+    Within a time frame the non-emitting edges are grouped into levels such
+    that every edge in a level depends only on edges in earlier levels, so each
+    level can be processed as a single vectorized operation.
+    levelsForwards is the grouping used for alpha recursions and levelsBackwards
+    is the grouping used for beta recursions.
+    """
+    def __init__(self, net, deltaTime):
+        self.numNodes = net.numNodes
+        self.startNode = net.start(True)
+        self.endNode = net.end(True)
+
+        labels0, sources0, targets0 = [], [], []
+        labels1, sources1, targets1 = [], [], []
+        for node in range(self.numNodes):
+            for label, nextNode in net.next(node, forwards = True):
+                delta = deltaTime(label)
+                if delta == 0:
+                    if nextNode <= node:
+                        raise RuntimeError('net is not topologically sorted')
+                    labels0.append(label)
+                    sources0.append(node)
+                    targets0.append(nextNode)
+                elif delta == 1:
+                    labels1.append(label)
+                    sources1.append(node)
+                    targets1.append(nextNode)
+                else:
+                    raise RuntimeError('deltaTime must be 0 or 1 for dense'
+                                       ' Forward-Backward (not %r)' % delta)
+        self.labels0 = labels0
+        self.sources0 = np.array(sources0, dtype = np.int64)
+        self.targets0 = np.array(targets0, dtype = np.int64)
+        self.labels1 = labels1
+        self.sources1 = np.array(sources1, dtype = np.int64)
+        self.targets1 = np.array(targets1, dtype = np.int64)
+
+        # depth of each node counting non-emitting edges from the left, and
+        #   height counting non-emitting edges from the right
+        depth = [ 0 for node in range(self.numNodes) ]
+        for node, nextNode in sorted(zip(sources0, targets0)):
+            depth[nextNode] = max(depth[nextNode], depth[node] + 1)
+        height = [ 0 for node in range(self.numNodes) ]
+        for node, nextNode in reversed(sorted(zip(sources0, targets0),
+                                              key = lambda (n, nn): nn)):
+            height[node] = max(height[node], height[nextNode] + 1)
+        self.levelsForwards = self.groupEdges(
+            [ depth[node] for node in sources0 ]
+        )
+        self.levelsBackwards = self.groupEdges(
+            [ height[nextNode] for nextNode in targets0 ]
+        )
+
+    def groupEdges(self, edgeLevels):
+        levels = defaultdict(list)
+        for edgeIndex, level in enumerate(edgeLevels):
+            levels[level].append(edgeIndex)
+        return [ np.array(levels[level], dtype = np.int64)
+                 for level in sorted(levels) ]
+
+@codeDeps()
+def getDenseWeights(net, labelToWeight, edgeArrays):
+    """Computes edge weights for each time frame of an UnrolledNet.
+
+    Returns arrays weights0 with shape (numTimes, numEdges0) and weights1 with
+    shape (numTimes - 1, numEdges1), where weights0[ti, e] is the weight of
+    non-emitting edge e at time startTime + ti and weights1[ti, e] is the
+    weight of emitting edge e from time startTime + ti to the next frame.
+    """
+    times = range(net.startTime, net.endTime + 1)
+    weights0 = np.array([
+        [ labelToWeight((label, time, time)) for label in edgeArrays.labels0 ]
+        for time in times
+    ], dtype = np.float64).reshape((len(times), len(edgeArrays.labels0)))
+    weights1 = np.array([
+        [ labelToWeight((label, time, time + 1))
+          for label in edgeArrays.labels1 ]
+        for time in times[:-1]
+    ], dtype = np.float64).reshape((len(times) - 1, len(edgeArrays.labels1)))
+    return weights0, weights1
+
+@codeDeps()
+def sumGetAlphaDense(edgeArrays, weights0, weights1, forwards = True):
+    """Sums over all paths in an unrolled top-sorted net using dense arrays.
+
+    The log-domain equivalent of sumGetAlpha for an UnrolledNet of a
+    topologically sorted ConcreteNet, where the alpha values for all (time,
+    node) pairs are computed frame by frame as vectorized log-sum-exp
+    operations. edgeArrays should be a TopSortEdgeArrays and weights0 and
+    weights1 should be as returned by getDenseWeights.
+
+    Returns the total log weight and an array of alpha values with shape
+    (numTimes, numNodes).
+    """
+    ea = edgeArrays
+    numTimes = len(weights0)
+    alpha = np.empty((numTimes, ea.numNodes))
+    alpha.fill(float('-inf'))
+    if forwards:
+        alpha[0, ea.startNode] = 0.0
+        for ti in range(numTimes):
+            alphaCurr = alpha[ti]
+            if ti > 0:
+                np.logaddexp.at(
+                    alphaCurr, ea.targets1,
+                    alpha[ti - 1, ea.sources1] + weights1[ti - 1]
+                )
+            for edges in ea.levelsForwards:
+                np.logaddexp.at(
+                    alphaCurr, ea.targets0[edges],
+                    alphaCurr[ea.sources0[edges]] + weights0[ti, edges]
+                )
+        totalWeight = alpha[numTimes - 1, ea.endNode]
+    else:
+        alpha[numTimes - 1, ea.endNode] = 0.0
+        for ti in reversed(range(numTimes)):
+            alphaCurr = alpha[ti]
+            if ti < numTimes - 1:
+                np.logaddexp.at(
+                    alphaCurr, ea.sources1,
+                    weights1[ti] + alpha[ti + 1, ea.targets1]
+                )
+            for edges in ea.levelsBackwards:
+                np.logaddexp.at(
+                    alphaCurr, ea.sources0[edges],
+                    weights0[ti, edges] + alphaCurr[ea.targets0[edges]]
+                )
+        totalWeight = alpha[0, ea.startNode]
+    return float(totalWeight), alpha
+
+@codeDeps(TopSortEdgeArrays, getDenseWeights, sumGetAlphaDense)
+def forwardBackwardDense(net, labelToWeight, edgeArrays = None):
+    """Performs Forward-Backward algorithm on an unrolled top-sorted net.
+
+    A dense alternative to forwardBackwardAlt for the common case where net is
+    an UnrolledNet of a topologically sorted ConcreteNet (as returned by
+    concretizeNetTopSort) and where weights are log probabilities (i.e. the
+    divisionRing is semiring.LogRealsField). No pruning is performed.
+
+    edgeArrays may be passed in if the TopSortEdgeArrays for net.netTop have
+    already been computed.
+
+    Returns total log weight, and an iterator over (label, logOcc) pairs, where
+    each label is a (label, labelStartTime, labelEndTime) triple as for
+    UnrolledNet. Only edges with non-zero occupancy are produced, and each
+    labelled edge is produced at most once.
+    """
+    if edgeArrays is None:
+        edgeArrays = TopSortEdgeArrays(net.netTop, net.deltaTime)
+    ea = edgeArrays
+    weights0, weights1 = getDenseWeights(net, labelToWeight, ea)
+    totalWeight, alpha = sumGetAlphaDense(ea, weights0, weights1,
+                                          forwards = True)
+    totalWeightAgain, beta = sumGetAlphaDense(ea, weights0, weights1,
+                                              forwards = False)
+    if not np.allclose(totalWeight, totalWeightAgain):
+        logging.warning('recomputed total weight ('+str(totalWeightAgain)+') differs from given value ('+str(totalWeight)+')')
+
+    def getEdgeGen():
+        if totalWeight == float('-inf'):
+            return
+        logOccs0 = (alpha[:, ea.sources0] + weights0 + beta[:, ea.targets0] -
+                    totalWeight)
+        logOccs1 = (alpha[:-1, ea.sources1] + weights1 +
+                    beta[1:, ea.targets1] - totalWeight)
+        for labels, logOccs, delta in [(ea.labels0, logOccs0, 0),
+                                       (ea.labels1, logOccs1, 1)]:
+            for ti, edgeIndex in zip(*np.nonzero(logOccs > float('-inf'))):
+                time = net.startTime + ti
+                yield ((labels[edgeIndex], time, time + delta),
+                       float(logOccs[ti, edgeIndex]))
+    return totalWeight, getEdgeGen()
@@ -13,8 +13,12 @@ import numpy as np
 import numpy.linalg as la
 import itertools
 import subprocess
+import multiprocessing
+import tempfile
+import shutil
 
-from codedep import codeDeps
+from codedep import codeDeps, ForwardRef
+from bisque import persist
 
 import armspeech.numpy_settings
 
@@ -48,7 +52,7 @@ class Stream(object):
         return 'Stream('+repr(self.name)+', '+repr(self.order)+', '+repr(self.encoder)+')'
 
 # (FIXME : move this to htk_io (generalizing slightly)?)
-@codeDeps()
+@codeDeps(ForwardRef(lambda: AcousticSeqWriter))
 class AcousticSeqIo(object):
     def __init__(self, dir, vecSeqIos, exts, encoders):
         self.dir = dir
@@ -89,6 +93,89 @@ class AcousticSeqIo(object):
         acousticSeq = zip(*elemSeqs)
         return acousticSeq
 
+    def openWriter(self, uttId, bufferFrames = 100):
+        """Returns an AcousticSeqWriter for the files for uttId."""
+        return AcousticSeqWriter(
+            [ os.path.join(self.dir, '%s.%s' % (uttId, ext))
+              for ext in self.exts ],
+            [ vecSeqIo.vecSize for vecSeqIo in self.vecSeqIos ],
+            self.encoders,
+            [ vecSeqIo.dtypeFile for vecSeqIo in self.vecSeqIos ],
+            bufferFrames = bufferFrames
+        )
+
+    def writeFilesStreaming(self, uttId, frames, bufferFrames = 100):
+        """Writes the files for uttId, consuming frames one at a time.
+
+        frames may be any iterable (e.g. the iterator returned by the
+        synthIterator method of a dist), and is never stored in full.
+        Returns the number of frames written.
+        """
+        numFrames = 0
+        with self.openWriter(uttId, bufferFrames = bufferFrames) as writer:
+            for frame in frames:
+                writer.write(frame)
+                numFrames += 1
+        return numFrames
+
+@codeDeps()
+class AcousticSeqWriter(object):
+    """Writes an acoustic sequence to per-stream files frame by frame.
+
+    Each frame has one element per stream, and each element is encoded (if
+    the stream has an encoder) and stored in a buffer for that stream. Every
+    bufferFrames frames the buffers are appended to the corresponding raw
+    vector sequence files, so memory use is independent of the length of
+    the sequence and output appears on disk as synthesis proceeds.
+    """
+    def __init__(self, vecSeqFiles, vecSizes, encoders, dtypesFile,
+                 bufferFrames = 100):
+        self.vecSizes = vecSizes
+        self.encoders = encoders
+        self.dtypesFile = dtypesFile
+        self.bufferFrames = bufferFrames
+
+        self.numStreams = len(vecSeqFiles)
+        assert len(self.vecSizes) == self.numStreams
+        assert len(self.encoders) == self.numStreams
+        assert len(self.dtypesFile) == self.numStreams
+        assert self.bufferFrames >= 1
+
+        self.files = [ open(vecSeqFile, 'wb') for vecSeqFile in vecSeqFiles ]
+        self.buffers = [ [] for streamIndex in range(self.numStreams) ]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, frame):
+        assert len(frame) == self.numStreams
+        for streamIndex, elem in enumerate(frame):
+            encode = self.encoders[streamIndex].encode
+            self.buffers[streamIndex].append(elem if encode is None
+                                             else encode(elem))
+        if len(self.buffers[0]) >= self.bufferFrames:
+            self.flush()
+
+    def flush(self):
+        for streamIndex in range(self.numStreams):
+            buffer = self.buffers[streamIndex]
+            if buffer:
+                vecSeq = np.reshape(
+                    np.asarray(buffer, dtype = self.dtypesFile[streamIndex]),
+                    (len(buffer), self.vecSizes[streamIndex])
+                )
+                vecSeq.tofile(self.files[streamIndex])
+                self.files[streamIndex].flush()
+                self.buffers[streamIndex] = []
+
+    def close(self):
+        self.flush()
+        for f in self.files:
+            f.close()
+
 @codeDeps()
 class Msd01Encoder(object):
     def __init__(self, specialValue):
@@ -107,18 +194,206 @@ class Msd01Encoder(object):
         else:
             return [x]
 
+@codeDeps(persist.secHashObject)
+class SynthCache(object):
+    """Disk-backed cache of synthesized acoustic sequences.
+
+    Each synthesized acoustic sequence is stored in cacheDir as a compressed
+    numpy file containing one encoded vector sequence per stream, keyed by a
+    hash of the dist (typically computed once using persist.secHashObject),
+    the input, the synthesis method and the actual output (which some dists
+    use during synthesis).
+    Once the total size of the cached files exceeds maxBytes the least
+    recently used files are removed. Files are marked as used by updating
+    their modification time, so a cache directory may be shared between
+    processes.
+
+    N.B. a cached sample is reused rather than a new sample being drawn, so
+    repeated synthesis using SynthMethod.Sample gives the same output.
+    """
+    def __init__(self, cacheDir, streams, maxBytes = 1 << 30):
+        self.cacheDir = cacheDir
+        self.streams = streams
+        self.maxBytes = maxBytes
+
+        assert self.maxBytes >= 0
+
+    def __repr__(self):
+        return 'SynthCache(%r, %r, maxBytes=%r)' % (self.cacheDir,
+                                                   self.streams, self.maxBytes)
+
+    def getKey(self, distHash, input, method, actualOutput):
+        return persist.secHashObject((distHash, input, method, actualOutput))
+
+    def location(self, key):
+        return os.path.join(self.cacheDir, key+'.npz')
+
+    def load(self, key):
+        """Returns the cached acoustic sequence for key, or None."""
+        location = self.location(key)
+        if not os.path.exists(location):
+            return None
+        os.utime(location, None)
+        with np.load(location) as vecSeqs:
+            elemSeqs = []
+            for streamIndex, stream in enumerate(self.streams):
+                vecSeq = vecSeqs['stream%s' % streamIndex]
+                decode = stream.encoder.decode
+                elemSeq = list(vecSeq) if decode is None else map(decode, vecSeq)
+                elemSeqs.append(elemSeq)
+        return zip(*elemSeqs)
+
+    def save(self, key, acousticSeq):
+        vecSeqs = dict()
+        for streamIndex, stream in enumerate(self.streams):
+            encode = stream.encoder.encode
+            elemSeq = [ frame[streamIndex] for frame in acousticSeq ]
+            vecSeq = elemSeq if encode is None else map(encode, elemSeq)
+            vecSeqs['stream%s' % streamIndex] = np.reshape(
+                np.asarray(vecSeq, dtype = np.float64),
+                (len(elemSeq), stream.order)
+            )
+        location = self.location(key)
+        head, tail = os.path.split(location)
+        with tempfile.NamedTemporaryFile(prefix = '.'+tail+'.', dir = head, mode = 'wb', delete = False) as f:
+            tempLocation = f.name
+            np.savez_compressed(f, **vecSeqs)
+        os.rename(tempLocation, location)
+
+    def prune(self):
+        """Removes least recently used files until within the size limit."""
+        entries = []
+        for fileName in os.listdir(self.cacheDir):
+            if fileName.endswith('.npz') and not fileName.startswith('.'):
+                location = os.path.join(self.cacheDir, fileName)
+                statInfo = os.stat(location)
+                entries.append((statInfo.st_mtime, location, statInfo.st_size))
+        entries.sort()
+        totalBytes = sum([ size for _, _, size in entries ])
+        for _, location, size in entries:
+            if totalBytes <= self.maxBytes:
+                break
+            os.remove(location)
+            totalBytes -= size
+
+    def synthBatch(self, dist, distHash, inputs, method, actualOutputs = None):
+        """Synthesizes as dist.synthBatch, reusing cached outputs if present.
+
+        Only the inputs whose outputs are not cached are passed to
+        dist.synthBatch, and their outputs are then added to the cache.
+        """
+        if actualOutputs is None:
+            actualOutputs = [None] * len(inputs)
+        keys = [ self.getKey(distHash, input, method, actualOutput)
+                 for input, actualOutput in zip(inputs, actualOutputs) ]
+        outputs = [ self.load(key) for key in keys ]
+        indicesToSynth = [ index for index, output in enumerate(outputs)
+                           if output is None ]
+        if indicesToSynth:
+            synthOutputs = dist.synthBatch(
+                [ inputs[index] for index in indicesToSynth ],
+                method,
+                [ actualOutputs[index] for index in indicesToSynth ]
+            )
+            for index, synthOutput in zip(indicesToSynth, synthOutputs):
+                self.save(keys[index], synthOutput)
+                outputs[index] = synthOutput
+            self.prune()
+        return outputs
+
+@codeDeps()
+def getHtsDemoVocoderCommand(scriptsDir):
+    """Returns the HTS-demo-with-STRAIGHT-style vocoder command.
+
+    The vocoder command is a list of args to which the output directory and
+    basenames to synthesize are appended.
+    """
+    return ['/usr/bin/perl', os.path.join(scriptsDir, 'gen_wave.pl'),
+            os.path.join(scriptsDir, 'Config.pm')]
+
 @codeDeps()
-def doHtsDemoWaveformGeneration(scriptsDir, synthOutDir, basenames, logFile = None):
+def runVocoder(vocoderCommand, genDir, basenames):
+    """Runs vocoder command on basenames in genDir.
+
+    Returns the exit code and the combined stdout and stderr output.
+    """
+    args = vocoderCommand + [genDir] + basenames
+    p = subprocess.Popen(args, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+    logOutput = p.communicate()[0]
+    return p.returncode, logOutput
+
+@codeDeps(runVocoder)
+def generateWaveformIsolated(vocoderCommand, synthOutDir, basename, inExts = ['mgc', 'lf0', 'bap']):
+    """Runs vocoder command for a single basename in its own temp directory.
+
+    The input files <basename>.{mgc,lf0,bap} in synthOutDir are linked into a
+    fresh temp directory inside synthOutDir, so that concurrent invocations
+    do not interfere (the HTS demo scripts write shared intermediate files to
+    the output directory, for example). If the vocoder succeeds, any
+    <basename>.* files it created are then moved into synthOutDir using
+    os.rename, so each output file appears atomically. The temp directory is
+    always removed.
+
+    Returns the exit code and log output of the vocoder command.
+    """
+    tempDir = tempfile.mkdtemp(dir = synthOutDir, prefix = '.gen_wave.')
+    try:
+        inFiles = set([ '%s.%s' % (basename, ext) for ext in inExts ])
+        for inFile in inFiles:
+            os.symlink(os.path.abspath(os.path.join(synthOutDir, inFile)),
+                       os.path.join(tempDir, inFile))
+        returncode, logOutput = runVocoder(vocoderCommand, tempDir, [basename])
+        if returncode == 0:
+            for outFile in sorted(os.listdir(tempDir)):
+                if outFile.startswith(basename + '.') and outFile not in inFiles:
+                    os.rename(os.path.join(tempDir, outFile),
+                              os.path.join(synthOutDir, outFile))
+    finally:
+        shutil.rmtree(tempDir)
+    return returncode, logOutput
+
+@codeDeps(generateWaveformIsolated)
+def generateWaveformIsolatedWorker((vocoderCommand, synthOutDir, basename)):
+    return generateWaveformIsolated(vocoderCommand, synthOutDir, basename)
+
+@codeDeps(generateWaveformIsolatedWorker, getHtsDemoVocoderCommand, runVocoder)
+def doHtsDemoWaveformGeneration(scriptsDir, synthOutDir, basenames, logFile = None, numWorkers = 1, vocoderCommand = None):
     """HTS-demo-with-STRAIGHT-style waveform generation.
 
     N.B. assumes files to synthesize are <basename>.{mgc,lf0,bap} in synthOutDir.
     Also assumes a matching Config.pm configuration file.
+
+    If numWorkers is 1 then the vocoder is invoked once for all basenames.
+    Otherwise a pool of numWorkers processes is used, and each basename is
+    generated in its own temp directory (see generateWaveformIsolated).
+    If vocoderCommand is not None then it is used in place of the HTS demo
+    scripts in scriptsDir (for example to use a mock vocoder for testing).
     """
-    args = ['/usr/bin/perl', os.path.join(scriptsDir, 'gen_wave.pl'), os.path.join(scriptsDir, 'Config.pm'), synthOutDir] + basenames
-    p = subprocess.Popen(args, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
-    logOutput = p.communicate()[0]
-    if p.returncode != 0:
-        logging.warning('waveform generation failed (exit code '+str(p.returncode)+')')
+    if numWorkers < 1:
+        raise RuntimeError('numWorkers should be at least 1 (got %r)' %
+                           numWorkers)
+    if vocoderCommand is None:
+        vocoderCommand = getHtsDemoVocoderCommand(scriptsDir)
+    if numWorkers == 1:
+        returncode, logOutput = runVocoder(vocoderCommand, synthOutDir, basenames)
+        if returncode != 0:
+            logging.warning('waveform generation failed (exit code '+str(returncode)+')')
+    else:
+        pool = multiprocessing.Pool(numWorkers)
+        try:
+            results = pool.map(generateWaveformIsolatedWorker, [
+                (vocoderCommand, synthOutDir, basename)
+                for basename in basenames
+            ], chunksize = 1)
+        finally:
+            pool.close()
+            pool.join()
+        logOutputs = []
+        for basename, (returncode, logOutputSingle) in zip(basenames, results):
+            if returncode != 0:
+                logging.warning('waveform generation failed for '+basename+' (exit code '+str(returncode)+')')
+            logOutputs.append(logOutputSingle)
+        logOutput = ''.join(logOutputs)
     if logFile is not None:
         with open(logFile, 'w') as f:
             f.write(logOutput)
@@ -0,0 +1,177 @@
+"""Unit tests for acoustic feature helper functions."""
+
+# Copyright 2011, 2012, 2013, 2014, 2015 Matt Shannon
+
+# This file is part of armspeech.
+# See `License` for details of license and warranty.
+
+import unittest
+import os
+import sys
+import random
+import numpy as np
+from numpy.random import randn, randint
+
+from codedep import codeDeps
+from bisque.filehelp import TempDir
+import htk_io.vecseq as vsio
+
+import armspeech.speech.features as feat
+from armspeech.util.mathhelp import assert_allclose
+import armspeech.numpy_settings
+
+@codeDeps()
+def getMockVocoderCommand():
+    """Returns a vocoder command which just copies mgc files to wav files.
+
+    Like the HTS demo scripts, it also writes a shared intermediate file to
+    the output directory.
+    """
+    script = '; '.join([
+        'import sys, os',
+        'genDir = sys.argv[1]',
+        'open(os.path.join(genDir, "synthesis.m"), "w").write(" ".join(sys.argv[2:]))',
+        '[ open(os.path.join(genDir, base + ".wav"), "w").write(open(os.path.join(genDir, base + ".mgc")).read()) for base in sys.argv[2:] ]',
+        'sys.stdout.write("generated %s\\n" % " ".join(sys.argv[2:]))',
+    ])
+    return [sys.executable, '-c', script]
+
+@codeDeps()
+class CountingSynthDist(object):
+    """Mock dist whose outputs are acoustic sequences of a given length."""
+    def __init__(self, streams):
+        self.streams = streams
+        self.numSynthesized = 0
+
+    def synthBatch(self, inputs, method, actualOutputs):
+        self.numSynthesized += len(inputs)
+        return [
+            [ (randn(self.streams[0].order), random.choice([(0, None), (1, randn())]), randn(self.streams[2].order))
+              for _ in range(numFrames) ]
+            for numFrames in inputs
+        ]
+
+@codeDeps(CountingSynthDist, TempDir, assert_allclose, feat.AcousticSeqIo,
+    feat.Msd01Encoder, feat.Stream, feat.SynthCache,
+    feat.doHtsDemoWaveformGeneration, getMockVocoderCommand
+)
+class TestFeatures(unittest.TestCase):
+    def test_writeFilesStreaming(self, numFramesMax = 25):
+        streams = [
+            feat.Stream('mgc', randint(1, 5)),
+            feat.Stream('lf0', 1, feat.Msd01Encoder(specialValue = -1e10)),
+            feat.Stream('bap', randint(1, 5)),
+        ]
+        def getFrame():
+            return (
+                randn(streams[0].order),
+                random.choice([(0, None), (1, randn())]),
+                randn(streams[2].order),
+            )
+        for numFrames in [0, 1, randint(2, numFramesMax + 1)]:
+            acousticSeq = [ getFrame() for _ in range(numFrames) ]
+            bufferFrames = randint(1, 5)
+            with TempDir() as tempDir:
+                acousticSeqIo = feat.AcousticSeqIo(
+                    tempDir.location,
+                    [ vsio.VecSeqIo(stream.order) for stream in streams ],
+                    [ 'tag.%s' % stream.name for stream in streams ],
+                    [ stream.encoder for stream in streams ],
+                )
+                numFramesWritten = acousticSeqIo.writeFilesStreaming('utt', iter(acousticSeq), bufferFrames = bufferFrames)
+                assert numFramesWritten == numFrames
+                for stream in streams:
+                    vecSeqFile = os.path.join(tempDir.location, 'utt.tag.%s' % stream.name)
+                    assert os.path.getsize(vecSeqFile) == numFrames * stream.order * 4
+
+                acousticSeqRead = acousticSeqIo.readFiles('utt')
+                assert len(acousticSeqRead) == numFrames
+                for (mgc, lf0, bap), (mgcRead, lf0Read, bapRead) in zip(acousticSeq, acousticSeqRead):
+                    assert_allclose(mgcRead, mgc, rtol = 1e-6)
+                    assert_allclose(bapRead, bap, rtol = 1e-6)
+                    assert lf0Read[0] == lf0[0]
+                    if lf0[0] == 0:
+                        assert lf0Read[1] is None
+                    else:
+                        assert_allclose(lf0Read[1], lf0[1], rtol = 1e-6)
+
+    def test_SynthCache(self):
+        streams = [
+            feat.Stream('mgc', randint(1, 5)),
+            feat.Stream('lf0', 1, feat.Msd01Encoder(specialValue = -1e10)),
+            feat.Stream('bap', randint(1, 5)),
+        ]
+        def checkEqual(acousticSeqs, acousticSeqsGood):
+            assert len(acousticSeqs) == len(acousticSeqsGood)
+            for acousticSeq, acousticSeqGood in zip(acousticSeqs, acousticSeqsGood):
+                assert len(acousticSeq) == len(acousticSeqGood)
+                for (mgc, lf0, bap), (mgcGood, lf0Good, bapGood) in zip(acousticSeq, acousticSeqGood):
+                    assert np.all(mgc == mgcGood) and np.all(bap == bapGood)
+                    assert lf0 == lf0Good
+        dist = CountingSynthDist(streams)
+        inputs = [3, 0, 5, 2]
+        with TempDir() as tempDir:
+            synthCache = feat.SynthCache(tempDir.location, streams)
+            outputs = synthCache.synthBatch(dist, 'hashA', inputs, 0)
+            assert dist.numSynthesized == 4
+            assert [ len(output) for output in outputs ] == inputs
+            checkEqual(synthCache.synthBatch(dist, 'hashA', inputs, 0), outputs)
+            assert dist.numSynthesized == 4
+            checkEqual(synthCache.synthBatch(dist, 'hashA', [5, 7], 0)[:1], outputs[2:3])
+            assert dist.numSynthesized == 5
+            # (a different dist, method or actual output is a cache miss)
+            synthCache.synthBatch(dist, 'hashB', inputs[:1], 0)
+            synthCache.synthBatch(dist, 'hashA', inputs[:1], 1)
+            synthCache.synthBatch(dist, 'hashA', inputs[:1], 0, actualOutputs = ['actual'])
+            assert dist.numSynthesized == 8
+
+            # (least recently used files are removed to respect maxBytes)
+            cacheFiles = os.listdir(tempDir.location)
+            assert len(cacheFiles) == 8
+            def totalSize():
+                return sum([ os.path.getsize(os.path.join(tempDir.location, cacheFile)) for cacheFile in os.listdir(tempDir.location) ])
+            maxBytes = totalSize() // 2
+            feat.SynthCache(tempDir.location, streams, maxBytes = maxBytes).prune()
+            assert 0 < len(os.listdir(tempDir.location)) < 8
+            assert totalSize() <= maxBytes
+            synthCacheEmpty = feat.SynthCache(tempDir.location, streams, maxBytes = 0)
+            synthCacheEmpty.prune()
+            assert os.listdir(tempDir.location) == []
+            synthCacheEmpty.synthBatch(dist, 'hashA', inputs[:1], 0)
+            assert dist.numSynthesized == 9
+            assert os.listdir(tempDir.location) == []
+
+    def test_doHtsDemoWaveformGeneration(self, numUtts = 7):
+        basenames = [ 'utt%s.tag' % uttIndex for uttIndex in range(numUtts) ]
+        for numWorkers in [1, 3]:
+            with TempDir() as tempDir:
+                synthOutDir = tempDir.location
+                for basename in basenames:
+                    for ext in ['mgc', 'lf0', 'bap']:
+                        with open(os.path.join(synthOutDir, '%s.%s' % (basename, ext)), 'w') as f:
+                            f.write('%s %s' % (basename, ext))
+                logFile = os.path.join(synthOutDir, 'tag.log')
+                feat.doHtsDemoWaveformGeneration(None, synthOutDir, basenames, logFile = logFile, numWorkers = numWorkers, vocoderCommand = getMockVocoderCommand())
+
+                for basename in basenames:
+                    with open(os.path.join(synthOutDir, basename + '.wav')) as f:
+                        assert f.read() == '%s mgc' % basename
+                with open(logFile) as f:
+                    logOutput = f.read()
+                if numWorkers == 1:
+                    assert logOutput == 'generated %s\n' % ' '.join(basenames)
+                else:
+                    # (each utterance is generated in its own temp directory,
+                    #   which is removed afterwards)
+                    assert logOutput == ''.join([ 'generated %s\n' % basename for basename in basenames ])
+                    expectedFiles = set([ '%s.%s' % (basename, ext) for basename in basenames for ext in ['mgc', 'lf0', 'bap', 'wav'] ] + ['tag.log'])
+                    assert set(os.listdir(synthOutDir)) == expectedFiles
+        for numWorkers in [0, -1]:
+            self.assertRaises(RuntimeError, feat.doHtsDemoWaveformGeneration, None, '.', basenames, numWorkers = numWorkers, vocoderCommand = getMockVocoderCommand())
+
+@codeDeps(TestFeatures)
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(TestFeatures)
+
+if __name__ == '__main__':
+    unittest.main()
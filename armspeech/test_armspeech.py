@@ -16,13 +16,14 @@ from armspeech.modelling import test_minimize
 from armspeech.modelling import test_transform
 from armspeech.modelling import test_wnet
 from armspeech.modelling import test_modelling_jobs
+from armspeech.speech import test_features
 from armspeech.util import test_iterhelp
 from armspeech.util import test_mathhelp
 from armspeech.util import test_memoize
 
-@codeDeps(test_dist.suite, test_iterhelp.suite, test_mathhelp.suite,
-    test_memoize.suite, test_minimize.suite, test_modelling_jobs.suite,
-    test_transform.suite, test_wnet.suite
+@codeDeps(test_dist.suite, test_features.suite, test_iterhelp.suite,
+    test_mathhelp.suite, test_memoize.suite, test_minimize.suite,
+    test_modelling_jobs.suite, test_transform.suite, test_wnet.suite
 )
 def suite(deepTest = False):
     return unittest.TestSuite([
@@ -31,6 +32,7 @@ def suite(deepTest = False):
         test_transform.suite(),
         test_wnet.suite(),
         test_modelling_jobs.suite(),
+        test_features.suite(),
         test_iterhelp.suite(),
         test_mathhelp.suite(),
         test_memoize.suite(),
@@ -6,6 +6,8 @@
 # See `License` for details of license and warranty.
 
 from collections import deque
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
 
 from codedep import codeDeps
 
@@ -19,6 +21,168 @@ def contextualizeIter(contextLength, iter, fillFrames = []):
         if len(context) > contextLength:
             context.popleft()
 
+@codeDeps()
+class MsdArray(object):
+    """A sequence of MSD elements stored as two arrays.
+
+    An MSD element is either (0, None) (e.g. unvoiced lf0) or (comp, value)
+    with comp non-zero and value a scalar. comps stores the component of each
+    element and values the corresponding value (NaN where comp is 0).
+    None may be assigned as an element and is stored as (0, None).
+    Slicing returns an MsdArray which is a view of the same arrays.
+    """
+    def __init__(self, comps, values):
+        self.comps = comps
+        self.values = values
+
+        assert len(self.comps) == len(self.values)
+
+    def __repr__(self):
+        return 'MsdArray(%r, %r)' % (self.comps, self.values)
+
+    def __len__(self):
+        return len(self.comps)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return MsdArray(self.comps[index], self.values[index])
+        comp = int(self.comps[index])
+        return (0, None) if comp == 0 else (comp, float(self.values[index]))
+
+    def __setitem__(self, index, elem):
+        comp, value = (0, None) if elem is None else elem
+        self.comps[index] = comp
+        self.values[index] = np.nan if comp == 0 else value
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+@codeDeps()
+class StreamContext(object):
+    """The past context of a frame, stored with one array per stream.
+
+    Behaves as a sequence of length frames, each a tuple with one element per
+    stream, starting at index start of the stream arrays.
+    stream(streamIndex) returns the context for a single stream as a slice of
+    the corresponding stream array, which is much cheaper than indexing each
+    frame in turn.
+    """
+    def __init__(self, streamArrays, start, length):
+        self.streamArrays = streamArrays
+        self.start = start
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            sliceStart, sliceEnd, sliceStep = index.indices(self.length)
+            assert sliceStep == 1
+            return StreamContext(self.streamArrays, self.start + sliceStart,
+                                 max(sliceEnd - sliceStart, 0))
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('context index out of range')
+        return tuple([ streamArray[self.start + index]
+                       for streamArray in self.streamArrays ])
+
+    def __iter__(self):
+        for index in range(self.length):
+            yield self[index]
+
+    def stream(self, streamIndex):
+        return self.streamArrays[streamIndex][self.start:
+                                              (self.start + self.length)]
+
+@codeDeps(MsdArray, StreamContext)
+class PackedFrames(object):
+    """Pre-allocated packed storage for a sequence of frames.
+
+    The layout is determined from frameTemplate. Frames which are tuples (one
+    element per stream, as for multi-stream acoustic frames) are stored with
+    one array per stream, where a stream whose element in frameTemplate is
+    None or a tuple is assumed to be an MSD stream and is stored as an
+    MsdArray. Other frames are assumed to be numeric with the same shape as
+    frameTemplate and are stored in a single array.
+    """
+    def __init__(self, frameTemplate, numFrames):
+        if isinstance(frameTemplate, tuple):
+            self.array = None
+            self.streamArrays = [
+                (MsdArray(np.zeros((numFrames,), dtype = np.int64),
+                          np.empty((numFrames,)))
+                 if elem is None or isinstance(elem, tuple)
+                 else np.empty((numFrames,) + np.shape(elem)))
+                for elem in frameTemplate
+            ]
+        else:
+            self.array = np.empty((numFrames,) + np.shape(frameTemplate))
+            self.streamArrays = None
+
+    def __setitem__(self, index, frame):
+        if self.streamArrays is None:
+            self.array[index] = frame
+        else:
+            assert len(frame) == len(self.streamArrays)
+            for streamArray, elem in zip(self.streamArrays, frame):
+                streamArray[index] = elem
+
+    def context(self, start, length):
+        """Returns a view of the length frames starting at start."""
+        if self.streamArrays is None:
+            return self.array[start:(start + length)]
+        else:
+            return StreamContext(self.streamArrays, start, length)
+
+@codeDeps(PackedFrames)
+def contextualizeArray(contextLength, frames, fillFrames):
+    """Returns packed views of the past context of each frame.
+
+    An array-based analogue of contextualizeIter.
+    The frames are packed once with fillFrames prepended, and (contexts,
+    frames) is returned, where contexts[t] is a view of the contextLength
+    frames preceding the t-th frame (no frame data is copied).
+    If frames are numeric and all have the same shape then they are packed
+    into a single array, contexts is a read-only strided view of this array
+    and the returned frames are the rows of this array.
+    Otherwise frames should be tuples or lists (one element per stream, for
+    example with an MSD stream or streams of differing shapes), and each
+    stream is packed into its own array (see PackedFrames), each context is a
+    StreamContext and the returned frames are the original frames.
+    Requires exactly contextLength fill frames so that every context has the
+    same length.
+    """
+    assert len(fillFrames) == contextLength
+    allFrames = list(fillFrames) + list(frames)
+    numFrames = len(allFrames) - contextLength
+    try:
+        packed = np.asarray(allFrames)
+    except ValueError:
+        packed = None
+    if packed is None or packed.dtype == np.object_:
+        if not isinstance(allFrames[0], (tuple, list)):
+            raise ValueError('frames must be numeric and all have the same'
+                             ' shape, or be sequences of streams')
+        packedFrames = PackedFrames(tuple(allFrames[0]), len(allFrames))
+        for index, frame in enumerate(allFrames):
+            packedFrames[index] = frame
+        contexts = [ packedFrames.context(frameIndex, contextLength)
+                     for frameIndex in range(numFrames) ]
+        return contexts, allFrames[contextLength:]
+
+    frameShape = np.shape(packed)[1:]
+    frameStride = packed.strides[0]
+    contexts = as_strided(
+        packed,
+        shape = (numFrames, contextLength) + frameShape,
+        strides = (frameStride, frameStride) + packed.strides[1:]
+    )
+    contexts.flags.writeable = False
+    return contexts, packed[contextLength:]
+
 @codeDeps()
 def getChunk(xs, chunkIndex, numChunks):
     assert numChunks >= 1
@@ -68,6 +68,20 @@ def logSum(l):
     else:
         return np.log(np.sum(np.exp(np.array(l) - k))) + k
 
+@codeDeps()
+def logSumArray(a, axis = 0):
+    """Computes log(sum(exp(a))) along the given axis of an array.
+
+    A vectorized version of logSum. Avoids underflow and copes with slices
+    which are entirely -inf.
+    """
+    a = np.asarray(a, dtype = np.float64)
+    if np.shape(a)[axis] == 0:
+        return np.sum(a, axis = axis) + _negInf
+    k = np.max(a, axis = axis)
+    k = np.where(k == _negInf, 0.0, k)
+    return np.log(np.sum(np.exp(a - np.expand_dims(k, axis)), axis = axis)) + k
+
 @codeDeps()
 class ThreshMax(object):
     """Computes the thresholded maximum of a list.
@@ -120,6 +134,46 @@ def sigmoid(a):
     else:
         return 1.0 / (1.0 + math.exp(-a))
 
+@codeDeps()
+def sigmoidArray(a):
+    """Computes the sigmoid function elementwise (agrees with sigmoid)."""
+    a = np.asarray(a, dtype = np.float64)
+    return np.where(a > 40.0, 1.0,
+                    np.where(a < -500.0, 0.0, 1.0 / (1.0 + np.exp(-a))))
+
+@codeDeps()
+def packSymmetric(a):
+    """Packs symmetric matrices into their upper triangles.
+
+    a should have shape (..., n, n), and the returned array has shape
+    (..., n * (n + 1) / 2).
+    Only the upper triangle of a is read.
+    """
+    rows, cols = np.triu_indices(np.shape(a)[-1])
+    return np.asarray(a)[..., rows, cols]
+
+@codeDeps()
+def unpackSymmetric(packed):
+    """Inverse of packSymmetric."""
+    numPacked = np.shape(packed)[-1]
+    n = int(round((math.sqrt(8 * numPacked + 1) - 1) / 2))
+    assert n * (n + 1) // 2 == numPacked
+    rows, cols = np.triu_indices(n)
+    a = np.empty(np.shape(packed)[:-1] + (n, n))
+    a[..., rows, cols] = packed
+    a[..., cols, rows] = packed
+    return a
+
+@codeDeps()
+def outerPacked(x):
+    """Returns packSymmetric(np.outer(x, x)) without computing the full outer.
+
+    If x has shape (n, ...) then the returned array has shape
+    (n * (n + 1) / 2, ...).
+    """
+    rows, cols = np.triu_indices(len(x))
+    return x[rows] * x[cols]
+
 @codeDeps()
 def logDet(mat):
     if np.shape(mat) == (0, 0):
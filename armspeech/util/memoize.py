@@ -5,7 +5,11 @@
 # This file is part of armspeech.
 # See `License` for details of license and warranty.
 
+import os
+from collections import OrderedDict
+
 from codedep import codeDeps, ForwardRef
+from bisque import persist
 
 @codeDeps(ForwardRef(lambda: MemoizedFn))
 def memoize(fn):
@@ -26,3 +30,54 @@ class MemoizedFn(object):
         if args not in self.mem:
             self.mem[args] = self.fn(*args)
         return self.mem[args]
+
+@codeDeps(persist.loadPickle, persist.savePickle)
+class LruCache(object):
+    """Bounded least-recently-used cache with optional on-disk persistence.
+
+    Keys should be strings which are valid filenames (e.g. hashes as computed
+    by persist.secHashObject). At most maxSize values are kept in memory. If
+    cacheDir is not None then each computed value is also pickled to cacheDir,
+    and values which are not in memory (for example because they were evicted
+    or were computed by a different process) are loaded from there rather than
+    recomputed.
+
+    The in-memory values are not pickled along with the cache.
+    """
+    def __init__(self, maxSize, cacheDir = None):
+        self.maxSize = maxSize
+        self.cacheDir = cacheDir
+
+        assert self.maxSize >= 0
+
+        self.mem = OrderedDict()
+
+    def __repr__(self):
+        return 'LruCache(%r, cacheDir=%r)' % (self.maxSize, self.cacheDir)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['mem'] = OrderedDict()
+        return state
+
+    def __contains__(self, key):
+        return key in self.mem
+
+    def get(self, key, compute):
+        """Returns the value for key, calling compute() if not cached."""
+        if key in self.mem:
+            value = self.mem.pop(key)
+        else:
+            location = (None if self.cacheDir is None
+                        else os.path.join(self.cacheDir, key+'.pickle'))
+            if location is not None and os.path.exists(location):
+                value = persist.loadPickle(location)
+            else:
+                value = compute()
+                if location is not None:
+                    persist.savePickle(location, value)
+        if self.maxSize > 0:
+            self.mem[key] = value
+            while len(self.mem) > self.maxSize:
+                self.mem.popitem(last = False)
+        return value
@@ -7,6 +7,7 @@
 
 import unittest
 import random
+import numpy as np
 
 from codedep import codeDeps
 
@@ -16,8 +17,53 @@ import armspeech.util.iterhelp as ih
 def gen_list(length):
     return [ random.choice('ABCDEFGHIJKLM') for i in range(length) ]
 
-@codeDeps(gen_list, ih.chunkList)
+@codeDeps(gen_list, ih.MsdArray, ih.chunkList, ih.contextualizeArray,
+    ih.contextualizeIter
+)
 class TestIterHelp(unittest.TestCase):
+    def test_contextualizeArray(self, its = 100):
+        for it in range(its):
+            contextLength = random.randint(0, 4)
+            frameShape = random.choice([(), (3,)])
+            frames = [ np.random.randn(*frameShape) for i in range(random.randint(0, 10)) ]
+            fillFrames = [ np.random.randn(*frameShape) for i in range(contextLength) ]
+            contexts, frameArray = ih.contextualizeArray(contextLength, frames, fillFrames)
+            contextedFrames = list(ih.contextualizeIter(contextLength, frames, fillFrames = fillFrames))
+            assert len(contexts) == len(frameArray) == len(contextedFrames)
+            for context, frame, (contextGood, frameGood) in zip(contexts, frameArray, contextedFrames):
+                assert np.all(frame == frameGood)
+                assert np.shape(context) == (contextLength,) + frameShape
+                assert all([ np.all(x == xGood) for x, xGood in zip(context, contextGood) ])
+
+    def test_contextualizeArray_streams(self, its = 100):
+        def genMsd():
+            return random.choice([(0, None), (1, np.random.randn())])
+        def genFrame():
+            return np.random.randn(3), genMsd(), np.random.randn()
+        for it in range(its):
+            contextLength = random.randint(0, 4)
+            frames = [ genFrame() for i in range(random.randint(0, 10)) ]
+            fillFrames = [ (np.random.randn(3), random.choice([None, genMsd()]), np.random.randn()) for i in range(contextLength) ]
+            contexts, framesOut = ih.contextualizeArray(contextLength, frames, fillFrames)
+            contextedFrames = list(ih.contextualizeIter(contextLength, frames, fillFrames = fillFrames))
+            assert len(framesOut) == len(frames)
+            assert all([ frameOut is frame for frameOut, frame in zip(framesOut, frames) ])
+            assert len(contexts) == len(contextedFrames)
+            for context, (contextGood, frameGood) in zip(contexts, contextedFrames):
+                assert len(context) == contextLength
+                for (mgc, lf0, bap), (mgcGood, lf0Good, bapGood) in zip(context, contextGood):
+                    assert np.all(mgc == mgcGood) and bap == bapGood
+                    assert lf0 == ((0, None) if lf0Good is None else lf0Good)
+                if contextLength > 0:
+                    # (per-stream views)
+                    start = random.randint(0, contextLength - 1)
+                    assert np.all(context.stream(0)[start:] == np.array([ mgc for mgc, lf0, bap in contextGood[start:] ]))
+                    assert np.all(context[start:].stream(2) == np.array([ bap for mgc, lf0, bap in contextGood[start:] ]))
+                    lf0Context = context.stream(1)
+                    assert isinstance(lf0Context, ih.MsdArray)
+                    assert list(lf0Context) == [ (0, None) if lf0 is None else lf0 for mgc, lf0, bap in contextGood ]
+                    assert context[-1][2] == contextGood[-1][2]
+
     def test_chunkList(self, its = 100):
         for it in range(its):
             length = random.randint(0, 20)
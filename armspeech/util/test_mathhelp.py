@@ -55,7 +55,9 @@ def shapeRand(ranks = [0, 1], allDimsNonZero = False):
 
 @codeDeps(ThreshMax, assert_allclose, gen_float, gen_list_of_floats,
     mathhelp.logAdd, mathhelp.logDet, mathhelp.logDetPosDef, mathhelp.logSum,
-    mathhelp.reprArray, mathhelp.sampleDiscrete, randLogProb, shapeRand
+    mathhelp.logSumArray, mathhelp.outerPacked, mathhelp.packSymmetric,
+    mathhelp.reprArray, mathhelp.sampleDiscrete, mathhelp.sigmoid,
+    mathhelp.sigmoidArray, mathhelp.unpackSymmetric, randLogProb, shapeRand
 )
 class TestMathHelp(unittest.TestCase):
     def test_logAdd(self, numPoints = 200):
@@ -72,6 +74,36 @@ class TestMathHelp(unittest.TestCase):
             r = mathhelp.logSum(l)
             assert_allclose(np.exp(r), np.sum(np.exp(l)))
 
+    def test_logSumArray(self, numPoints = 200):
+        for pointIndex in range(numPoints):
+            m = randint(0, 5)
+            n = randint(0, 20)
+            a = np.array([ [ randLogProb() for _ in range(n) ] for _ in range(m) ]).reshape((m, n))
+            r = mathhelp.logSumArray(a, axis = 1)
+            assert_allclose(r, [ mathhelp.logSum(list(row)) for row in a ])
+            r = mathhelp.logSumArray(a, axis = 0)
+            assert_allclose(r, [ mathhelp.logSum(list(col)) for col in a.T ])
+
+    def test_sigmoidArray(self, numPoints = 200):
+        a = np.append(randn(numPoints) * 100.0, [-1000.0, -500.0, 0.0, 40.0, 1000.0])
+        assert_allclose(mathhelp.sigmoidArray(a), [ mathhelp.sigmoid(x) for x in a ])
+        for x in [a[0], np.float64(a[0]), -1000.0, 1000.0]:
+            assert np.shape(mathhelp.sigmoidArray(x)) == ()
+            assert_allclose(mathhelp.sigmoidArray(x), mathhelp.sigmoid(x))
+        assert np.shape(mathhelp.sigmoidArray(np.reshape(a[:6], (2, 3)))) == (2, 3)
+
+    def test_packSymmetric(self, numPoints = 50):
+        for pointIndex in range(numPoints):
+            n = randint(0, 6)
+            shape = tuple(randint(1, 4, size = randint(0, 3)))
+            a = randn(*(shape + (n, n)))
+            a = a + np.swapaxes(a, -1, -2)
+            packed = mathhelp.packSymmetric(a)
+            assert np.shape(packed) == shape + (n * (n + 1) // 2,)
+            assert_allclose(mathhelp.unpackSymmetric(packed), a)
+            x = randn(n)
+            assert_allclose(mathhelp.outerPacked(x), mathhelp.packSymmetric(np.outer(x, x)))
+
     def test_ThreshMax(self, numPoints = 200):
         for pointIndex in range(numPoints):
             objectType = randint(3)
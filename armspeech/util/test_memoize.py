@@ -6,10 +6,13 @@
 # See `License` for details of license and warranty.
 
 import unittest
+import os
 
 from codedep import codeDeps
+from bisque import persist
+from bisque.filehelp import TempDir
 
-from armspeech.util.memoize import memoize
+from armspeech.util.memoize import memoize, LruCache
 
 @codeDeps()
 class FnEval(object):
@@ -22,7 +25,7 @@ class FnEval(object):
         self.evalCount += 1
         return self.f(x)
 
-@codeDeps(FnEval, memoize)
+@codeDeps(FnEval, LruCache, TempDir, memoize, persist.roundTrip)
 class TestMemoize(unittest.TestCase):
     def test_memoize(self):
         def f(x):
@@ -45,6 +48,37 @@ class TestMemoize(unittest.TestCase):
         assert fe.evalCount == 2
         assert fm(x3) == f(x3)
         assert fe.evalCount == 3
+    def test_LruCache(self):
+        def f(key):
+            return key * 2
+        fe = FnEval(f)
+        cache = LruCache(2)
+        assert cache.get('a', lambda: fe('a')) == 'aa'
+        assert cache.get('b', lambda: fe('b')) == 'bb'
+        assert fe.evalCount == 2
+        assert cache.get('a', lambda: fe('a')) == 'aa'
+        assert fe.evalCount == 2
+        # 'b' is least recently used so is evicted
+        assert cache.get('c', lambda: fe('c')) == 'cc'
+        assert 'a' in cache and 'b' not in cache and 'c' in cache
+        assert cache.get('b', lambda: fe('b')) == 'bb'
+        assert fe.evalCount == 4
+        cacheAgain = persist.roundTrip(cache)
+        assert 'a' not in cacheAgain and cacheAgain.maxSize == 2
+
+    def test_LruCache_persistence(self):
+        def f(key):
+            return [key]
+        fe = FnEval(f)
+        with TempDir() as tempDir:
+            cache = LruCache(0, cacheDir = tempDir.location)
+            assert cache.get('a', lambda: fe('a')) == ['a']
+            assert os.path.exists(os.path.join(tempDir.location, 'a.pickle'))
+            assert cache.get('a', lambda: fe('a')) == ['a']
+            assert fe.evalCount == 1
+            cacheOther = LruCache(1, cacheDir = tempDir.location)
+            assert cacheOther.get('a', lambda: fe('a')) == ['a']
+            assert fe.evalCount == 1
 
 @codeDeps(TestMemoize)
 def suite():
@@ -281,6 +281,41 @@ class LazySeqArtifact(Artifact):
 def lazySeq(seqArt):
     return LazySeqArtifact(seqArt)
 
+@codeDeps(Artifact)
+class LazyArtifact(Artifact):
+    """A wrapper for artifacts allowing lazy loading.
+
+    The artifact value for this class is a function which takes no arguments
+    and returns the value of the underlying artifact.
+    The underlying value is only loaded when this function is called, and is
+    not stored by this class.
+    This class therefore provides a way for a job with many large inputs to
+    load (e.g. unpickle) each input only when it is needed and to release it
+    afterwards.
+    """
+    def __init__(self, art):
+        self.art = art
+    def parents(self):
+        return self.art.parents()
+    def parentArtifacts(self):
+        return self.art.parentArtifacts()
+    def computeSecHash(self):
+        return self.art.computeSecHash()
+    def loc(self, buildRepo):
+        return self.art.loc(buildRepo)
+    def isDone(self, buildRepo):
+        return self.art.isDone(buildRepo)
+    def loadValue(self, buildRepo):
+        def getValue():
+            return self.art.loadValue(buildRepo)
+        return getValue
+    def saveValue(self, buildRepo, value):
+        return self.art.saveValue(buildRepo, value)
+
+@codeDeps(LazyArtifact)
+def lazy(art):
+    return LazyArtifact(art)
+
 @codeDeps(Artifact, codedep.getHash, persist.loadPickle, persist.savePickle,
     persist.secHashObject
 )
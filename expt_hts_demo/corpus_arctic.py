@@ -12,6 +12,7 @@ that is produced by the HTS demo with STRAIGHT.
 import os
 
 from codedep import codeDeps, ForwardRef
+from bisque import persist
 from htk_io.base import DirReader
 import htk_io.alignment as alio
 import htk_io.vecseq as vsio
@@ -23,7 +24,8 @@ from armspeech.util.timing import timed
 
 @codeDeps(align.checkAlignment, ForwardRef(lambda: cleanAlignment), cps.Corpus,
     feat.AcousticSeqIo, feat.Msd01Encoder, feat.Stream,
-    feat.doHtsDemoWaveformGeneration, ForwardRef(lambda: getMgcLims40), timed
+    feat.doHtsDemoWaveformGeneration, ForwardRef(lambda: getMgcLims40),
+    persist.secHashObject, timed
 )
 class ArcticCorpus(cps.Corpus):
     def __init__(self, trainUttIds, testUttIds, synthUttIds, dataDir, labDir, scriptsDir, parseLabel, subLabels, mgcOrder, framePeriod):
@@ -96,7 +98,18 @@ class ArcticCorpus(cps.Corpus):
         return frames
 
     # (FIXME : this should not be part of corpus?)
-    def synthComplete(self, dist, uttIds, method, synthOutDir, exptTag, afterSynth = None, verbosity = 1):
+    def synthComplete(self, dist, uttIds, method, synthOutDir, exptTag, afterSynth = None, batchSize = 16, streaming = False, synthCache = None, numWaveformWorkers = 1, verbosity = 1):
+        """Synthesizes the given utterances and generates waveforms.
+
+        If streaming is True then each utterance is written to disk frame by
+        frame as it is synthesized (so memory use does not grow with
+        utterance length), which requires dist to have a synthIterator method
+        and afterSynth and synthCache to be None. Otherwise utterances are synthesized in
+        batches of batchSize in lockstep.
+        If synthCache is not None then synthesized outputs are cached (see
+        feat.SynthCache), and utterances whose dist, input and method are
+        unchanged since a previous call are not synthesized again.
+        """
         synthAcousticSeqIo = feat.AcousticSeqIo(
             synthOutDir,
             [ vsio.VecSeqIo(stream.order) for stream in self.streams ],
@@ -107,17 +120,31 @@ class ArcticCorpus(cps.Corpus):
         if verbosity >= 1:
             print 'synth: synthesizing to', synthOutDir, 'with tag', exptTag
 
-        for uttId in uttIds:
-            synthOutput = self.synth(dist, uttId, method)
+        if streaming:
             if afterSynth is not None:
-                afterSynth(synthOutput = synthOutput, uttId = uttId, exptTag = exptTag)
-            synthAcousticSeqIo.writeFiles(uttId, synthOutput)
+                raise RuntimeError('afterSynth is not supported when streaming'
+                                   ' (the complete output is never stored)')
+            if synthCache is not None:
+                raise RuntimeError('synthCache is not supported when'
+                                   ' streaming')
+            for uttId in uttIds:
+                synthAcousticSeqIo.writeFilesStreaming(uttId, self.synthIterator(dist, uttId, method))
+        else:
+            distHash = None if synthCache is None else persist.secHashObject(dist)
+            for batchStart in range(0, len(uttIds), batchSize):
+                uttIdsBatch = uttIds[batchStart:(batchStart + batchSize)]
+                synthOutputs = self.synthBatch(dist, uttIdsBatch, method, synthCache = synthCache, distHash = distHash)
+                for uttId, synthOutput in zip(uttIdsBatch, synthOutputs):
+                    if afterSynth is not None:
+                        afterSynth(synthOutput = synthOutput, uttId = uttId, exptTag = exptTag)
+                    synthAcousticSeqIo.writeFiles(uttId, synthOutput)
 
         (timed(feat.doHtsDemoWaveformGeneration) if verbosity >= 1 else feat.doHtsDemoWaveformGeneration)(
             self.scriptsDir,
             synthOutDir,
             basenames = [ uttId+'.'+exptTag for uttId in uttIds ],
-            logFile = os.path.join(synthOutDir, exptTag+'.log')
+            logFile = os.path.join(synthOutDir, exptTag+'.log'),
+            numWorkers = numWaveformWorkers
         )
 
 @codeDeps()
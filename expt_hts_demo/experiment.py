@@ -167,9 +167,19 @@ def evaluateMgcOutError(dist, corpus, vecError = stdCepDist, desc = 'MCD'):
             ('test %s' % desc, (testError, testFrames))]
 
 @codeDeps(d.SynthMethod)
-def evaluateSynthesize(dist, corpus, synthOutDir, exptTag, afterSynth = None):
-    corpus.synthComplete(dist, corpus.synthUttIds, d.SynthMethod.Sample, synthOutDir, exptTag+'.sample', afterSynth = afterSynth)
-    corpus.synthComplete(dist, corpus.synthUttIds, d.SynthMethod.Meanish, synthOutDir, exptTag+'.meanish', afterSynth = afterSynth)
+def evaluateSynthesize(dist, corpus, synthOutDir, exptTag, afterSynth = None, streaming = False, synthCache = None, numWaveformWorkers = 1):
+    """Synthesizes the synth utterances of corpus using sampling and meanish.
+
+    If streaming is True then utterances are written to disk frame by frame
+    as they are synthesized (see corpus.synthComplete). In this case the
+    complete synthesized output is never held in memory, so the afterSynth
+    hook (e.g. drawing figures) is skipped and synthCache is not used.
+    """
+    if streaming:
+        afterSynth = None
+        synthCache = None
+    corpus.synthComplete(dist, corpus.synthUttIds, d.SynthMethod.Sample, synthOutDir, exptTag+'.sample', afterSynth = afterSynth, streaming = streaming, synthCache = synthCache, numWaveformWorkers = numWaveformWorkers)
+    corpus.synthComplete(dist, corpus.synthUttIds, d.SynthMethod.Meanish, synthOutDir, exptTag+'.meanish', afterSynth = afterSynth, streaming = streaming, synthCache = synthCache, numWaveformWorkers = numWaveformWorkers)
 
 @codeDeps(draw.drawLabelledSeq, draw.partitionSeq)
 def getDrawMgc(corpus, mgcIndices, figOutDir, ylims = None, includeGivenLabels = True, extraLabelSeqs = []):
@@ -195,7 +205,7 @@ def getDrawMgc(corpus, mgcIndices, figOutDir, ylims = None, includeGivenLabels =
     evaluateSynthesize, getDrawMgc, persist.savePickle, reportFlooredPerStream,
     stdCepDistIncZero
 )
-def evaluateVarious(dist, bmi, corpus, synthOutDir, figOutDir, exptTag, vecError = stdCepDistIncZero):
+def evaluateVarious(dist, bmi, corpus, synthOutDir, figOutDir, exptTag, vecError = stdCepDistIncZero, streaming = False, synthCache = None, numWaveformWorkers = 1):
     # FIXME : vecError default should probably be changed to stdCepDist eventually
     reportFlooredPerStream(dist)
     # (FIXME : perhaps this shouldn't really go in synthOutDir)
@@ -204,7 +214,7 @@ def evaluateVarious(dist, bmi, corpus, synthOutDir, figOutDir, exptTag, vecError
     logProbResults = evaluateLogProb(dist, corpus)
     marcdResults = evaluateMgcOutError(dist, corpus, vecError = vecError)
     mcdResults = evaluateMgcArOutError(dist, corpus, vecError = vecError)
-    evaluateSynthesize(dist, corpus, synthOutDir, exptTag, afterSynth = getDrawMgc(corpus, bmi.mgcSummarizer.outIndices, figOutDir))
+    evaluateSynthesize(dist, corpus, synthOutDir, exptTag, afterSynth = getDrawMgc(corpus, bmi.mgcSummarizer.outIndices, figOutDir), streaming = streaming, synthCache = synthCache, numWaveformWorkers = numWaveformWorkers)
     return logProbResults + marcdResults + mcdResults
 
 @codeDeps(d.defaultEstimatePartial, nodetree.getDagMap,
@@ -472,9 +482,11 @@ def globalToMonophoneMap(dist, bmi, tupleMap = tupleMap1Phone):
 
 @codeDeps(ElemGetter, d.AutoGrowingDiscreteAcc, d.MappedInputAcc,
     d.createDiscreteAcc, d.defaultCreateAccPartial, d.getDefaultCreateAcc,
-    getElem, nodetree.findTaggedNode, nodetree.getDagMap, tupleMap1
+    d.getPackedCreateAcc, getElem, nodetree.findTaggedNode, nodetree.getDagMap,
+    tupleMap1
 )
-def globalToFullCtxCreateAcc(dist, bmi, agTags = None, tupleMap = tupleMap1):
+def globalToFullCtxCreateAcc(dist, bmi, agTags = None, tupleMap = tupleMap1,
+                             packed = False):
     """Converts a global dist to a full context acc.
 
     Expects stream dist tag to be ('stream', streamName).
@@ -497,8 +509,13 @@ def globalToFullCtxCreateAcc(dist, bmi, agTags = None, tupleMap = tupleMap1):
     In this case only the corresponding streams and subLabels have an
     AutoGrowingDiscreteAcc created.
     (This is mainly for debugging).
+
+    If packed is True then the acoustic vector accs store their symmetric
+    sumOuter statistics packed, roughly halving the memory used by the
+    per-label accs.
     """
     getAcInput = ElemGetter(1, 2)
+    createAccAc = d.getPackedCreateAcc() if packed else d.getDefaultCreateAcc()
 
     def globalToFullCtxCreateAccPartial(dist, createAccChild):
         if getElem(dist.tag, 0, 2) == 'stream':
@@ -506,7 +523,7 @@ def globalToFullCtxCreateAcc(dist, bmi, agTags = None, tupleMap = tupleMap1):
             acVecDist = nodetree.findTaggedNode(dist,
                                                 lambda tag: tag == 'acVec')
             def createAcc():
-                return d.getDefaultCreateAcc()(acVecDist)
+                return createAccAc(acVecDist)
             return d.MappedInputAcc(tupleMap,
                 d.createDiscreteAcc(bmi.subLabels, lambda subLabel:
                     (